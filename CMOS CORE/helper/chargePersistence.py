@@ -5,10 +5,15 @@ import math
 import time
 from astropy.io import fits
 import re
+import itertools
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import sys
 sys.path.append("..")
 import loadImage
+import stackStats
+from headerIndex import headerIndex
 
 sys.path.append("../cam")
 from camera import DLAPICamera
@@ -139,39 +144,126 @@ class CHARGEPERSISTENCE:
             time.sleep(1) 
         
     
-    def calcPersistence(self, temp=5):
+    def calcPersistence(self, temp=5, tileSize=64, nExp=2, workers=4):
         """
-        Loads biases in order they are taken and calculates mean pixel values.
+        Loads biases in order they are taken and calculates the mean pixel value of
+        every tileSize x tileSize tile. Frames are memory mapped and reduced to tile
+        means by a pool of threads, so no full frame is kept and the 300 frames are
+        never in memory together. Times come from the DATE-OBS header (through the
+        header index) relative to the first bias. A decay of nExp exponentials is
+        then fit to every tile at once (see fitDecay) and the maps saved as fits to
+        data/chargePersistence/maps.
 
         Args:
             temp (int, optional): Temperature of sensor (what biases to load). Defaults to 5.
+            tileSize (int, optional): Width of a square tile in pixels. Defaults to 64.
+            nExp (int, optional): Number of exponentials in the decay model. Defaults to 2.
+            workers (int, optional): Number of threads reading frames. Defaults to 4.
+
+        Returns:
+            dict: offset, amplitude and tau maps (see fitDecay).
         """
-        meanCounts = []
         dataPath = os.path.join(self.rootPath, 'data', 'chargePersistence', 'bias', f'{temp}', "High Gain")
         
-        # Sort files before loading 
+        # Sort files before loading, order they were taken in
         filenames = sorted([filename for filename in os.listdir(dataPath) if filename.endswith(".fits")],
                            key=lambda x: int(re.search(r'(\d+).fits', x).group(1)))
         
-        # Load bias images. Similar to loadImage.py but done here because order matters. 
-        # Also mean is calculated immedietly instead of returning a 2d array of each frame.
-        # This is done because the pi runs out of memory if loading all images.
-        for filename in filenames:
-            filePath = os.path.join(dataPath, filename)
-            try:
-                with fits.open(filePath) as hdul:
-                    data = hdul[0].data
-                    meanCounts.append(np.sum(data))
-            except Exception as e:
-                print(f"Error reading {filePath}: {str(e)}")
- 
-        # fills a list up to numBias in 1 increments. Time list.
-        times = [i for i in range(1, self.numBias+1)]    
+        # Real time of each frame from the header index, 1s cadence if there is no DATE-OBS
+        index = headerIndex(dataPath)
+        dates = [index.get(filename, 'DATE-OBS') for filename in filenames]
+        if all(dates):
+            times = frameTimes(dates)
+        else:
+            print("DATE-OBS missing, assuming 1s between biases")
+            times = np.arange(len(filenames), dtype=np.float64)
+
+        # Tile means of every frame, read in parallel. Only the (frames, tilesY, tilesX) means are kept
+        def tileMeans(filename):
+            frame = loadImage.lazyFrame(os.path.join(dataPath, filename))
+            return stackStats.tileView(frame[...], tileSize).mean(axis=(1, 3))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            tiles = np.array(list(pool.map(tileMeans, filenames)))
+
+        return self.fitPersistence(times, tiles, temp, tileSize, nExp)
+
+
+    def streamPersistence(self, temp=5, expTime=3, tileSize=64, nExp=2, readout_mode="High Gain", saveEvery=None):
+        """
+        Takes a light image followed by numBias biases 1s apart and reduces every
+        bias to tile means as it is downloaded, so the burst is never written to
+        disk and read back (apart from every saveEvery'th bias if asked for).
+        The decay is then fit like calcPersistence.
+
+        Args:
+            temp (int, optional): Temperature of sensor. Defaults to 5.
+            expTime (int, optional): Exposure time of light image. Defaults to 3.
+            tileSize (int, optional): Width of a square tile in pixels. Defaults to 64.
+            nExp (int, optional): Number of exponentials in the decay model. Defaults to 2.
+            readout_mode (str, optional): Readout mode of sensor. Defaults to "High Gain".
+            saveEvery (int, optional): Also save every saveEvery'th bias. Defaults to None.
+
+        Returns:
+            dict: offset, amplitude and tau maps (see fitDecay).
+        """
+        self.takeLight(temp=temp, expTime=expTime, readout_mode=readout_mode)
+        savedir = os.path.join(self.rootPath, 'data', 'chargePersistence', 'bias', str(temp), readout_mode)
+        os.makedirs(savedir, exist_ok=True)
+        gateway = DLAPIGateway() 
+        cam = DLAPICamera(gateway, model='stc', dirname=savedir)
+        cam.connect() 
+        cam.set_temperature(temp)
+
+        # Only the (frames, tilesY, tilesX) means and the start times are kept
+        tiles = []
+        dates = []
+        def addBias(frame, header):
+            tiles.append(stackStats.tileView(frame, tileSize).mean(axis=(1, 3)))
+            dates.append(header['DATE-OBS'])
+
+        result = cam.acquire(self.numBias, 0, [addBias], imtype='bias', readout_mode=readout_mode, 
+                             fast=True, interval=1, save_every=saveEvery)
+        print(result.description)
+        if len(tiles) <= nExp + 1:
+            print(f"Not enough biases to fit: {len(tiles)}")
+            return
+        times = frameTimes(dates)
+        return self.fitPersistence(times, np.array(tiles), temp, tileSize, nExp)
+
+
+    def fitPersistence(self, times, tiles, temp, tileSize, nExp):
+        """
+        Fits the decay of every tile, saves the maps as fits to data/chargePersistence/maps
+        and plots the mean of every frame.
+
+        Args:
+            times (np.ndarray): (frames,) time of every bias in seconds.
+            tiles (np.ndarray): (frames, tilesY, tilesX) tile means.
+            temp (int): Temperature of sensor, used in the file names.
+            tileSize (int): Width of a square tile in pixels.
+            nExp (int): Number of exponentials in the decay model.
+
+        Returns:
+            dict: offset, amplitude and tau maps (see fitDecay).
+        """
+        meanCounts = tiles.mean(axis=(1, 2))
         # Print first 5 values and times
         print(f"Mean Values: {meanCounts[:5]}")
         print(f"Times: {times[:5]}")
+
+        fit = fitDecay(times, tiles, nExp)
+        print(f"Median tau: {[float(np.median(tau)) for tau in fit['tau']]} s")
+        mapDir = os.path.join(self.rootPath, 'data', 'chargePersistence', 'maps')
+        os.makedirs(mapDir, exist_ok=True)
+        header = fits.Header([('TILESIZE', tileSize), ('NEXP', nExp), ('NFRAMES', len(times))])
+        fits.writeto(os.path.join(mapDir, f'{temp}C_persistence_tau.fits'), fit['tau'].astype(np.float32), header, overwrite=True)
+        fits.writeto(os.path.join(mapDir, f'{temp}C_persistence_amplitude.fits'), fit['amplitude'].astype(np.float32), header, overwrite=True)
+        fits.writeto(os.path.join(mapDir, f'{temp}C_persistence_offset.fits'), fit['offset'].astype(np.float32), header, overwrite=True)
+
         # Plot values
         self.plotPersistence(meanCounts, times)
+        return fit
     
     
     def plotPersistence(self, meanVals, times):
@@ -192,4 +284,79 @@ class CHARGEPERSISTENCE:
         plt.savefig(self.plotPath)
         plt.show()  # Display the plot (optional)
         return
-    
\ No newline at end of file
+    
+
+
+def frameTimes(dates):
+    """
+    Seconds since the first frame from DATE-OBS values. The camera writes them
+    with millisecond precision. Older files only have whole seconds, each time
+    is then up to 1s early, which biases the short decay constants without the
+    times ever repeating, so when no DATE-OBS has a fractional second the frames
+    are spread evenly between the first and last time (a constant cadence).
+
+    Args:
+        dates (list): ISO format DATE-OBS of every frame, in the order taken.
+
+    Returns:
+        np.ndarray: time of every frame in seconds.
+
+    Raises:
+        ValueError: if the times are not strictly increasing, for example frames
+        taken faster than the timestamp resolution.
+    """
+    parsed = [datetime.fromisoformat(date) for date in dates]
+    times = np.array([(date - parsed[0]).total_seconds() for date in parsed])
+    if len(times) > 1 and all(date.microsecond == 0 for date in parsed):
+        print("DATE-OBS only has whole seconds, assuming a constant cadence between the first and last frame")
+        times = np.linspace(0, times[-1], len(times))
+    if np.any(np.diff(times) <= 0):
+        repeated = int(np.count_nonzero(np.diff(times) <= 0))
+        raise ValueError(f"DATE-OBS is not strictly increasing ({repeated} frames share or go back in time)")
+    return times
+
+
+def fitDecay(times, signals, nExp=2, tauGrid=None):
+    """
+    Fit S(t) = offset + sum(amplitude_i * exp(-t / tau_i)) to many signals at once.
+    For a fixed set of tau the model is linear, so every combination of nExp
+    values from tauGrid is solved for all signals with one least squares call
+    and each signal keeps the combination with the smallest residual.
+
+    Args:
+        times (np.ndarray): (T,) time of every frame in seconds.
+        signals (np.ndarray): (T, ...) signals to fit, for example tile means.
+        nExp (int, optional): Number of exponentials. Defaults to 2.
+        tauGrid (np.ndarray, optional): Decay constants to try. Defaults to 40 log spaced
+        values between the frame spacing and the length of the sequence.
+
+    Returns:
+        dict: offset (...), amplitude (nExp, ...), tau (nExp, ...) sorted fastest first, rss (...).
+    """
+    times = np.asarray(times, dtype=np.float64)
+    shape = signals.shape[1:]
+    y = signals.reshape(len(times), -1).astype(np.float64)
+    if tauGrid is None:
+        span = max(times[-1] - times[0], 1)
+        step = max(np.min(np.diff(times)), span / len(times) / 10) if len(times) > 1 else 1
+        tauGrid = np.geomspace(step, span, 40)
+    t = times - times[0]
+
+    best = np.full(y.shape[1], np.inf)
+    coefficients = np.zeros((nExp + 1, y.shape[1]))
+    taus = np.zeros((nExp, y.shape[1]))
+    for combination in itertools.combinations(tauGrid, nExp):
+        design = np.column_stack([np.ones_like(t)] + [np.exp(-t / tau) for tau in combination])
+        solution, _, rank, _ = np.linalg.lstsq(design, y, rcond=None)
+        if rank < design.shape[1]:
+            continue
+        rss = ((y - design @ solution)**2).sum(axis=0)
+        better = rss < best
+        best[better] = rss[better]
+        coefficients[:, better] = solution[:, better]
+        taus[:, better] = np.array(combination)[:, None]
+
+    return {'offset': coefficients[0].reshape(shape),
+            'amplitude': coefficients[1:].reshape((nExp,) + shape),
+            'tau': taus.reshape((nExp,) + shape),
+            'rss': best.reshape(shape)}
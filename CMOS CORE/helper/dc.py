@@ -5,18 +5,29 @@ import os
 import sys
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
-from astropy.stats import sigma_clip
 from astropy.io import fits
 import time
+import re
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append("..")
 import loadImage
+import stackStats
+import combine
+import badPixelMask
+from headerIndex import headerIndex
+
 
 sys.path.append("../cam")
 from camera import DLAPICamera
 from gateway import DLAPIGateway
 from cam import camera, gateway
 
+
+# Boltzmann constant in eV/K
+BOLTZMANN_EV = 8.617333262e-5
+
 class DC: 
     def __init__(self, darkPath="", biasPath = '-5.0C_highGain', figureName='dark_current_plot_run3'):
         
@@ -40,37 +51,33 @@ class DC:
     def createMasterBias(self, temp, readout_mode='High Gain'):
         """
         Given a temperature of pre existing bias images create a master bias from them. 
-        Individual frames are sigma clipped and filled in with an average value before being stacked.
+        Frames are sigma clipped along the stack axis and median combined (see combine.sigmaClipCombine).
 
         Args:
             temp (int): Temperature of bias frames
             readout_mode (str): Readout mode of biases either "High Gain" or "Low Gain" 
+
+        Returns:
+            np.ndarray: master bias. 
+        """
+        # Create save and frame directories 
+        biasdir = os.path.join(self.rootPath, 'data', 'dc', 'bias', str(temp), readout_mode)
+        savedir = self.masterBiasPath(temp, readout_mode)
+        # Sigma clipped median of the stack, shared with RON
+        stackedMask = combine.createMasterBias(biasdir, savedir)
+        return stackedMask
+        
+
+    def masterBiasPath(self, temp, readout_mode='High Gain'):
+        """
+        Where the master bias for a temperature and readout mode is saved.
         """
         if readout_mode == 'High Gain':
             gain = 'high_gain'
         else: 
             gain = 'low_gain'
-        # Create save and frame directories 
-        biasdir = os.path.join(self.rootPath, 'data', 'dc', 'bias', str(temp), readout_mode)
-        savedir = os.path.join(self.rootPath, 'data', 'dc', 'master_bias', f"{temp}C_{gain}_master_bias.fits")
-        # Load the biases
-        fitsLoader = loadImage.fitsLoader(biasdir)
-        bias = fitsLoader.loadImages() 
-        # Apply clipping to each frame
-        clippedMask = [] 
-        for i in bias:
-            maskedFrame = sigma_clip(i, sigma=3, maxiters=None)
-            clippedMask.append(maskedFrame)
-        
-        # Stack the clipped biases
-        stackedMask = np.ma.stack(clippedMask, axis=0)
-        fillValue = np.ma.mean(stackedMask)
-        stackedMask = np.median(stackedMask, axis=0)
-        # Fill clipped values with the mean of other pixels (after stacking)
-        stackedMask = stackedMask.filled(fillValue)
-        stackedMask = stackedMask.astype(np.float32)
-        fits.writeto(savedir, stackedMask)
-        
+        return os.path.join(self.rootPath, 'data', 'dc', 'master_bias', f"{temp}C_{gain}_master_bias.fits")
+
 
     def takeBias(self, temp, number=20, readout_mode = 'High Gain'):
         """
@@ -157,29 +164,143 @@ class DC:
                 print(result.description)
                 return
             
-    def createTimeDict(self, temp, expTimes):
+    def createTimeDict(self, temp, expTimes, readout_mode="High Gain"):
         """
         Create a dict where the key is the exposure time and the value is the 3D stack of frames
 
         Args:
             temp (int): Temperature in Celcius 
             expTimes (list): List of exposure times
+            readout_mode (str, optional): Readout mode of sensor. Defaults to "High Gain".
 
         Returns:
             dict: Key is expTime value is total dark current. 
         """
         data = {}
         for time in expTimes: 
-            dataPath = os.path.join(self.rootPath, 'data', 'dc', 'dark', f'{temp}C', f'{time}s', "High Gain")
-            dataLoader = loadImage.fitsLoader(dataPath)
+            dataPath = os.path.join(self.rootPath, 'data', 'dc', 'dark', f'{temp}C', f'{time}s', readout_mode)
+            dataLoader = loadImage.fitsLoader(dataPath, lazy=True)
             ccdTemp = dataLoader.getHeaderInfo('CCD-TEMP')
             dataList = dataLoader.loadImages() 
-            dataList = np.stack(dataList, axis=0)
-            dataList = np.mean(dataList, axis=0) 
-            data[time] = dataList 
+            data[time] = stackStats.stackMean(dataList)
         return data, ccdTemp
 
     
+    def dcRateMap(self, temp, expTimes, readout_mode='High Gain', eGain=1.2, hotSigma=5):
+        """
+        Dark current of every pixel. Each bias subtracted dark frame is added as a
+        point to a per pixel straight line fit of dark signal (e-) vs exposure time,
+        which only keeps the running sums of t, t^2, y and ty, so memory does not
+        grow with the number of frames or exposure times. The slope is the dark
+        current (e-/s), the intercept the offset left after bias subtraction (e-) and
+        the residual rms how far the pixel is from a straight line (e-).
+        Maps are saved as fits to data/dc/maps along with a csv of hot pixels whose
+        dark current is more than hotSigma (MAD) standard deviations above the median.
+
+        Args:
+            temp (int): Temperature in Celcius.
+            expTimes (list): Exposure times of the darks in seconds.
+            readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+            eGain (float, optional): Gain of the sensor in e-/ADU. Defaults to 1.2.
+            hotSigma (float, optional): Hot pixel threshold. Defaults to 5.
+
+        Returns:
+            tuple: (dark current, intercept, residual rms) maps.
+        """
+        master = self.createMasterBias(temp, readout_mode)
+
+        fit = stackStats.pixelRegression()
+        for time in expTimes:
+            dataPath = os.path.join(self.rootPath, 'data', 'dc', 'dark', f'{temp}C', f'{time}s', readout_mode)
+            for frame in loadImage.fitsLoader(dataPath, lazy=True).loadImages():
+                fit.add(float(time), (frame - master) * eGain)
+        print(f"Fit {fit.count} dark frames at {len(expTimes)} exposure times")
+        dcMap, interceptMap, residualMap = fit.solve()
+
+        # Hot pixels from a robust estimate of the dark current spread
+        median = np.median(dcMap)
+        std = np.median(np.abs(dcMap - median)) * combine.MAD_TO_STD
+        hotY, hotX = np.nonzero(dcMap > median + hotSigma * std)
+        order = np.argsort(dcMap[hotY, hotX])[::-1]
+        hotY, hotX = hotY[order], hotX[order]
+        print(f"Median DC: {median:.4f} e-/s, {len(hotX)} hot pixels")
+        # Shared with the other analyses through the bad pixel mask
+        badPixelMask.updateMask(badPixelMask.HOT, dcMap > median + hotSigma * std, readout_mode)
+
+        mapDir = os.path.join(self.rootPath, 'data', 'dc', 'maps')
+        os.makedirs(mapDir, exist_ok=True)
+        name = f"{temp}C_{readout_mode.replace(' ', '')}"
+        for suffix, data, unit in (('dc', dcMap, 'e-/s'), ('intercept', interceptMap, 'e-'), ('residual', residualMap, 'e-')):
+            header = fits.Header([('BUNIT', unit), ('EGAIN', eGain), ('NFRAMES', fit.count)])
+            fits.writeto(os.path.join(mapDir, f"{name}_{suffix}.fits"), data.astype(np.float32), header, overwrite=True)
+        np.savetxt(os.path.join(mapDir, f"{name}_hot_pixels.csv"),
+                   np.column_stack([hotX, hotY, dcMap[hotY, hotX], interceptMap[hotY, hotX], residualMap[hotY, hotX]]),
+                   delimiter=',', fmt=['%d', '%d', '%.6g', '%.6g', '%.6g'],
+                   header='x,y,dc,intercept,residual', comments='')
+        return dcMap, interceptMap, residualMap
+
+
+    def arrheniusFit(self, temps, expTimes, readout_mode='High Gain', eGain=1.2, tileSize=None):
+        """
+        Activation energy of the dark current for every pixel (or tile). At each
+        temperature the dark current is the slope of the bias subtracted mean dark
+        frames from createTimeDict vs exposure time. Dark current then follows
+        D = A * exp(-Ea / kT) with T the CCD-TEMP header, so ln D vs 1/kT is a
+        straight line per pixel with slope -Ea, and all of them are solved at
+        once with the same streaming regression. Pixels/temperatures with no
+        positive dark current are left out of the fit.
+        Across pixels ln A and Ea follow the Meyer-Neldel rule ln A = ln A0 + Ea / E_MN
+        which gives a single Meyer-Neldel energy for the sensor.
+        Maps are saved as fits to data/dc/maps.
+
+        Args:
+            temps (list): Set point temperatures in Celcius, at least 2.
+            expTimes (list): Exposure times of the darks at every temperature.
+            readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+            eGain (float, optional): Gain of the sensor in e-/ADU. Defaults to 1.2.
+            tileSize (int, optional): Fit the mean dark current of tileSize x tileSize tiles
+            instead of single pixels. Defaults to None (per pixel).
+
+        Returns:
+            tuple: (activation energy map (eV), ln A map, Meyer-Neldel energy (eV)).
+        """
+        fit = stackStats.pixelRegression()
+        for temp in temps:
+            data, ccdTemp = self.createTimeDict(temp, expTimes, readout_mode)
+            master = self.createMasterBias(temp, readout_mode)
+            # Dark current (e-/s) of every pixel at this temperature
+            ramp = stackStats.pixelRegression()
+            for time, frame in data.items():
+                ramp.add(float(time), (frame - master) * eGain)
+            dcMap = ramp.solve()[0]
+            if tileSize:
+                dcMap = stackStats.tileView(dcMap, tileSize).mean(axis=(1, 3))
+
+            if ccdTemp is None:
+                ccdTemp = temp
+            valid = dcMap > 0
+            invKT = 1 / (BOLTZMANN_EV * (float(ccdTemp) + 273.15))
+            fit.add(invKT, np.log(np.where(valid, dcMap, 1)), valid)
+            print(f"{ccdTemp}C: median DC {np.median(dcMap):.4f} e-/s, {np.count_nonzero(~valid)} non positive")
+
+        slope, lnA, _ = fit.solve()
+        eaMap = -slope
+
+        # Meyer-Neldel rule across every pixel that was fit
+        good = np.isfinite(eaMap) & np.isfinite(lnA)
+        mnSlope = np.polyfit(eaMap[good], lnA[good], 1)[0]
+        meyerNeldel = 1 / mnSlope
+        print(f"Median Ea: {np.median(eaMap[good]):.3f} eV, Meyer-Neldel energy: {meyerNeldel:.4f} eV")
+
+        mapDir = os.path.join(self.rootPath, 'data', 'dc', 'maps')
+        os.makedirs(mapDir, exist_ok=True)
+        name = f"arrhenius_{readout_mode.replace(' ', '')}" + (f"_{tileSize}px" if tileSize else '')
+        header = fits.Header([('EMN', meyerNeldel, 'Meyer-Neldel energy (eV)'), ('NTEMPS', len(temps))])
+        fits.writeto(os.path.join(mapDir, f"{name}_ea.fits"), eaMap.astype(np.float32), header, overwrite=True)
+        fits.writeto(os.path.join(mapDir, f"{name}_lnA.fits"), lnA.astype(np.float32), header, overwrite=True)
+        return eaMap, lnA, meyerNeldel
+
+
     def subtractMaster(self, data, master):
         
         for key, frame in data.items():
@@ -193,94 +314,174 @@ class DC:
         return data
         
     
-    def clipFrames(self, data): 
-        
-        for key, frameList in data.items():
-            for i in range(len(frameList)):
-                frame = frameList[i]
-                maskedFrame = sigma_clip(frame, sigma=3, maxiters=None)
-                fillValue = np.ma.mean(maskedFrame)
-                maskedFrame.filled(fillValue)
-                frameList[i] = maskedFrame 
-                # print(f"after min: {np.min(maskedFrame)}")
-                # print(f"after max: {np.max(maskedFrame)}")
-                # print(f"after mean: {np.mean(maskedFrame)}")
+    def clipFrames(self, data, sigma=3, readout_mode='High Gain'): 
+        """
+        Replace hot pixels in every frame with the mean of the good pixels. If
+        there is a shared bad pixel mask for the readout mode its HOT, SATURATED
+        and DEAD pixels are used, otherwise the outliers are found once for the
+        whole stack from the median and MAD of the stack mean. The mask is kept
+        in self.badPixelMask, so later calls keep masking the same pixels.
+        Writable float frames are filled in place, read only (lazy) and integer
+        frames are replaced by a float32 copy.
+
+        Args:
+            data (dict): Key -> frame (or list of frames), like from createTimeDict.
+            sigma (float, optional): Clipping threshold in robust standard deviations. Defaults to 3.
+            readout_mode (str, optional): Readout mode of the shared bad pixel mask. Defaults to 'High Gain'.
+
+        Returns:
+            dict: data with hot pixels replaced.
+        """
+        def isFrame(value):
+            return isinstance(value, (np.ndarray, loadImage.lazyFrame))
+
+        frames = []
+        for value in data.values():
+            frames.extend([value] if isFrame(value) else value)
+        mask = hotPixels(stackStats.stackMean(frames), sigma, badPixelMask.maskPath(readout_mode))
+        if getattr(self, 'badPixelMask', None) is not None and self.badPixelMask.shape == mask.shape:
+            mask |= self.badPixelMask
+        self.badPixelMask = mask
+
+        def fill(frame):
+            # Writable float arrays are filled as they are, only read only (lazy)
+            # or integer frames are copied, to float32 which can hold the mean
+            if not (isinstance(frame, np.ndarray) and frame.flags.writeable and frame.dtype.kind == 'f'):
+                frame = np.array(frame[...], dtype=np.result_type(frame.dtype, np.float32))
+            frame[mask] = np.mean(frame[~mask])
+            return frame
+
+        for key, value in data.items():
+            if isFrame(value):
+                data[key] = fill(value)
+            elif isinstance(value, list):
+                value[:] = [fill(frame) for frame in value]
+            else:
+                data[key] = [fill(frame) for frame in value]
         return data
             
-    def fullFrameDC(self, expTimes = [1, 10, 60, 120, 240], temp1=None, temp2=None, temp3=None, temp4=None, temp5=None):
+    def darkGroups(self, temps=None, expTimes=None, readout_mode='High Gain'):
         """
-        Test to calculate the dark current vs time for the entire image. 
+        Find the (temperature, exposure time) groups of darks in data/dc/dark.
+        Directories are used for the grouping and the header index of each one
+        gives the exposure time and CCD temperature without reading any pixels.
+
+        Args:
+            temps (list, optional): Set point temperatures to use. Defaults to None (every temperature found).
+            expTimes (list, optional): Exposure times to use. Defaults to None (every exposure time found).
+            readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+
+        Returns:
+            list: dict per group with temp, tempName (temperature as written in the
+            directory name), expTime, ccdTemp, nFrames and dataPath.
         """
-        
-        if (temp1 or temp2 or temp3 or temp4 or temp5) is None:
-            print("Must give 5 temperatures")
-        
-        
-        data1, ccdTemp1 = self.createTimeDict(temp1, expTimes)
-        data2, ccdTemp2 = self.createTimeDict(temp2, expTimes)
-        data3, ccdTemp3 = self.createTimeDict(temp3, expTimes)
-        data4, ccdTemp4 = self.createTimeDict(temp4, expTimes)
-        data5, ccdTemp5 = self.createTimeDict(temp5, expTimes)
-            
-        # Load master 
-        masterPath = os.path.join(self.rootPath, 'data', 'dc', 'master_bias')
-        masterLoader = loadImage.fitsLoader(masterPath) 
-        master = masterLoader.loadByFilename('high_gain_', 'temp')
-        
-        print(master.keys())
-
-        # Get master frames
-        master1 = master[str(temp1)]
-        master2 = master[str(temp2)]
-        master3 = master[str(temp3)]
-        master4 = master[str(temp4)]
-        master5 = master[str(temp5)]
-        
-        # Sigma clip individual dark frames
-        # This is done because there are saturated "hot pixels"
-        data1 = self.clipFrames(data1)
-        data2 = self.clipFrames(data2)
-        data3 = self.clipFrames(data3)
-        data4 = self.clipFrames(data4)
-        data5 = self.clipFrames(data5)
-        
-        # Subtract master from individual frames
-        data1 = self.subtractMaster(data1, master1)
-        data2 = self.subtractMaster(data2, master2)
-        data2 = self.subtractMaster(data3, master3)
-        data2 = self.subtractMaster(data4, master4)
-        data2 = self.subtractMaster(data5, master5)
-        
-        print(f"{temp1}: {data1}")
-        print(f"{temp2}: {data2}")
-        print(f"{temp3}: {data3}")
-        print(f"{temp4}: {data4}")
-        print(f"{temp5}: {data5}")
-
-        self.graphDCvsTIME(data1, data2, data3, data4, data5,ccdTemp1, ccdTemp2, ccdTemp3, ccdTemp4, ccdTemp5)
-        return 
+        darkRoot = os.path.join(self.rootPath, 'data', 'dc', 'dark')
+        groups = []
+        for temp, tempName in matchDirs(darkRoot, r'-?[\d.]+C', temps):
+            tempDir = os.path.join(darkRoot, tempName)
+            if not os.path.isdir(tempDir):
+                print(f"No darks for {temp}C in {darkRoot}")
+                continue
+            for time, timeName in matchDirs(tempDir, r'[\d.]+s', expTimes):
+                dataPath = os.path.join(tempDir, timeName, readout_mode)
+                if not os.path.isdir(dataPath):
+                    continue
+                index = headerIndex(dataPath)
+                if not index.files():
+                    continue
+                ccdTemps = [index.get(f, 'CCD-TEMP') for f in index.files()]
+                ccdTemps = [t for t in ccdTemps if t is not None]
+                exptime = index.get(index.files()[0], 'EXPTIME')
+                groups.append({'temp': temp,
+                               'tempName': tempName[:-1],
+                               'expTime': float(exptime) if exptime is not None else time,
+                               'ccdTemp': float(np.mean(ccdTemps)) if ccdTemps else np.nan,
+                               'nFrames': len(index.files()),
+                               'dataPath': dataPath})
+        return groups
+
+
+    def fullFrameDC(self, temps=None, expTimes=None, readout_mode='High Gain', eGain=1.2, workers=None):
+        """
+        Dark current vs time for the entire image at any number of temperatures.
+        Every (temperature, exposure time) group found by darkGroups is reduced to
+        a bias subtracted mean dark signal with hot pixels masked, in parallel worker processes
+        when workers > 1. Dark current is the slope of a linear fit of signal vs time
+        for each temperature.
+
+        Args:
+            temps (list, optional): Set point temperatures. Defaults to None (every temperature in data/dc/dark).
+            expTimes (list, optional): Exposure times. Defaults to None (every exposure time found).
+            readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+            eGain (float, optional): Gain of the sensor in e-/ADU. Defaults to 1.2.
+            workers (int, optional): Number of worker processes. Defaults to None (serial).
+
+        Returns:
+            pd.DataFrame: one row per temperature with temp, ccdTemp, dc (e-/s) and intercept (e-).
+            The per group signals are kept in self.dcGroups.
+        """
+        groups = self.darkGroups(temps, expTimes, readout_mode)
+        if not groups:
+            print("No dark frames found")
+            return
+
+        # Master biases are made (or taken from the calibration cache) before any work is sent out.
+        # Without raw biases an existing master in data/dc/master_bias is used as is.
+        masterPaths = {}
+        for tempName in sorted(set(group['tempName'] for group in groups)):
+            biasDir = os.path.join(self.rootPath, 'data', 'dc', 'bias', tempName, readout_mode)
+            masterPath = self.masterBiasPath(tempName, readout_mode)
+            if os.path.isdir(biasDir):
+                self.createMasterBias(tempName, readout_mode)
+            elif not os.path.isfile(masterPath):
+                print(f"No bias frames or master bias for {tempName}C, skipping")
+                continue
+            masterPaths[tempName] = masterPath
+        groups = [group for group in groups if group['tempName'] in masterPaths]
+        if not groups:
+            print("No master biases for the dark frames found")
+            return
+
+        if workers and workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                signals = list(pool.map(groupDarkSignal, [group['dataPath'] for group in groups],
+                                        [masterPaths[group['tempName']] for group in groups],
+                                        [eGain] * len(groups),
+                                        [badPixelMask.maskPath(readout_mode)] * len(groups)))
+        else:
+            signals = [groupDarkSignal(group['dataPath'], masterPaths[group['tempName']], eGain,
+                                       badPixelMask.maskPath(readout_mode)) for group in groups]
+
+        table = pd.DataFrame(groups).drop(columns=['dataPath', 'tempName'])
+        table['signal'] = signals
+        table = table.sort_values(['temp', 'expTime']).reset_index(drop=True)
+        self.dcGroups = table
+
+        rows = []
+        for temp, group in table.groupby('temp', sort=True):
+            if len(group) < 2:
+                print(f"Need at least 2 exposure times for {temp}C")
+                continue
+            slope, intercept = np.polyfit(group['expTime'], group['signal'], 1)
+            rows.append({'temp': temp, 'ccdTemp': group['ccdTemp'].mean(), 'dc': slope, 'intercept': intercept})
+        result = pd.DataFrame(rows)
+        print(result.to_string(index=False))
+
+        self.graphDCvsTIME(table)
+        return result
    
 
-    def graphDCvsTIME(self, dict1, dict2, dict3, dict4, dict5,
-                      temp1, temp2, temp3, temp4, temp5):
+    def graphDCvsTIME(self, table):
         """
-        Plot Dark Current Count vs Time
+        Plot Dark Current Count vs Time, one line per temperature
         Also display Dark Current (slope of linear fit)
+
+        Args:
+            table (pd.DataFrame): temp, ccdTemp, expTime and signal of every group (see fullFrameDC).
         """
-        times = list(dict1.keys())
-        values1 = list(dict1.values())
-        values2 = list(dict2.values())
-        values3 = list(dict3.values())
-        values4 = list(dict4.values())
-        values5 = list(dict5.values())
-
-        # Plot the lines
-        
-        self.plot_line_with_slope(times, values1, label=f"{temp1}C")
-        self.plot_line_with_slope(times, values2, label=f"{temp2}C")
-        self.plot_line_with_slope(times, values3, label=f"{temp3}C")
-        self.plot_line_with_slope(times, values4, label=f"{temp4}C")
-        self.plot_line_with_slope(times, values5, label=f"{temp5}C")
+        for temp, group in table.groupby('temp', sort=True):
+            self.plot_line_with_slope(list(group['expTime']), list(group['signal']),
+                                      label=f"{group['ccdTemp'].mean():.1f}C")
 
         # Customize the plot
         plt.xlabel('Time')
@@ -294,11 +495,80 @@ class DC:
         plt.show()
 
     def plot_line_with_slope(self, times, values, label):
-        # Calculate the rise-over-run (slope)
-        rise = values[-1] - values[0]
-        run = times[-1] - times[0]
-        slope = rise / run
-        
+        # Slope of a least squares fit through every point
+        slope = np.polyfit(times, values, 1)[0] if len(times) > 1 else np.nan
 
         # Plot the line
         plt.plot(times, values, label=f'{label} (DC: {slope:.4f})')
+
+
+def matchDirs(parent, pattern, values=None):
+    """
+    Directories named like a number plus a unit (for example -5C or 1.0s).
+    The matched names are kept as they are so paths are never rebuilt from
+    the number ("-5.0C" stays "-5.0C").
+
+    Args:
+        parent (str): Directory to look in.
+        pattern (str): Regular expression the whole name has to match, the last character is the unit.
+        values (list, optional): Only these values, compared as numbers. Names that are
+        not found are returned as f"{value}{unit}". Defaults to None (every match).
+
+    Returns:
+        list: (value as float, directory name) sorted by value.
+    """
+    unit = pattern[-1]
+    found = {}
+    if os.path.isdir(parent):
+        for name in os.listdir(parent):
+            if re.fullmatch(pattern, name):
+                try:
+                    found[float(name[:-1])] = name
+                except ValueError:
+                    continue
+    if values is None:
+        return sorted(found.items())
+    return sorted((float(value), found.get(float(value), f"{value}{unit}")) for value in values)
+
+
+def hotPixels(meanFrame, sigma=3, maskPath=None):
+    """
+    Pixels to leave out of dark signal means. The HOT, SATURATED and DEAD pixels
+    of the bad pixel mask at maskPath when there is one for this frame size,
+    otherwise the outliers of meanFrame found once from its median and MAD.
+
+    Args:
+        meanFrame (np.ndarray): Mean of a stack of darks.
+        sigma (float, optional): Clipping threshold in robust standard deviations. Defaults to 3.
+        maskPath (str, optional): Path to a saved bad pixel mask. Defaults to None.
+
+    Returns:
+        np.ndarray: boolean frame, True for pixels to leave out.
+    """
+    shared = badPixelMask.badPixelMask.load(maskPath) if maskPath else None
+    if shared is not None and shared.shape == np.shape(meanFrame):
+        return shared.get(badPixelMask.HOT | badPixelMask.SATURATED | badPixelMask.DEAD)
+    return stackStats.madOutliers(meanFrame, sigma)
+
+
+def groupDarkSignal(dataPath, masterPath, eGain, maskPath=None, sigma=3):
+    """
+    Worker for fullFrameDC. Mean dark signal (e-) of a directory of darks: the
+    frames are averaged, the master bias subtracted and hot pixels (see hotPixels)
+    left out before taking the mean of the frame.
+
+    Args:
+        dataPath (str): Directory of dark frames with the same temperature and exposure time.
+        masterPath (str): Path to the master bias fits file.
+        eGain (float): Gain of the sensor in e-/ADU.
+        maskPath (str, optional): Path to a saved bad pixel mask. Defaults to None.
+        sigma (float, optional): Clipping threshold when there is no saved mask. Defaults to 3.
+
+    Returns:
+        float: mean dark signal in electrons.
+    """
+    master = fits.getdata(masterPath)
+    frames = loadImage.fitsLoader(dataPath, lazy=True).loadImages()
+    subFrame = stackStats.stackMean(frames) - master
+    mask = hotPixels(subFrame, sigma, maskPath)
+    return float(np.mean(subFrame[~mask])) * eGain
@@ -2,10 +2,13 @@ import matplotlib.pyplot as plt
 import numpy as np 
 import os 
 import math 
+from astropy.io import fits
 
 import sys
 sys.path.append("..")
 import loadImage
+import stackStats
+import calibCache
 
 sys.path.append("../cam")
 from camera import DLAPICamera
@@ -29,11 +32,12 @@ class GAIN:
         # self.fitsLoaderDark.loadImages() 
         # Lists to store data
         # Output path for figures
+        self.figureName = figureName
         self.outputDir = os.path.join(os.path.dirname(__file__), '..', 'plots', 'gain_plots')
         self.plotPath = os.path.join(self.outputDir, f'{figureName}_PTC.png')
 
 
-    def takeFlats(self, temp, expTime, number = 1, readout_mode = "High Gain"): 
+    def takeFlats(self, temp, expTime, number = 1, readout_mode = "High Gain", level = None): 
         # """
         # Take a flat. Manually adjust illumination levels of setup and re run this method. 
 
@@ -42,6 +46,8 @@ class GAIN:
         #     expTime (int): Exposure time in seconds. 
         #     number (int, optional): number of frames to take. Defaults to 1.
         #     readout_mode (str, optional): Readout mode of sensor. Defaults to "High Gain".
+        #     level (int, optional): Illumination level, frames are saved to a level_{level}
+        #     sub directory for calcPixelPTC. Defaults to None.
         # """
                 # Create new directory for given temperature
         savedir = os.path.join(self.rootPath, 'data', 'gain', 'flat', f"{str(temp)}C", f"{str(expTime)}s")
@@ -64,6 +70,10 @@ class GAIN:
         else:
             print(f"Incorrect readout mode: {readout_mode}")
             return        
+        # Each illumination level gets its own directory for the per pixel PTC
+        if level is not None:
+            savedir = os.path.join(savedir, f"level_{level}")
+            os.makedirs(savedir, exist_ok=True)
         # Create camera objectsss
         gateway = DLAPIGateway() 
         print(f"Images saved to: {savedir}")
@@ -142,7 +152,7 @@ class GAIN:
         """
         # Load darks
         darkPath = os.path.join(self.rootPath, 'data', 'gain', 'dark', f"{str(temp)}C", f"{str(expTime)}s", readout_mode)        
-        darkLoader = loadImage.fitsLoader(darkPath)
+        darkLoader = loadImage.fitsLoader(darkPath, lazy=True)
         darks = darkLoader.loadImages()
         
         #Calculate Midpoint 
@@ -150,12 +160,12 @@ class GAIN:
         
         # Load Flats
         flatPath = os.path.join(self.rootPath, 'data', 'gain', 'flat', f"{str(temp)}C", f"{str(expTime)}s", readout_mode)
-        flatLoader = loadImage.fitsLoader(flatPath)
+        flatLoader = loadImage.fitsLoader(flatPath, lazy=True)
         flats = flatLoader.loadImages() 
         
-        # Create master dark 
-        masterDark = np.stack(darks, axis=0)
-        masterDark = np.mean(masterDark, axis=0)
+        # Create master dark (reused from the calibration cache if the darks are unchanged)
+        masterDark = calibCache.getCache().master(darks.filePaths, 'dark',
+                                                  lambda: stackStats.stackMean(darks), method='mean')
         
         meanVals = []
         varVals = []
@@ -202,51 +212,190 @@ class GAIN:
         plt.show()
 
 
-    def spacialVariation(self): 
+    def calcPixelPTC(self, temp=-5, expTime=0.07, readout_mode='High Gain'):
         """
-        AHHH WHAT DOES THIS DO ITS IN MY BRAIN
+        Photon transfer curve for every pixel. Flats are taken with takeFlats(level=n)
+        so each illumination level has its own level_n directory holding K flats.
+        The temporal mean and variance of every pixel is streamed over the K flats
+        of a level and added as one weighted point to a per pixel straight line fit, so only
+        a few full frames are ever in memory no matter how many flats there are.
+        Gain (1/slope, e-/ADU) and read noise (sqrt of intercept, ADU) maps are
+        saved as fits to data/gain/maps.
+
+        Args:
+            temp (int, optional): Temperature of the data. Defaults to -5.
+            expTime (float, optional): Exposure time of the flats/darks. Defaults to 0.07.
+            readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+
+        Returns:
+            tuple: (gain map, read noise map). Pixels without a positive slope are NaN.
         """
-        #Create Master Dark 
-        masterDark = np.stack(self.fitsLoaderDark.images, axis=0)
-        masterDark = np.mean(masterDark, axis=0)
+        # Load darks
+        darkPath = os.path.join(self.rootPath, 'data', 'gain', 'dark', f"{str(temp)}C", f"{str(expTime)}s", readout_mode)        
+        darks = loadImage.fitsLoader(darkPath, lazy=True).loadImages()
+        masterDark = calibCache.getCache().master(darks.filePaths, 'dark',
+                                                  lambda: stackStats.stackMean(darks), method='mean')
 
-        ### ADD THE LOOP HERE 48 box size
-        gainVals = []
+        flatPath = os.path.join(self.rootPath, 'data', 'gain', 'flat', f"{str(temp)}C", f"{str(expTime)}s", readout_mode)
+        levels = sorted(level for level in os.listdir(flatPath) if level.startswith('level_'))
+        if len(levels) < 2:
+            print(f"Need at least 2 illumination levels in {flatPath}, found {len(levels)}")
+            return
+
+        fit = stackStats.pixelRegression()
+        for level in levels:
+            flats = loadImage.fitsLoader(os.path.join(flatPath, level), lazy=True).loadImages()
+            stats = stackStats.pixelStats().addFrames(flats)
+            # Dark subtraction only moves the mean, the temporal variance is unchanged
+            variance = stats.variance(ddof=1)
+            # A sample variance has variance 2*var^2/(K-1), weight each level by the inverse
+            # of that. The level median is used so a pixel's own noise does not bias its weight
+            weight = (stats.count - 1) / (2 * np.median(variance)**2)
+            fit.add(stats.mean - masterDark, variance, weight)
+            print(f"{level}: {stats.count} flats, mean signal {np.mean(stats.mean - masterDark):.1f} ADU")
 
-        for x in range(0, 3216, 48):
-            for y in range(0, 2208, 48):
-                
-                meanNums = []
-                varNums = [] 
+        slope, intercept, _ = fit.solve()
+        slope[~(slope > 0)] = np.nan
+        gainMap = 1 / slope
+        ronMap = np.sqrt(np.abs(intercept))
+        print(f"Median gain: {np.nanmedian(gainMap):.2f} median RON: {np.nanmedian(ronMap):.2f}")
 
-                for frame in self.fitsLoaderFlat.images:
-                    subFrame = frame - masterDark     
-                    # get region of interest within frame
-                    ROI = subFrame[x:x+48, y:y+48]
-                    mean = np.mean(ROI)
-                    variance = np.var(ROI)
+        mapDir = os.path.join(self.rootPath, 'data', 'gain', 'maps')
+        os.makedirs(mapDir, exist_ok=True)
+        name = f"{str(temp)}C_{str(expTime)}s_{readout_mode.replace(' ', '')}"
+        fits.writeto(os.path.join(mapDir, f"{name}_gain.fits"), gainMap.astype(np.float32),
+                     fits.Header([('BUNIT', 'e-/ADU'), ('NLEVELS', len(levels))]), overwrite=True)
+        fits.writeto(os.path.join(mapDir, f"{name}_ron.fits"), ronMap.astype(np.float32),
+                     fits.Header([('BUNIT', 'ADU'), ('NLEVELS', len(levels))]), overwrite=True)
+        return gainMap, ronMap
 
-                    meanNums.append(mean) 
-                    varNums.append(variance)
 
-                gain, intercept = np.polyfit(meanNums, varNums, 1)
+    def calcPairPTC(self, temp=-5, expTime=0.07, readout_mode='High Gain', tileSize=None):
+        """
+        Pair difference photon transfer curve. Flats at the same illumination level
+        (the level_n directories from takeFlats) are paired up and the variance is
+        taken from var(A - B) / 2, which cancels fixed pattern noise that would
+        otherwise inflate the variance of a single frame. Pairs are streamed from
+        disk and only the ROI (or the whole frame for tiles) of each pair is read.
+
+        Args:
+            temp (int, optional): Temperature of the data. Defaults to -5.
+            expTime (float, optional): Exposure time of the flats/darks. Defaults to 0.07.
+            readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+            tileSize (int, optional): Fit a PTC to every tileSize x tileSize tile instead
+            of the central ROI. Defaults to None (central ROI, plotted like calcPTC).
 
-                gainValues.append(gain) 
+        Returns:
+            np.ndarray: (tilesY, tilesX) gain map when tileSize is given, also saved
+            as fits to data/gain/maps.
+        """
+        # Load darks
+        darkPath = os.path.join(self.rootPath, 'data', 'gain', 'dark', f"{str(temp)}C", f"{str(expTime)}s", readout_mode)        
+        darkLoader = loadImage.fitsLoader(darkPath, lazy=True)
+        darks = darkLoader.loadImages()
+        masterDark = calibCache.getCache().master(darks.filePaths, 'dark',
+                                                  lambda: stackStats.stackMean(darks), method='mean')
 
+        if tileSize is None:
+            self.midROI(darkLoader)
+            region = (slice(self.startY, self.endY), slice(self.startX, self.endX))
+        else:
+            region = (slice(None), slice(None))
+        dark = masterDark[region]
 
-        original = np.zeros((3216, 2208))
+        flatPath = os.path.join(self.rootPath, 'data', 'gain', 'flat', f"{str(temp)}C", f"{str(expTime)}s", readout_mode)
+        levels = sorted(level for level in os.listdir(flatPath) if level.startswith('level_'))
 
-        # Reshape frame with 48x48 binning
-        gainValues = np.array(gainValues).reshape(3216 // 48, 2208 // 48)
+        meanVals = []
+        varVals = []
+        for level in levels:
+            flats = loadImage.fitsLoader(os.path.join(flatPath, level), lazy=True).loadImages()
+            if len(flats) < 2:
+                print(f"Skipping {level}, need at least 2 flats for a pair")
+                continue
+            pairMeans = []
+            pairVars = []
+            for frameA, frameB in zip(flats[0::2], flats[1::2]):
+                a = np.asarray(frameA[region], dtype=np.float64)
+                b = np.asarray(frameB[region], dtype=np.float64)
+                signal = (a + b) / 2 - dark
+                a -= b
+                if tileSize is None:
+                    pairMeans.append(np.mean(signal))
+                    pairVars.append(np.var(a) / 2)
+                else:
+                    pairMeans.append(stackStats.tileMeanVar(signal, tileSize)[0])
+                    pairVars.append(stackStats.tileMeanVar(a, tileSize)[1] / 2)
+            meanVals.append(np.mean(pairMeans, axis=0))
+            varVals.append(np.mean(pairVars, axis=0))
 
-        for i in range(67):
-            for j in range(46):
-                original[i*48:(i+1)*48, j*48:(j+1)*48] = gainValues[i,j]
-        
-        plt.imshow(original, cmap='viridis', origin='lower', aspect='auto')
+        if len(meanVals) < 2:
+            print(f"Need at least 2 illumination levels with pairs in {flatPath}")
+            return
+        if tileSize is None:
+            self.plotPTC(meanVals, varVals)
+            return
+        slope, intercept = stackStats.linearFit(np.array(meanVals), np.array(varVals))
+        slope[~(slope > 0)] = np.nan
+        gainMap = 1 / slope
+        print(f"Median pair gain: {np.nanmedian(gainMap):.2f}")
+
+        mapDir = os.path.join(self.rootPath, 'data', 'gain', 'maps')
+        os.makedirs(mapDir, exist_ok=True)
+        name = f"{str(temp)}C_{str(expTime)}s_{readout_mode.replace(' ', '')}_{tileSize}px"
+        fits.writeto(os.path.join(mapDir, f"{name}_pair_gain.fits"), gainMap.astype(np.float32),
+                     fits.Header([('BUNIT', 'e-/ADU'), ('NLEVELS', len(meanVals)), ('TILESIZE', tileSize)]), overwrite=True)
+        return gainMap
+
+
+    def spacialVariation(self, temp=-5, expTime=0.07, readout_mode='High Gain', tileSize=48): 
+        """
+        Gain map. A photon transfer curve is fit to every tileSize x tileSize
+        tile of the frame using the same flats and darks as calcPTC. Each dark
+        subtracted flat is split into tiles once and the mean/variance of every
+        tile found in one go, then all the PTC lines are solved together.
+        Works for any frame shape, edge pixels that do not fill a tile are dropped.
+
+        Args:
+            temp (int, optional): Temperature of the data. Defaults to -5.
+            expTime (float, optional): Exposure time of the flats/darks. Defaults to 0.07.
+            readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+            tileSize (int, optional): Width of a square tile in pixels. Defaults to 48.
+
+        Returns:
+            np.ndarray: (tilesY, tilesX) gain map in e-/ADU.
+        """
+        # Load darks and flats
+        darkPath = os.path.join(self.rootPath, 'data', 'gain', 'dark', f"{str(temp)}C", f"{str(expTime)}s", readout_mode)        
+        darks = loadImage.fitsLoader(darkPath, lazy=True).loadImages()
+        flatPath = os.path.join(self.rootPath, 'data', 'gain', 'flat', f"{str(temp)}C", f"{str(expTime)}s", readout_mode)
+        flats = loadImage.fitsLoader(flatPath, lazy=True).loadImages()
+
+        #Create Master Dark 
+        masterDark = calibCache.getCache().master(darks.filePaths, 'dark',
+                                                  lambda: stackStats.stackMean(darks), method='mean')
+
+        # Mean and variance of every tile for every flat: (flats, tilesY, tilesX)
+        meanVals = []
+        varVals = []
+        for frame in flats:
+            mean, variance = stackStats.tileMeanVar(frame - masterDark, tileSize)
+            meanVals.append(mean)
+            varVals.append(variance)
+
+        # Fit every tile's PTC at once, gain is 1/slope like in plotPTC
+        slope, intercept = stackStats.linearFit(np.array(meanVals), np.array(varVals))
+        gainValues = 1 / slope
+
+        print(f"Gain min: {np.min(gainValues):.2f} max: {np.max(gainValues):.2f} mean: {np.mean(gainValues):.2f}")
+        plt.figure()
+        plt.imshow(gainValues, cmap='viridis', origin='lower', aspect='auto', interpolation='nearest',
+                   extent=(0, gainValues.shape[1] * tileSize, 0, gainValues.shape[0] * tileSize))
         plt.colorbar(label='Gain Value')
         plt.title("Gain Values Heatmap")
+        plt.savefig(os.path.join(self.outputDir, f'{self.figureName}_gain_heatmap.png'))
         plt.show() 
+        return gainValues
 
     def printKeyandVals(self, imageList):
         """
@@ -2,10 +2,12 @@ import matplotlib.pyplot as plt
 import numpy as np 
 import os 
 import math 
+from astropy.io import fits
 
 import sys
 sys.path.append("..")
 import loadImage
+import stackStats
 
 sys.path.append("../cam")
 from camera import DLAPICamera
@@ -116,7 +118,7 @@ class LINEARITY:
         self.plotCurve(expTimeVals, meanVals) 
         
 
-    def plotCurve(self, expTimeVals, meanVals):
+    def plotCurve(self, expTimeVals, meanVals, cutoff=None):
         """
         Plot linearity curve and save figure to:
         plots/linearity
@@ -124,9 +126,17 @@ class LINEARITY:
         Args:
             expTimeVals (list): list of exposure time values. 
             meanVals (list): List of mean values of frames.
+            cutoff (float, optional): Highest mean ADU used in the linear fit.
+            Defaults to None (the saturation knee found by findKnee).
         """
-        # Filter data to exclude values over 4000 from the linear fit
-        filtered_data = [(t, m) for t, m in zip(expTimeVals, meanVals) if m <= 4050]
+        expTimeVals = np.asarray(expTimeVals, dtype=np.float64)
+        meanVals = np.asarray(meanVals, dtype=np.float64)
+        if cutoff is None:
+            knee, _, _ = findKnee(expTimeVals, meanVals)
+            cutoff = float(knee)
+            print(f"Saturation knee: {cutoff:.1f} ADU")
+        # Filter data to exclude values over the cutoff from the linear fit
+        filtered_data = [(t, m) for t, m in zip(expTimeVals, meanVals) if m <= cutoff]
         x_data_fit, y_data_fit = zip(*filtered_data)
         # Convert lists to numpy arrays for linear regression
         x_data_fit = np.array(x_data_fit)
@@ -148,3 +158,159 @@ class LINEARITY:
         # Show and save the plot
         plt.savefig(self.plotPath)
         plt.show()
+
+
+    def calcTileCurves(self, temp=-5, readout_mode='High Gain', tileSize=64):
+        """
+        Response curve of every tileSize x tileSize tile (tileSize=1 for single pixels).
+        Frames are grouped by EXPTIME through the header index and streamed from disk
+        one at a time, each reduced straight to its tile means.
+
+        Args:
+            temp (int, optional): Temperature of sensor (for loading data). Defaults to -5.
+            readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+            tileSize (int, optional): Width of a square tile in pixels. Defaults to 64.
+
+        Returns:
+            tuple: (exposure times (N,), mean ADU of every tile (N, tilesY, tilesX)).
+        """
+        flatPath = os.path.join(self.rootPath, 'data', 'linearity', 'flat', f"{str(temp)}C", readout_mode)
+        flatLoader = loadImage.fitsLoader(flatPath, lazy=True)
+        expTimeVals = []
+        curves = []
+        for t, filenames in flatLoader.index.groupBy('EXPTIME').items():
+            if t is None:
+                continue
+            total = 0
+            for filename in filenames:
+                frame = loadImage.lazyFrame(os.path.join(flatPath, filename))
+                total = total + stackStats.tileView(frame[...], tileSize).mean(axis=(1, 3))
+            expTimeVals.append(float(t))
+            curves.append(total / len(filenames))
+        return np.array(expTimeVals), np.array(curves)
+
+
+    def buildLUT(self, temp=-5, readout_mode='High Gain', tileSize=64, lutSize=256, maxADU=65535):
+        """
+        Non linearity correction look up table for every tile. The linear response
+        of each tile is fit below its saturation knee (findKnee) and the table holds,
+        at lutSize evenly spaced measured ADU values, the int16 correction that takes
+        a measured value to the linear response. Values above a tile's knee get the
+        correction at the knee. Saved to data/linearity/lut and applied with applyLUT.
+
+        Args:
+            temp (int, optional): Temperature of sensor (for loading data). Defaults to -5.
+            readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+            tileSize (int, optional): Width of a square tile in pixels. Defaults to 64.
+            lutSize (int, optional): Number of table entries per tile. Defaults to 256.
+            maxADU (int, optional): Largest ADU covered by the table. Defaults to 65535.
+
+        Returns:
+            tuple: (lut (lutSize, tilesY, tilesX) int16, node spacing in ADU, knee map).
+        """
+        expTimeVals, curves = self.calcTileCurves(temp, readout_mode, tileSize)
+        order = np.argsort(expTimeVals)
+        expTimeVals, curves = expTimeVals[order], curves[order]
+        knee, slope, intercept = findKnee(expTimeVals, curves)
+        print(f"Median knee: {np.median(knee):.1f} ADU, median slope: {np.median(slope):.2f} ADU/s")
+
+        nodeStep = maxADU / (lutSize - 1)
+        nodes = np.arange(lutSize) * nodeStep
+        # Exposure time each node would be reached at, interpolated along each tile's measured
+        # curve below its knee, gives the linear (corrected) value for that node
+        below = curves <= knee
+        measured = np.where(below, curves, np.inf)
+        lastGood = below.sum(axis=0) - 1
+        lut = np.zeros((lutSize,) + knee.shape, dtype=np.int16)
+        for i, node in enumerate(nodes):
+            level = np.minimum(node, knee)
+            upper = np.clip((measured <= level).sum(axis=0), 1, np.maximum(lastGood, 1))
+            lower = upper - 1
+            y0 = np.take_along_axis(curves, lower[None], 0)[0]
+            y1 = np.take_along_axis(curves, upper[None], 0)[0]
+            t0 = expTimeVals[lower]
+            t1 = expTimeVals[upper]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = np.where(y1 != y0, t0 + (level - y0) * (t1 - t0) / (y1 - y0), t0)
+            correction = slope * t + intercept - level
+            lut[i] = np.clip(np.round(correction), -32768, 32767)
+
+        lutDir = os.path.join(self.rootPath, 'data', 'linearity', 'lut')
+        os.makedirs(lutDir, exist_ok=True)
+        header = fits.Header([('TILESIZE', tileSize), ('NODESTEP', nodeStep), ('LUTSIZE', lutSize)])
+        fits.HDUList([fits.PrimaryHDU(lut, header), fits.ImageHDU(knee.astype(np.float32), name='KNEE')]).writeto(
+            os.path.join(lutDir, f"{temp}C_{readout_mode.replace(' ', '')}_lut.fits"), overwrite=True)
+        return lut, nodeStep, knee
+
+
+def findKnee(expTimeVals, curves, fitFraction=0.3, slopeFraction=0.5):
+    """
+    Saturation knee of many response curves at once. A line is fit to the points
+    of each curve below fitFraction of its maximum, then the knee is the last point
+    before the slope between consecutive exposures drops under slopeFraction of
+    the fitted slope (or the last point if it never does).
+
+    Args:
+        expTimeVals (np.ndarray): (N,) exposure times in increasing order.
+        curves (np.ndarray): (N, ...) mean ADU at every exposure time.
+        fitFraction (float, optional): Part of the curve used for the linear fit. Defaults to 0.3.
+        slopeFraction (float, optional): Slope drop that marks the knee. Defaults to 0.5.
+
+    Returns:
+        tuple: (knee ADU, slope, intercept) each with the shape of curves[0].
+    """
+    expTimeVals = np.asarray(expTimeVals, dtype=np.float64)
+    curves = np.asarray(curves, dtype=np.float64)
+    fit = stackStats.pixelRegression()
+    peak = curves.max(axis=0)
+    for t, curve in zip(expTimeVals, curves):
+        fit.add(t, curve, curve <= fitFraction * peak)
+    slope, intercept, _ = fit.solve()
+
+    local = np.diff(curves, axis=0) / np.diff(expTimeVals).reshape((-1,) + (1,) * (curves.ndim - 1))
+    flattened = local < slopeFraction * slope
+    # Index of the first flat step, the knee is the point it starts from
+    kneeIndex = np.where(flattened.any(axis=0), flattened.argmax(axis=0), len(expTimeVals) - 1)
+    knee = np.take_along_axis(curves, np.asarray(kneeIndex)[None], 0)[0]
+    return knee, slope, intercept
+
+
+def applyLUT(frame, lut, nodeStep, tileSize):
+    """
+    Correct a frame for non linearity with a table from LINEARITY.buildLUT. Every
+    pixel is linearly interpolated between the two table entries around its value
+    for its tile. Pixels past the last whole tile use the edge tile.
+
+    Args:
+        frame (np.ndarray): 2D frame in ADU.
+        lut (np.ndarray): (lutSize, tilesY, tilesX) int16 corrections.
+        nodeStep (float): ADU between table entries.
+        tileSize (int): Tile width the table was made with.
+
+    Returns:
+        np.ndarray: corrected float32 frame.
+    """
+    frame = np.asarray(frame, dtype=np.float32)
+    lutSize, tilesY, tilesX = lut.shape
+    position = np.clip(frame / np.float32(nodeStep), 0, lutSize - 1)
+    lower = np.minimum(position.astype(np.intp), lutSize - 2)
+    weight = position - lower
+    tileY = np.minimum(np.arange(frame.shape[0]) // tileSize, tilesY - 1)[:, None]
+    tileX = np.minimum(np.arange(frame.shape[1]) // tileSize, tilesX - 1)[None, :]
+    flat = lut.reshape(lutSize, -1)
+    tile = tileY * tilesX + tileX
+    low = flat[lower, tile]
+    high = flat[lower + 1, tile]
+    return frame + low + weight * (high - low)
+
+
+def loadLUT(path):
+    """
+    Load a table saved by LINEARITY.buildLUT.
+
+    Returns:
+        tuple: (lut, node spacing in ADU, tile size, knee map).
+    """
+    with fits.open(path) as hdul:
+        header = hdul[0].header
+        return hdul[0].data, header['NODESTEP'], header['TILESIZE'], hdul['KNEE'].data
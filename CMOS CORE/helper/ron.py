@@ -2,12 +2,14 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 import sys
-from astropy.stats import sigma_clip
 from astropy.io import fits
 from scipy.ndimage import uniform_filter
 
 sys.path.append("..")
 import loadImage
+import stackStats
+import combine
+import badPixelMask
 
 sys.path.append("../cam")
 from camera import DLAPICamera
@@ -44,7 +46,7 @@ class RON:
     def createMasterBias(self, temp, readout_mode='High Gain'):
         """
         Given a temperature of pre existing bias images create a master bias from them. 
-        Individual frames are sigma clipped and filled in with an average value before being stacked.
+        Frames are sigma clipped along the stack axis and median combined (see combine.sigmaClipCombine).
 
         Args:
             temp (int): Temperature of bias frames
@@ -57,26 +59,11 @@ class RON:
         # Create save and frame directories 
         biasdir = os.path.join(self.rootPath, 'data', 'ron', str(temp), readout_mode)
         savedir = os.path.join(self.rootPath, 'data', 'ron', 'master_bias', f"{temp}C_{gain}_master_bias.fits")
-        # Load the biases
-        fitsLoader = loadImage.fitsLoader(biasdir)
-        bias = fitsLoader.loadImages() 
-        # Apply clipping to each frame
-        clippedMask = [] 
-        for i in bias:
-            maskedFrame = sigma_clip(i, sigma=3, maxiters=None)
-            clippedMask.append(maskedFrame)
-        
-        # Stack the clipped biases
-        stackedMask = np.ma.stack(clippedMask, axis=0)
-        fillValue = np.ma.mean(stackedMask)
-        stackedMask = np.median(stackedMask, axis=0)
-        # Fill clipped values with the mean of other pixels (after stacking)
-        stackedMask = stackedMask.filled(fillValue)
-        stackedMask = stackedMask.astype(np.float32)
+        # Sigma clipped median of the stack, shared with DC
+        stackedMask = combine.createMasterBias(biasdir, savedir)
         print(type(stackedMask))
         print(f"shape: {np.shape(stackedMask)}")
         print(f"min: {np.min(stackedMask)} max: {np.max(stackedMask)}")
-        fits.writeto(savedir, stackedMask)
     
     
     def takeData(self, temp, number=10, readout_mode="High Gain"):
@@ -126,7 +113,7 @@ class RON:
                 return
 
     
-    def calcRON(self, dataPath, plotName, binning=1):
+    def calcRON(self, dataPath, plotName, binning=1, readout_mode='High Gain'):
         """
         Calculates RON by subtracting the master from individual biases.
         Then calcualtes the pixel wise std of all frames and divides by sqrt 2.
@@ -135,22 +122,77 @@ class RON:
             dataPath (str:): Path to bias images something of the form: -5/High Gain
             plotName (str:): Name for the heatmap and histogram plot
             binning (int, optional): Square bin size for making the heatmap. Defaults to 1 (no binning).
+            readout_mode (str, optional): Readout mode of the biases, high RON pixels are
+            added to this mode's bad pixel mask. Defaults to 'High Gain'.
         """
         # Load master bias
         masterPath = os.path.join(self.rootPath,'data', 'ron', 'master_bias')
         masterLoader = loadImage.fitsLoader(masterPath)
-        masterBias = masterLoader.loadImages() 
+        masterBias = masterLoader.loadImages()[0]
         
-        # Load bias images
+        # Load bias images (memory mapped, read one at a time below)
         biasPath = os.path.join(self.rootPath, 'data', 'ron', dataPath)
-        biasLoader = loadImage.fitsLoader(biasPath)
+        biasLoader = loadImage.fitsLoader(biasPath, lazy=True)
         biasFrames = biasLoader.loadImages()
         
-        # Calculate STD
-        stack = np.stack(biasFrames, axis=0)
-        finish = stack - masterBias
-        finish = np.std(finish, axis=0)
+        # Calculate STD one frame at a time instead of stacking every frame
+        stats = stackStats.pixelStats()
+        for frame in biasFrames:
+            stats.add(frame - masterBias)
+        self.finishRON(stats, plotName, binning, readout_mode)
+
+
+    def streamRON(self, temp, plotName, number=300, binning=1, readout_mode='High Gain', saveEvery=None):
+        """
+        Takes biases and calculates RON from them in memory. Every frame goes straight
+        from the camera into the running per pixel statistics, so nothing is written
+        to disk and read back (apart from every saveEvery'th bias if asked for).
+        Subtracting a master bias does not change the per pixel std, so it is skipped.
+
+        Args:
+            temp (int): Temperature of sensor to take data at.
+            plotName (str): Name for the heatmap and histogram plot
+            number (int, optional): Number of biases. Defaults to 300.
+            binning (int, optional): Square bin size for making the heatmap. Defaults to 1 (no binning).
+            readout_mode (str, optional): Readout mode of sensor either: "High Gain" or "Low Gain". Defaults to "High Gain".
+            saveEvery (int, optional): Also save every saveEvery'th bias to data/ron/{temp}/{readout_mode}. Defaults to None.
+        """
+        savedir = os.path.join(self.rootPath, 'data', 'ron', str(temp), readout_mode)
+        os.makedirs(savedir, exist_ok=True)
+        gateway = DLAPIGateway() 
+        cam = DLAPICamera(gateway, model='stc', dirname=savedir)
+        cam.connect() 
+        cam.set_temperature(temp)
+        cam.start_cooling()
+
+        stats = stackStats.pixelStats()
+        result = cam.acquire(number, 0, [lambda frame, header: stats.add(frame)], imtype='bias', 
+                             readout_mode=readout_mode, save_every=saveEvery)
+        print(result.description)
+        if not result.success and stats.count < 2:
+            return
+        self.finishRON(stats, plotName, binning, readout_mode)
+
+
+    def finishRON(self, stats, plotName, binning=1, readout_mode='High Gain'):
+        """
+        RON from the per pixel statistics of a stack of biases. High RON pixels are
+        flagged in the shared bad pixel mask and the results plotted.
+
+        Args:
+            stats (stackStats.pixelStats): Statistics of the biases.
+            plotName (str:): Name for the heatmap and histogram plot
+            binning (int, optional): Square bin size for making the heatmap. Defaults to 1 (no binning).
+            readout_mode (str, optional): Readout mode of the biases. Defaults to 'High Gain'.
+        """
+        finish = stats.std()
         finish /= np.sqrt(2) 
+
+        # Flag noisy pixels in the shared bad pixel mask
+        highRON = stackStats.madOutliers(finish, 5) & (finish > np.median(finish))
+        shared = badPixelMask.updateMask(badPixelMask.HIGH_RON, highRON, readout_mode)
+        print(f"High RON pixels: {np.count_nonzero(highRON)}")
+        print(f"Mean Value (unflagged pixels): {np.mean(shared.goodPixels(finish))}")
         
         self.plotStatistics(finish, plotName, binning) 
 
@@ -9,6 +9,8 @@ import re
 import sys
 sys.path.append("..")
 import loadImage
+import stackStats
+import badPixelMask
 
 sys.path.append("../cam")
 from camera import DLAPICamera
@@ -78,62 +80,160 @@ class SALTNPEPPER:
                 return
     
     
-    def calcSaltnPepper(self, temp=-5, readout_mode='High Gain'): 
+    def calcSaltnPepper(self, temp=-5, readout_mode='High Gain', render='scatter', k=3): 
         """
         Take N biases identify a small ROI then plot ADU of pixels.
-        graph all pixels change colour for ones +/- 3x RON. 
+        graph all pixels change colour for ones +/- k x RON. 
+
+        Args:
+            temp (int, optional): Temperature of the biases. Defaults to -5.
+            readout_mode (str, optional): Readout mode of the biases. Defaults to 'High Gain'.
+            render (str, optional): 'scatter', 'density' or 'png' (see plotTimeSeries). Defaults to 'scatter'.
+            k (float, optional): Outlier threshold in units of RON. Defaults to 3.
         """
-        # Load bias images
+        # Load bias images (memory mapped, only the ROI is read below)
         biasPath = os.path.join(self.rootPath, 'data', 'saltnPepper', 'bias', f"{str(temp)}", readout_mode)
-        biasLoader = loadImage.fitsLoader(biasPath)
+        biasLoader = loadImage.fitsLoader(biasPath, lazy=True)
         biasFrames = biasLoader.loadImages()
         
 
-        # Get std and mean of first frame
-        # Used to find pixels of interest
-        std = np.std(biasFrames[0])
-        mean = np.mean(biasFrames[0])
-        
-        # Get coordinates of pixels 
-        highStd = np.where(biasFrames[0] > (mean + self.stdVar*std))
+        # Use pixels already flagged as noisy in the shared bad pixel mask
+        shared = badPixelMask.loadMask(readout_mode)
+        noisy = badPixelMask.RTN | badPixelMask.HIGH_RON
+        if shared is not None and shared.count(noisy):
+            highStd = np.nonzero(shared.get(noisy))
+        else:
+            # Get std and mean of first frame
+            # Used to find pixels of interest
+            firstFrame = np.asarray(biasFrames[0])
+            std = np.std(firstFrame)
+            mean = np.mean(firstFrame)
+            
+            # Get coordinates of pixels 
+            highStd = np.where(firstFrame > (mean + self.stdVar*std))
         
         print(f"Starting x ROI: {highStd[0][0]}, Starting y ROI: {highStd[1][0]}")
 
         self.midROI(highStd)
         
-        # Initialize lists to store pixel values and corresponding frame numbers
-        pixel_values = []
-        frame_numbers = []
-
-        # Iterate through the subset of frames
-        for i, frame in enumerate(biasFrames):
-            # Get the ROI
-            subset = frame[self.startX:self.endX, self.startY:self.endY]
-            # List of frame numbers
-            frame_numbers.append(i) 
-            # List of lists containing pixel Values
-            flat_array  = subset.flatten()
-            pixel_values.append(list(flat_array))
-        
+        # (frames, pixels) array of the ROI
+        values = np.array([np.asarray(frame[self.startX:self.endX, self.startY:self.endY]).ravel()
+                           for frame in biasFrames], dtype=np.float64)
+        self.plotTimeSeries(values, render, k)
 
-        # Chart all pixels across frames
-        # Not sure how to change colours of outliers
-        # without tanking performance. 
-        for x, y in zip(frame_numbers, pixel_values):            
-            plt.scatter([x]*len(y), y,  color='red')
 
+    def plotTimeSeries(self, values, render='scatter', k=3, maxSize=(2000, 1000)):
+        """
+        Plot a (frames, pixels) array of pixel values against frame number in one go.
+        A pixel's values more than k x RON from its median are drawn in red, the rest
+        in blue. RON is the median of the pixels' temporal standard deviations.
 
+        Args:
+            values (np.ndarray): (frames, pixels) pixel values.
+            render (str, optional): How to draw the points. Defaults to 'scatter'.
+                'scatter': every point drawn at once, one marker colour for normal points and one for outliers.
+                'density': 2D histogram image of ADU vs frame number.
+                'png': write a decimated image straight to plotPath without a figure.
+            k (float, optional): Outlier threshold in units of RON. Defaults to 3.
+            maxSize (tuple, optional): Largest (width, height) of the 'png' image. Defaults to (2000, 1000).
+        """
+        nFrames, nPixels = values.shape
+        ron = np.median(np.std(values, axis=0))
+        outliers = np.abs(values - np.median(values, axis=0)) > k * ron
+        print(f"RON: {ron:.2f} ADU, {np.count_nonzero(outliers)} of {values.size} points outside +/-{k} RON")
+        low, high = np.percentile(values, [0.1, 99.9])
+        low, high = low - ron, high + ron
+        title = f"Salt and Pepper Noise (Random Telegraph Noise) +/-{k} RON"
+
+        if render == 'png':
+            # Bin straight into pixels of the output image, one column per (decimated) frame
+            width = min(nFrames, maxSize[0])
+            height = maxSize[1]
+            columns = np.broadcast_to((np.arange(nFrames) * width // nFrames)[:, None], values.shape)
+            rows = np.clip(((high - values) / (high - low) * (height - 1)).astype(np.intp), 0, height - 1)
+            image = np.full((height, width, 3), 255, dtype=np.uint8)
+            # Normal points first so outliers are drawn on top
+            image[rows[~outliers], columns[~outliers]] = (31, 119, 180)
+            image[rows[outliers], columns[outliers]] = (214, 39, 40)
+            plt.imsave(self.plotPath, image)
+            return
+
+        plt.figure()
+        if render == 'density':
+            bins = max(1, int(np.ceil(high - low)))
+            frameIndex = np.broadcast_to(np.arange(nFrames)[:, None], values.shape)
+            density, _, _ = np.histogram2d(frameIndex.ravel(), values.ravel(), bins=[nFrames, bins],
+                                           range=[[-0.5, nFrames - 0.5], [low, high]])
+            plt.imshow(density.T, origin='lower', aspect='auto', cmap='magma', interpolation='nearest',
+                       extent=(-0.5, nFrames - 0.5, low, high), norm='log')
+            plt.colorbar(label='count')
+        elif render == 'scatter':
+            # One marker-only line per colour draws far faster than a scatter with a colour per point
+            frameIndex = np.broadcast_to(np.arange(nFrames)[:, None], values.shape)
+            plt.plot(frameIndex[~outliers], values[~outliers], linestyle='none', marker='.', markersize=2, color='tab:blue')
+            plt.plot(frameIndex[outliers], values[outliers], linestyle='none', marker='.', markersize=2, color='tab:red')
+        else:
+            print(f"Unknown render mode: {render}")
+            return
 
-        plt.ylim(210, 250)
+        plt.ylim(low, high)
         plt.xlabel('Frame Number')
         plt.ylabel('ADU Pixel Value')
-        plt.title("Salt and Pepper Noise (Random Telegraph Noise) +/-12 std")
-        # plt.legend()
+        plt.title(title)
 
         plt.savefig(os.path.join(self.plotPath))
         # Show the plot
         plt.show()
 
+
+    def findRTN(self, temp=-5, readout_mode='High Gain', minJumps=2, minBimodality=5/9):
+        """
+        Random telegraph noise candidates over the full frame. The bias stack is
+        streamed once through stackStats.rtnStats which keeps, for every pixel,
+        the number of large frame to frame jumps, a coarse histogram (how many
+        separate levels the pixel sits at) and the bimodality coefficient of its
+        values. A candidate has at least minJumps jumps and either two or more
+        levels or a bimodal distribution. Candidates are ranked by bimodality
+        times their noise in units of the read noise.
+        The candidate map is saved as fits, the ranked list as csv (both in
+        data/saltnPepper/rtn) and the pixels are flagged RTN in the bad pixel mask.
+
+        Args:
+            temp (int, optional): Temperature of the biases. Defaults to -5.
+            readout_mode (str, optional): Readout mode of the biases. Defaults to 'High Gain'.
+            minJumps (int, optional): Fewest jumps for a candidate. Defaults to 2.
+            minBimodality (float, optional): Bimodality coefficient threshold. Defaults to 5/9 (uniform distribution).
+
+        Returns:
+            tuple: (boolean candidate map, ranked array of x, y, score, levels, jumps, bimodality, std).
+        """
+        biasPath = os.path.join(self.rootPath, 'data', 'saltnPepper', 'bias', f"{str(temp)}", readout_mode)
+        biasFrames = loadImage.fitsLoader(biasPath, lazy=True).loadImages()
+        stats = stackStats.rtnStats().addFrames(biasFrames)
+
+        jumps = stats.jumps
+        levels = stats.levels()
+        bimodality = stats.bimodality()
+        std = stats.std()
+        candidates = (jumps >= minJumps) & ((levels >= 2) | (bimodality > minBimodality))
+
+        y, x = np.nonzero(candidates)
+        score = bimodality[y, x] * std[y, x] / stats.noise
+        order = np.argsort(score)[::-1]
+        ranked = np.column_stack([x, y, score, levels[y, x], jumps[y, x], bimodality[y, x], std[y, x]])[order]
+        print(f"Read noise: {stats.noise:.2f} ADU, {len(ranked)} RTN candidates from {stats.count} frames")
+
+        saveDir = os.path.join(self.rootPath, 'data', 'saltnPepper', 'rtn')
+        os.makedirs(saveDir, exist_ok=True)
+        name = f"{temp}C_{readout_mode.replace(' ', '')}"
+        fits.writeto(os.path.join(saveDir, f"{name}_rtn_candidates.fits"), candidates.astype(np.uint8),
+                     fits.Header([('NFRAMES', stats.count), ('RON', stats.noise)]), overwrite=True)
+        np.savetxt(os.path.join(saveDir, f"{name}_rtn_candidates.csv"), ranked, delimiter=',',
+                   fmt=['%d', '%d', '%.4g', '%d', '%d', '%.4g', '%.4g'],
+                   header='x,y,score,levels,jumps,bimodality,std', comments='')
+        badPixelMask.updateMask(badPixelMask.RTN, candidates, readout_mode)
+        return candidates, ranked
+
    
     def midROI(self, indexes): 
         """
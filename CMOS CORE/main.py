@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 
@@ -13,9 +14,9 @@ def testRON(biasPath, figureName):
     ronObject = ron.RON(biasPath, figureName)
     ronObject.calcRON()   
 
-def testGain(flatPath, darkPath):
-    test = gain.GAIN(flatPath, darkPath)
-    test.spacialVariation()
+def testGain(temp=-5, expTime=0.065, readout_mode='Low Gain'):
+    test = gain.GAIN()
+    test.spacialVariation(temp=temp, expTime=expTime, readout_mode=readout_mode)
 
 
 def testPixelWiseGain(flatPath, darkPath, figureName):
@@ -29,14 +30,9 @@ def dcData(temps=[0, -5, -10, -15, -20], times=[1,10,60,120,240]):
         for t in times:
             test.takeDarks(temp, t)
 
-def processDC():
+def processDC(temps=[0, -5, -10, -15, -20], times=[1,10,60,120,240]):
     test = dc.DC()
-    temp1 = 0
-    temp2 = -5
-    temp3 = -10
-    temp4 = -15
-    temp5 = -20
-    test.fullFrameDC(temp1=temp1, temp2=temp2, temp3=temp3, temp4=temp4, temp5=temp5)
+    test.fullFrameDC(temps=temps, expTimes=times, workers=os.cpu_count())
     
 #----------------GAIN---------------------------------------------------------------
 def takeGainFlats():
@@ -1,11 +1,17 @@
 import sys
 sys.path.append("..")
 import loadImage
+import stackStats
+import calibCache
 import os 
+import re
+import glob
+import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from scipy.constants import h, c, e
+from astropy.io import fits
 
 
 #**********************************************************************************
@@ -42,18 +48,65 @@ from scipy.constants import h, c, e
 
 
 
+def parseFilename(filename, imageType='light'):
+    """
+    Exposure time and wavelength from a filename written by gatherData,
+    for example 12s_light_550nm_High Gain.fits or 0.5s_dark_400nm_High Gain.fits
+
+    Returns:
+        tuple: (expTime, wavelength) as floats, None if the filename does not match.
+    """
+    match = re.search(rf'(\d+(?:\.\d+)?)s_{imageType}_(\d+(?:\.\d+)?)nm', filename)
+    if not match:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+
+def loadGain(gainPath=None, mapDir='../CMOS CORE/data/gain/maps'):
+    """
+    Gain of the sensor from a gain map saved by the CMOS CORE gain PTC.
+    The median over the map is used so unfit (NaN) pixels/tiles are ignored.
+
+    Args:
+        gainPath (str, optional): Gain map fits file. Defaults to None (newest *_gain.fits in mapDir).
+        mapDir (str, optional): Where the gain maps are saved, relative to this file.
+
+    Returns:
+        float: Gain in e-/ADU.
+    """
+    if gainPath is None:
+        gainMaps = glob.glob(os.path.join(os.path.dirname(__file__), mapDir, '*_gain.fits'))
+        if not gainMaps:
+            raise FileNotFoundError(f"Error. No gain map in {mapDir}, run the gain PTC or pass --egain.")
+        gainPath = max(gainMaps, key=os.path.getmtime)
+    eGain = float(np.nanmedian(fits.getdata(gainPath)))
+    print(f"Gain {eGain:.3f} e-/ADU from {os.path.basename(gainPath)}")
+    return eGain
+
+
 def loadFrames(exposurePath='data/exposures/time1', darkPath = 'data/darks'): 
-    
+    """
+    Group light and dark frames by the exposure time and wavelength in their
+    filenames. Frames are memory mapped and only read when they are reduced.
+
+    Returns:
+        tuple: light frames {(expTime, wavelength): [frames]} and dark frames {expTime: [frames]}.
+    """
     absPath = os.path.dirname(__file__)
-    # Load light frames (12s exp)
-    fullPathLight = os.path.join(absPath, exposurePath)
-    lightFrames = loadImage.fitsLoader(fullPathLight) 
-    lightFrames.loadByFilename('light_', 'wavelength') 
-    # Load dark frames
-    fullPathDark = os.path.join(absPath, darkPath)
-    darkFrames = loadImage.fitsLoader(fullPathDark)
-    darkFrames.loadByFilename('dark_', 'exposure_time')
-    return lightFrames.keyImages, darkFrames.keyImages
+    lightFrames = {}
+    darkFrames = {}
+    for path, imageType in ((exposurePath, 'light'), (darkPath, 'dark')):
+        fullPath = os.path.join(absPath, path)
+        for filename in loadImage.fitsLoader(fullPath).fitsFiles():
+            info = parseFilename(filename, imageType)
+            if info is None:
+                continue
+            frame = loadImage.lazyFrame(os.path.join(fullPath, filename))
+            if imageType == 'light':
+                lightFrames.setdefault(info, []).append(frame)
+            else:
+                darkFrames.setdefault(info[0], []).append(frame)
+    return lightFrames, darkFrames
 
     
 def graphPhotodiode(filepath='data/photodiode/example.csv'):
@@ -78,7 +131,7 @@ def graphPhotodiode(filepath='data/photodiode/example.csv'):
     plt.show()
     
 
-def stackByKey(data):
+def stackByKey(data, kind=None):
     """
     Takes a dictionary, key values are wavelength and then averages
     all the frames into one pixel wise. Then returns a dict with key 
@@ -86,6 +139,9 @@ def stackByKey(data):
 
     Args:
         data (dict): Frames to be averaged. 
+        kind (str, optional): Master type ('dark', 'flat'...). When given the 
+        averaged frames are stored in the calibration cache and reused on the
+        next run. Needs frames from a lazy fitsLoader. Defaults to None.
 
     Returns:
         averagedData (dict): Averaged frames.  
@@ -94,61 +150,43 @@ def stackByKey(data):
     for wavelength, image in data.items():
             if image:
                 # Calculate the mean of all image arrays for the current wavelength
-                averagedValue = np.mean(image, axis=0)
+                if kind:
+                    filePaths = [frame.filePath for frame in image]
+                    averagedValue = calibCache.getCache().master(filePaths, kind,
+                                                                 lambda: stackStats.stackMean(image), method='mean')
+                else:
+                    averagedValue = stackStats.stackMean(image)
                 averagedData[wavelength] = averagedValue
     return averagedData
 
-def subFrames(lightFrames: dict, darkFrames: dict):
+def calcSensorTerm(lightFrames: dict, masterDarks: dict, eGain):
     """
-    Subtract dark images from light. Right now the exp time
-    is hard coded which is not great. 
+    Electrons per second collected by the whole sensor at every exposure time
+    and wavelength. Each group of light frames is streamed into a mean frame,
+    the master dark with the same exposure time is subtracted in place,
+    negative values are clamped to 0, then the frame is summed and converted
+    with the gain and exposure time.
 
     Args:
-        lightFrames (dict): Light Frames, key is wavelength. 
-        darkFrames (dict): Dark frames, key is exp time. 
-    """
-    scienceImages = {} 
-    for wavelength, image in lightFrames.items():
-        
-        sImg = image - darkFrames['7']
-        # Set any negative values to 0
-        sImg[sImg < 0] = 0
-        scienceImages[wavelength] = sImg
-        
-        min_value = np.min(sImg)
-        max_value = np.max(sImg)
-        average_value = np.mean(sImg)
-        
-        # plt.imshow(sImg, cmap='viridis')  # 'viridis' is a colormap for brighter colors
-        # plt.colorbar()  # Add a colorbar for reference
-        # plt.title("Heatmap of 2D Array")
-        # plt.savefig(f'test_{wavelength}nm.png')
-        # plt.clf()
-
-        # print(f"Minimum value: {min_value}")
-        # print(f"Maximum value: {max_value}")
-        # print(f"Average value: {average_value}")
-    return scienceImages
-        
-#eGain = 5.419037
-def calcSensorTerm(scienceImages: dict, eGain = 2.3, expTime=7):
-    """
-    Calc signal value by taking summing all pixels 
-    then multiplying by eGain.
-    (hard coded eGain here, cringe and BAD)
-    Args:
-        scienceImages (dict): Images with key as wavelength.
+        lightFrames (dict): {(expTime, wavelength): [frames]} from loadFrames.
+        masterDarks (dict): {expTime: master dark frame}.
+        eGain (float): Gain of the sensor in e-/ADU (from the gain PTC).
 
     Returns:
-        scienceMedian (dict): Median values, key is wavelength.  
+        pd.DataFrame: Wavelength, ExpTime and SensorTerm (e-/s) for every group.
     """
-    sensorTerm = {} 
-    for wavelength, image in scienceImages.items():
-        print(wavelength)
-        sum = np.sum(image) * eGain # sum the data
-        sum = sum / expTime # divide by exposure time
-        # Round wavelength to integer
-        sensorTerm[int(wavelength)] = sum
+    rows = []
+    for (expTime, wavelength), frames in sorted(lightFrames.items()):
+        if expTime not in masterDarks:
+            print(f"No dark frames for {expTime}s, skipping {wavelength}nm")
+            continue
+        science = stackStats.stackMean(frames)
+        science -= masterDarks[expTime]
+        # Set any negative values to 0
+        np.maximum(science, 0, out=science)
+        rows.append({'Wavelength': wavelength, 'ExpTime': expTime,
+                     'SensorTerm': np.sum(science) * eGain / expTime})
+    sensorTerm = pd.DataFrame(rows, columns=['Wavelength', 'ExpTime', 'SensorTerm'])
     print(f"Sensor Term: {sensorTerm}")
     return sensorTerm
 
@@ -187,38 +225,49 @@ def subPhotodiode(lightData, darkData):
     return merged
 
 def calcPhotodiodeTerm(data):
-    photodiodeTerm = {} 
-    for index, row in photoDiodeScience.iterrows():
-        wavelength = row['Wavelength']
-        science_reading = row['science_reading']
-        # Calc Term 
-        result = (wavelength * 1e-9 * science_reading) / (h*c)
-        photodiodeTerm[wavelength] = result
+    """
+    Photons per second seen by the photodiode at each wavelength:
+    (wavelength * science_reading) / (h * c).
+
+    Args:
+        data (df): Wavelength and science_reading columns (from subPhotodiode).
+
+    Returns:
+        pd.DataFrame: Wavelength and PhotodiodeTerm columns.
+    """
+    photodiodeTerm = data[['Wavelength']].copy()
+    photodiodeTerm['PhotodiodeTerm'] = data['Wavelength'] * 1e-9 * data['science_reading'] / (h * c)
     return photodiodeTerm
 
 def calcQE(sensorTerm, photodiodeTerm, printData=True, plot=True):
-    results = {}
-    # Divide values at each wavelength and store the result
-    for wavelength in photodiodeTerm:
-        if wavelength in sensorTerm:
-            result = (sensorTerm[wavelength] / photodiodeTerm[wavelength]) * 1000 * 10
-            results[wavelength] = result
+    """
+    QE at every wavelength both terms were measured at. Wavelengths are
+    rounded to 0.1nm before the terms are joined.
+
+    Args:
+        sensorTerm (df): Wavelength, ExpTime and SensorTerm (from calcSensorTerm).
+        photodiodeTerm (df): Wavelength and PhotodiodeTerm (from calcPhotodiodeTerm).
+
+    Returns:
+        pd.DataFrame: Wavelength, ExpTime, both terms and QE.
+    """
+    sensorTerm = sensorTerm.assign(Wavelength=sensorTerm['Wavelength'].round(1))
+    photodiodeTerm = photodiodeTerm.assign(Wavelength=photodiodeTerm['Wavelength'].round(1))
+    results = pd.merge(sensorTerm, photodiodeTerm, on='Wavelength')
+    results['QE'] = results['SensorTerm'] / results['PhotodiodeTerm'] * 1000 * 10
 
     if printData: 
-        print(f"Photodiode Term: {photodiodeTerm}")
-        print(f"Sensor Term: {sensorTerm}")
-        print(results)
+        print(results.to_string(index=False))
         
     if plot: 
-        # Format data for plot
-        wavelengths = list(results.keys())
-        division_results = list(results.values())
-        # Create a plot
+        # One line per exposure time
         plt.figure()
-        plt.plot(wavelengths, division_results, marker='o', linestyle='-')
+        for expTime, group in results.groupby('ExpTime'):
+            plt.plot(group['Wavelength'], group['QE'], marker='o', linestyle='-', label=f'{expTime:g}s')
         plt.title("Quantum Efficiency")
         plt.xlabel("Wavelength (nm)")
         plt.ylabel("QE (%)")
+        plt.legend()
         plt.grid(True)
         # Save Plot
         plt.savefig("QE_2Gain.png")
@@ -228,16 +277,20 @@ def calcQE(sensorTerm, photodiodeTerm, printData=True, plot=True):
     
     
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Calculate quantum efficiency from light/dark frames and photodiode readings.")
+    parser.add_argument('--egain', type=float, default=None, help="Gain in e-/ADU. Defaults to the measured gain map.")
+    parser.add_argument('--gain-map', default=None, help="Gain map fits file. Defaults to the newest in CMOS CORE/data/gain/maps.")
+    args = parser.parse_args()
+
  # ---------------------Sensor----------------------------------------------------    
+    # Gain in e-/ADU from the gain PTC
+    eGain = args.egain if args.egain is not None else loadGain(args.gain_map)
     # Load Frames
     lightFrames, darkFrames = loadFrames()
-    # Stack Light/dark frames 
-    stackedLight = stackByKey(lightFrames)
-    stackedDark = stackByKey(darkFrames) 
-    # Subtract dark from light frames     
-    scienceFrames = subFrames(stackedLight, stackedDark)
-    # Calculate term
-    sensorTerm = calcSensorTerm(scienceFrames)
+    # Stack dark frames at each exposure time
+    stackedDark = stackByKey(darkFrames, kind='dark') 
+    # Stack light frames, subtract dark and sum at each wavelength
+    sensorTerm = calcSensorTerm(lightFrames, stackedDark, eGain)
 
  # ---------------------PhotoDiode-------------------------------------------------
  
@@ -0,0 +1,215 @@
+import os
+import numpy as np
+from astropy.io import fits
+
+import stackStats
+
+
+# Bit flags, a pixel can have any combination of them
+HOT = 1
+DEAD = 2
+RTN = 4
+SATURATED = 8
+HIGH_RON = 16
+ALL = HOT | DEAD | RTN | SATURATED | HIGH_RON
+FLAG_NAMES = {HOT: 'HOT', DEAD: 'DEAD', RTN: 'RTN', SATURATED: 'SATURATED', HIGH_RON: 'HIGH_RON'}
+
+# Masks are kept in data/bad_pixel_masks at the root of the repository
+DEFAULT_MASK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bad_pixel_masks')
+
+
+class badPixelMask:
+    """
+    Bad pixel mask of the sensor. Every pixel has a uint8 of bit flags (HOT,
+    DEAD, RTN, SATURATED, HIGH_RON) so one small map holds the outliers found
+    by every analysis. Masks are built from dark, bias and flat stacks (streamed,
+    never fully in memory), saved as a compressed FITS (or .npz) file and applied
+    to frames as a cheap boolean reduction instead of clipping every run.
+    """
+
+    def __init__(self, shape=None, flags=None):
+        """
+        Args:
+            shape (tuple, optional): Frame shape for an empty mask.
+            flags (np.ndarray, optional): Existing uint8 flag map.
+        """
+        if flags is not None:
+            self.flags = np.asarray(flags, dtype=np.uint8)
+        elif shape is not None:
+            self.flags = np.zeros(shape, dtype=np.uint8)
+        else:
+            self.flags = None
+
+    @property
+    def shape(self):
+        return None if self.flags is None else self.flags.shape
+
+
+    def add(self, flag, mask):
+        """
+        Set a flag on every pixel where mask is True.
+
+        Args:
+            flag (int): Flag bit(s) to set. For example HOT.
+            mask (np.ndarray): Boolean frame.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if self.flags is None:
+            self.flags = np.zeros(mask.shape, dtype=np.uint8)
+        elif mask.shape != self.flags.shape:
+            raise ValueError(f"Mask shape {mask.shape} does not match bad pixel mask shape {self.flags.shape}")
+        self.flags[mask] |= np.uint8(flag)
+        return self
+
+
+    def get(self, flags=ALL):
+        """
+        Boolean frame, True where a pixel has any of the given flags.
+        """
+        return (self.flags & np.uint8(flags)) != 0
+
+
+    def count(self, flags=ALL):
+        return int(np.count_nonzero(self.get(flags)))
+
+
+    def summary(self):
+        """
+        Number of pixels with each flag.
+        """
+        return {name: self.count(flag) for flag, name in FLAG_NAMES.items()}
+
+
+    def addDarks(self, frames, masterBias=None, sigma=5, saturation=65535):
+        """
+        Flag HOT pixels (dark signal more than sigma robust standard deviations above
+        the median of the stack mean) and SATURATED pixels from a stack of darks.
+
+        Args:
+            frames (iterable): Dark frames, can be lazy.
+            masterBias (np.ndarray, optional): Subtracted from the mean dark. Defaults to None.
+            sigma (float, optional): Hot pixel threshold. Defaults to 5.
+            saturation (int, optional): ADU counted as saturated. Defaults to 65535.
+        """
+        stats = stackStats.pixelStats().addFrames(frames)
+        mean = stats.mean if masterBias is None else stats.mean - masterBias
+        self.add(HOT, stackStats.madOutliers(mean, sigma) & (mean > np.median(mean)))
+        self.add(SATURATED, stats.max >= saturation)
+        return self
+
+
+    def addBiases(self, frames, sigma=5, saturation=65535):
+        """
+        Flag HIGH_RON pixels (temporal standard deviation more than sigma robust
+        standard deviations above the median) and SATURATED pixels from a stack of biases.
+        """
+        stats = stackStats.pixelStats().addFrames(frames)
+        std = stats.std()
+        self.add(HIGH_RON, stackStats.madOutliers(std, sigma) & (std > np.median(std)))
+        self.add(SATURATED, stats.max >= saturation)
+        return self
+
+
+    def addFlats(self, frames, masterDark=None, deadFraction=0.5, saturation=65535):
+        """
+        Flag DEAD pixels (response below deadFraction of the median of the stack mean)
+        and SATURATED pixels from a stack of flats.
+        """
+        stats = stackStats.pixelStats().addFrames(frames)
+        mean = stats.mean if masterDark is None else stats.mean - masterDark
+        self.add(DEAD, mean < deadFraction * np.median(mean))
+        self.add(SATURATED, stats.max >= saturation)
+        return self
+
+
+    def apply(self, frame, flags=ALL):
+        """
+        Frame as a masked array with the flagged pixels masked.
+        """
+        return np.ma.masked_array(frame, mask=self.get(flags))
+
+
+    def goodPixels(self, frame, flags=ALL):
+        """
+        1D array of the pixels without any of the given flags, for reductions
+        like np.mean(mask.goodPixels(frame)).
+        """
+        return np.asarray(frame)[~self.get(flags)]
+
+
+    def fill(self, frame, flags=ALL, value=None):
+        """
+        Replace flagged pixels in place with value (default the mean of the good pixels).
+        """
+        mask = self.get(flags)
+        frame[mask] = np.mean(frame[~mask]) if value is None else value
+        return frame
+
+
+    def save(self, path):
+        """
+        Save the mask. Paths ending in .npz are saved as a compressed numpy
+        archive, anything else as a compressed FITS image.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.endswith('.npz'):
+            np.savez_compressed(path, flags=self.flags)
+            return
+        header = fits.Header()
+        for flag, name in FLAG_NAMES.items():
+            header[f'HIERARCH BIT {flag}'] = name
+        hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(self.flags, header, name='BPM')])
+        hdul.writeto(path, overwrite=True)
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a saved mask.
+
+        Returns:
+            badPixelMask: the mask, None if there is no file at path.
+        """
+        if not os.path.exists(path):
+            return None
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                return cls(flags=data['flags'])
+        with fits.open(path) as hdul:
+            return cls(flags=hdul['BPM'].data)
+
+
+def maskPath(readout_mode='High Gain', maskDir=DEFAULT_MASK_DIR):
+    """
+    Where the shared mask for a readout mode is stored.
+    """
+    return os.path.join(maskDir, f"{readout_mode.replace(' ', '')}_bpm.fits")
+
+
+def loadMask(readout_mode='High Gain'):
+    """
+    Shared mask for a readout mode, None if none has been made yet.
+    """
+    return badPixelMask.load(maskPath(readout_mode))
+
+
+def updateMask(flag, mask, readout_mode='High Gain'):
+    """
+    Add pixels found by an analysis to the shared mask of a readout mode and save it.
+    The flag is cleared first so re-running an analysis replaces its old result.
+
+    Args:
+        flag (int): Flag bit. For example HOT.
+        mask (np.ndarray): Boolean frame, True for flagged pixels.
+        readout_mode (str, optional): Readout mode of sensor. Defaults to 'High Gain'.
+
+    Returns:
+        badPixelMask: the updated mask.
+    """
+    shared = loadMask(readout_mode)
+    if shared is None or shared.shape != np.shape(mask):
+        shared = badPixelMask(np.shape(mask))
+    shared.flags &= np.uint8(~flag & 0xFF)
+    shared.add(flag, mask)
+    shared.save(maskPath(readout_mode))
+    return shared
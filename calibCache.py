@@ -0,0 +1,138 @@
+import os
+import json
+import hashlib
+import numpy as np
+from astropy.io import fits
+
+
+# Masters are kept in data/calibration_cache at the root of the repository
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'calibration_cache')
+
+
+class calibrationCache:
+    """
+    Cache of master calibration frames (bias, dark, flat). Masters are stored
+    as FITS files named by a hash of the input files (path, size and mtime)
+    and the combine parameters, so a master is only rebuilt when its frames or
+    the way they are combined change. The least recently used masters are
+    removed once the cache grows past maxBytes.
+    """
+
+    def __init__(self, cacheDir=DEFAULT_CACHE_DIR, maxBytes=2 * 1024**3):
+        """
+        Args:
+            cacheDir (str, optional): Directory masters are stored in. Defaults to DEFAULT_CACHE_DIR.
+            maxBytes (int, optional): Size limit of the cache. Defaults to 2GB.
+        """
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+
+    def key(self, filePaths, kind, **params):
+        """
+        Content address of a master frame.
+
+        Args:
+            filePaths (list): Paths of the frames that make up the master.
+            kind (str): Type of master. For example 'bias', 'dark' or 'flat'.
+            **params: Combine parameters (sigma, maxiters, method...).
+
+        Returns:
+            str: hex digest used as the cache key.
+        """
+        files = []
+        for filePath in sorted(os.path.abspath(path) for path in filePaths):
+            stat = os.stat(filePath)
+            files.append([filePath, stat.st_size, stat.st_mtime_ns])
+        description = {'kind': kind, 'files': files, 'params': params}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, f'{key}.fits')
+
+
+    def get(self, key):
+        """
+        Stored master for a key.
+
+        Returns:
+            np.ndarray: master frame, None if it is not in the cache.
+        """
+        cachePath = self.path(key)
+        if not os.path.exists(cachePath):
+            return None
+        try:
+            data = fits.getdata(cachePath)
+        except Exception as e:
+            print(f"Error reading cached master {cachePath}: {str(e)}")
+            return None
+        # Mark as recently used for eviction
+        os.utime(cachePath)
+        return data
+
+
+    def put(self, key, data, kind=None, **params):
+        """
+        Store a master frame and evict old masters if the cache is too big.
+        """
+        header = fits.Header()
+        if kind:
+            header['CALTYPE'] = kind
+        for name, value in params.items():
+            header[f'HIERARCH {name.upper()}'] = str(value)
+        tmpPath = self.path(key) + '.tmp'
+        fits.writeto(tmpPath, np.asarray(data), header, overwrite=True)
+        os.replace(tmpPath, self.path(key))
+        self.evict()
+
+
+    def evict(self):
+        """
+        Remove least recently used masters until the cache is under maxBytes.
+        """
+        entries = []
+        for filename in os.listdir(self.cacheDir):
+            if filename.endswith('.fits'):
+                stat = os.stat(os.path.join(self.cacheDir, filename))
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            os.remove(os.path.join(self.cacheDir, filename))
+            total -= size
+
+
+    def master(self, filePaths, kind, build, **params):
+        """
+        Get a master frame from the cache, building and storing it on a miss.
+
+        Args:
+            filePaths (list): Paths of the frames that make up the master.
+            kind (str): Type of master. For example 'bias', 'dark' or 'flat'.
+            build (callable): Called with no arguments to make the master on a miss.
+            **params: Combine parameters, part of the cache key.
+
+        Returns:
+            np.ndarray: master frame.
+        """
+        key = self.key(filePaths, kind, **params)
+        data = self.get(key)
+        if data is None:
+            data = build()
+            self.put(key, data, kind, **params)
+        return data
+
+
+_cache = None
+
+def getCache():
+    """
+    Calibration cache shared by every analysis in this process.
+    """
+    global _cache
+    if _cache is None:
+        _cache = calibrationCache()
+    return _cache
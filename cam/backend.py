@@ -0,0 +1,46 @@
+import os
+
+
+# Which DLAPI implementation to use. "dlapi" is the real SDK (needs cppyy, the
+# headers and library in /usr/local and a camera plugged in), "sim" is the
+# simulated camera in simulator.py which runs anywhere.
+BACKEND = os.environ.get('DLAPI_BACKEND', 'dlapi').lower()
+
+
+def load_backend(name:str = BACKEND):
+    """Loads the dl namespace of a DLAPI backend.
+
+    Args:
+        name (str, optional): "dlapi" or "sim". Defaults to the DLAPI_BACKEND environment variable, or "dlapi".
+
+    Returns:
+        The dl namespace (getGateway, TSubframe, TExposureOptions, ISensor, IPromise...).
+    """
+    if name == 'dlapi':
+        import cppyy
+        cppyy.include('/usr/local/include/dlapi.h')
+        cppyy.load_library('/usr/local/lib/libdlapi')
+        return cppyy.gbl.dl
+    elif name == 'sim':
+        import simulator
+        return simulator.dl
+    else:
+        raise ValueError(f"Error. Unknown DLAPI backend '{name}', expected 'dlapi' or 'sim'.")
+
+
+def buffer_address(pointer) -> int:
+    """Address of an image buffer returned by getBufferData().
+
+    Args:
+        pointer: Buffer pointer from the backend.
+
+    Returns:
+        int: Address of the first pixel.
+    """
+    if BACKEND == 'dlapi':
+        import cppyy.ll
+        return cppyy.ll.cast['intptr_t'](pointer)
+    return int(pointer)
+
+
+dl = load_backend()
@@ -0,0 +1,101 @@
+"""Benchmarks acquisition against the simulated camera, no hardware needed.
+
+Usage:
+    python benchmark.py --frames 100 --width 3208 --height 2200 --download-time 0.1
+
+Compares the serial expose() loop, the pipelined expose_sequence() and the
+in-memory acquire() feeding streaming statistics, and checks the read noise
+recovered from the in-memory biases against the simulator's settings.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+# Must be set before the camera modules import the backend
+os.environ['DLAPI_BACKEND'] = 'sim'
+
+import simulator
+from gateway import DLAPIGateway
+from camera import DLAPICamera
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import stackStats
+
+
+def run_benchmark(n_frames=50, exptime=0.0, width=3208, height=2200, readout_mode='High Gain',
+                readout_time=0.0, download_time=0.0, n_writers=1, queue_size=8, fsync=False, dirname=None):
+    """Times each acquisition mode on a simulated camera.
+
+    Args:
+        n_frames (int, optional): Frames per mode. Defaults to 50.
+        exptime (float, optional): Exposure time in seconds. Defaults to 0 (biases).
+        width (int, optional): Frame width. Defaults to 3208 (full STC-428).
+        height (int, optional): Frame height. Defaults to 2200.
+        readout_mode (str, optional): Readout mode. Defaults to 'High Gain'.
+        readout_time (float, optional): Simulated sensor readout time in seconds. Defaults to 0.
+        download_time (float, optional): Simulated USB download time in seconds. Defaults to 0.
+        n_writers (int, optional): FITS writer threads. Defaults to 1.
+        queue_size (int, optional): FITS writer queue size. Defaults to 8.
+        fsync (bool, optional): fsync every file. Defaults to False.
+        dirname (str, optional): Where files are written. Defaults to a temporary directory.
+
+    Returns:
+        results (dict): mode -> frames per second, plus the recovered read noise.
+    """
+    simulator.configure(width=width, height=height, readout_time=readout_time, download_time=download_time,
+                        cooling_time_constant=0, seed=0)
+    imtype = 'bias' if exptime == 0 else 'dark'
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cam = DLAPICamera(DLAPIGateway(), model='stc', dirname=dirname or tmpdir)
+        cam.connect()
+        cam.set_temperature(-5)
+        cam.start_cooling()
+        cam.set_writer(n_workers=n_writers, queue_size=queue_size, fsync=fsync)
+        results = {}
+
+        start = time.perf_counter()
+        for n in range(n_frames):
+            cam.expose(exptime, imtype=imtype, readout_mode=readout_mode, fast=True)
+        results['expose'] = n_frames / (time.perf_counter() - start)
+
+        response = cam.expose_sequence(n_frames, exptime, imtype=imtype, readout_mode=readout_mode, fast=True)
+        results['expose_sequence'] = response.payload['frame_rate_hz']
+        results['writer'] = response.payload['writer']
+
+        stats = stackStats.pixelStats()
+        response = cam.acquire(n_frames, exptime, [lambda frame, header: stats.add(frame)],
+                            imtype=imtype, readout_mode=readout_mode, fast=True)
+        results['acquire'] = response.payload['frame_rate_hz']
+        config = simulator.SENSOR_CONFIG
+        results['read_noise_adu'] = float(np.median(stats.std(ddof=1)))
+        results['expected_read_noise_adu'] = config['read_noise'][readout_mode] / config['gain'][readout_mode]
+        cam.writer.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark acquisition with the simulated DLAPI camera.")
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--exptime', type=float, default=0.0)
+    parser.add_argument('--width', type=int, default=3208)
+    parser.add_argument('--height', type=int, default=2200)
+    parser.add_argument('--readout-mode', default='High Gain')
+    parser.add_argument('--readout-time', type=float, default=0.0)
+    parser.add_argument('--download-time', type=float, default=0.0)
+    parser.add_argument('--writers', type=int, default=1)
+    parser.add_argument('--queue-size', type=int, default=8)
+    parser.add_argument('--fsync', action='store_true')
+    parser.add_argument('--dir', default=None, help="Directory to write to. Defaults to a temporary directory.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.frames, args.exptime, args.width, args.height, args.readout_mode,
+                            args.readout_time, args.download_time, args.writers, args.queue_size, args.fsync, args.dir)
+    for mode in ['expose', 'expose_sequence', 'acquire']:
+        print(f"{mode:>16}: {results[mode]:.2f} frames/s")
+    writer = results['writer']
+    print(f"FITS writer: mean write {writer['mean_write_s']*1000:.1f}ms, max queue depth {writer['max_queue_depth']}, "
+          f"blocked {writer['blocked_s']:.2f}s")
+    print(f"Read noise: {results['read_noise_adu']:.3f} ADU (simulated {results['expected_read_noise_adu']:.3f} ADU)")
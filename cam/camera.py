@@ -1,7 +1,5 @@
 import os
 import time
-import cppyy
-import cppyy.ll
 import ctypes
 import time
 import hashlib
@@ -12,18 +10,15 @@ import sys
 import re
 
 from datetime import datetime, timedelta
-from astropy.io import fits
 
 
 
 from gateway import DLAPIGateway
 from log import DFLog
 from base import DCPHardware
-
-cppyy.include('/usr/local/include/dlapi.h')
-cppyy.load_library('/usr/local/lib/libdlapi')
-
-dl = cppyy.gbl.dl
+from ring_buffer import FrameRingBuffer
+from writer import FITSWriter, write_fits
+from backend import dl, buffer_address
     
 
 class DLAPICameraError(Exception):
@@ -119,6 +114,7 @@ class DLAPICamera(DCPHardware):
                         
         # Variables describing the exposure currently in progress.
         self._imtype = None
+        self._readout_mode = None
         self._is_exposing = None
         self._exposure_duration = None
         self._exposure_start_datetime = None
@@ -133,6 +129,15 @@ class DLAPICamera(DCPHardware):
         self._image_stack = []
         self._latest_image = None
         self._latest_image_number = None
+        
+        # Optional preallocated ring buffer that downloads are copied into.
+        self._ring_buffer = None
+        
+        # Session cache of what has been sent to the device, so repeated calls with
+        # unchanged settings do not go over USB. Filled in at connect and updated
+        # by the setters. None means unknown, so the next setter always talks to the device.
+        self._device_cache = {}
+        self.invalidate_cache()
 
         # Polling
         self._polling_thread = None
@@ -146,6 +151,9 @@ class DLAPICamera(DCPHardware):
         
         # Add custom logger
         self.logger = DFLog(f'DLAPICamera({model})').logger
+        
+        # FITS files are written on background threads so a slow disk does not hold the camera.
+        self._writer = FITSWriter(logger=self.logger)
 
 
     @property
@@ -188,6 +196,58 @@ class DLAPICamera(DCPHardware):
         return self._image_stack
 
 
+    @property
+    def ring_buffer(self):
+        """Ring buffer that downloaded frames are copied into.
+
+        Returns:
+            ring_buffer (FrameRingBuffer): The ring buffer, None if frames are not being kept in memory.
+        """
+        return self._ring_buffer
+
+
+    def set_ring_buffer(self, n_frames:int):
+        """Keeps the last n_frames downloaded frames in a preallocated ring buffer.
+        Each download is copied straight into the next slot, so bursts do not 
+        allocate a new array per frame.
+
+        Args:
+            n_frames (int): Number of frames to keep. 0 or None turns the ring buffer off.
+        """
+        if not n_frames:
+            self._ring_buffer = None
+            return DLAPICameraResponse(description="Ring buffer disabled.")
+        if not self._state['is_connected']:
+            return DLAPICameraResponse(success=False,description="Error. Camera not connected.")
+        self._ring_buffer = FrameRingBuffer(n_frames, (self._height, self._width))
+        return DLAPICameraResponse(description=f"Ring buffer of {n_frames} frames allocated.")
+
+
+    @property
+    def writer(self):
+        """Background FITS writer.
+
+        Returns:
+            writer (FITSWriter): The writer. Use writer.flush() to wait for queued files and writer.stats() for backpressure.
+        """
+        return self._writer
+
+
+    def set_writer(self, n_workers:int = 1, queue_size:int = 8, fsync:bool = False, fsync_batch:int = 1):
+        """Replaces the background FITS writer. Anything queued on the old one is written first.
+
+        Args:
+            n_workers (int, optional): Number of writer threads. Defaults to 1.
+            queue_size (int, optional): Frames waiting to be written before acquisition blocks. Defaults to 8.
+            fsync (bool, optional): Make sure files are on disk, not just in the page cache. Defaults to False.
+            fsync_batch (int, optional): Files written between fsyncs. Defaults to 1.
+        """
+        self._writer.close()
+        self._writer = FITSWriter(n_workers=n_workers, queue_size=queue_size, fsync=fsync, 
+                                fsync_batch=fsync_batch, logger=self.logger)
+        return DLAPICameraResponse(description=f"FITS writer with {n_workers} workers and a queue of {queue_size} frames.")
+
+
     def connect(self):
         """Connects to the DLAPI camera.
 
@@ -220,6 +280,8 @@ class DLAPICamera(DCPHardware):
         self._latest_image_number = highnum
         
         self._state['is_connected'] = True
+        self.invalidate_cache()
+        self._cache_readout_modes()
         self.set_default_subframe()
         time.sleep(0.5)
         self.logger.info("Camera is connected.")
@@ -230,10 +292,12 @@ class DLAPICamera(DCPHardware):
         """
         try:
             self.logger.info("Disconnecting camera.")
+            self._writer.flush()
             self.camera = None
             self.sensor = None
             self.serial_number = None
             self._state['is_connected'] = False
+            self.invalidate_cache()
             return DLAPICameraResponse(success=True,description='Camera Disconnected Successfully.')
         except:
             return DLAPICameraResponse(success=False,description="Could not disconnect from camera.")     
@@ -368,6 +432,8 @@ class DLAPICamera(DCPHardware):
         """
         if not self._state['is_connected']:
             return DLAPICameraResponse(success=False,description="Error. Camera not connected.")
+        if self._device_cache['subframe'] == (top, left, nx, ny, binx, biny):
+            return DLAPICameraResponse(description="subframe unchanged.")
         with self._activity_lock:
             try:
                 if self.verbose:
@@ -378,10 +444,14 @@ class DLAPICamera(DCPHardware):
                 self._height = ny
                 self._bin_x = binx
                 self._bin_y = biny
+                if self._ring_buffer is not None and self._ring_buffer.shape != (ny, nx):
+                    self._ring_buffer = FrameRingBuffer(self._ring_buffer.n_frames, (ny, nx))
                 subf = dl.TSubframe(top, left, nx, ny, binx, biny)
                 handlePromise(self.sensor.setSubframe(subf))
+                self._device_cache['subframe'] = (top, left, nx, ny, binx, biny)
                 return DLAPICameraResponse(description="subframe set.")
             except:
+                self._device_cache['subframe'] = None
                 return DLAPICameraResponse(success=False,description="Error. Could not set default subframe.")  
 
 
@@ -407,6 +477,36 @@ class DLAPICamera(DCPHardware):
         except:
             return DLAPICameraResponse(success=False,description='readout modes could not be obtained')
 
+
+    def _cache_readout_modes(self):
+        """Queries the readout modes once and stores the index of each name."""
+        modes = self._get_readout_modes()
+        self._device_cache['readout_modes'] = {mode: index for index, mode in enumerate(modes)}
+        return self._device_cache['readout_modes']
+
+
+    def _readout_mode_index(self, readout_mode:str) -> int:
+        """Index of a readout mode name, from the session cache.
+
+        Raises:
+            ValueError: Readout mode is not supported by the sensor.
+        """
+        modes = self._device_cache['readout_modes']
+        if modes is None:
+            modes = self._cache_readout_modes()
+        if readout_mode not in modes:
+            raise ValueError(f"Readout mode '{readout_mode}' not supported.")
+        return modes[readout_mode]
+
+
+    def invalidate_cache(self):
+        """Forgets the cached device settings so the next setters always talk to the device.
+        Use this if the camera may have been changed by something else (power cycle, another program).
+        """
+        self._device_cache['readout_modes'] = None
+        self._device_cache['subframe'] = None
+        self._device_cache['cooler'] = None
+
     
     def set_temperature(self, setpoint):
         """Sets the temperature setpoint of the camera. (Does not automatically cool the camera.)
@@ -421,10 +521,15 @@ class DLAPICamera(DCPHardware):
             return DLAPICameraResponse(success=False,description="Error. Camera not connected.")
         with self._activity_lock:
             if self._state['supports_cooling']:
+                cached = self._device_cache['cooler']
+                if cached is not None and cached[1] == setpoint:
+                    self._state['setpoint_temperature_c'] = setpoint
+                    return DLAPICameraResponse(success=True,description="Cooling setpoint unchanged.")
                 cooler = self.camera.getTEC()
                 cooler_is_enabled = cooler.getEnabled()
                 self._state['setpoint_temperature_c'] = setpoint
                 handlePromise(cooler.setState(cooler_is_enabled, setpoint))
+                self._device_cache['cooler'] = (cooler_is_enabled, setpoint)
                 self._state['cooling_enabled'] = True
                 return DLAPICameraResponse(success=True,description="Cooling setpoint set. (cooling not yet active).")
             else:
@@ -444,10 +549,13 @@ class DLAPICamera(DCPHardware):
             return DLAPICameraResponse(success=False,description="Error. Camera not connected.")
         with self._activity_lock:
             if self._state['supports_cooling']:
-                cooler = self.camera.getTEC()
                 if setpoint is None:
                     setpoint = float(self._state['setpoint_temperature_c'])
+                if self._device_cache['cooler'] == (True, setpoint):
+                    return DLAPICameraResponse(success=True,description="Cooling already enabled.")
+                cooler = self.camera.getTEC()
                 handlePromise(cooler.setState(True, setpoint))
+                self._device_cache['cooler'] = (True, setpoint)
                 self._state['cooling_enabled'] = True
                 return DLAPICameraResponse(success=True,description="Cooling Enabled.")
             else:
@@ -464,9 +572,12 @@ class DLAPICamera(DCPHardware):
             return DLAPICameraResponse(success=False,description="Error. Camera not connected.")
         with self._activity_lock:
             if self._state['supports_cooling']:
-                cooler = self.camera.getTEC()
                 setpoint = float(self._state['setpoint_temperature_c'])
+                if self._device_cache['cooler'] == (False, setpoint):
+                    return DLAPICameraResponse(success=True,description="Cooling already disabled.")
+                cooler = self.camera.getTEC()
                 handlePromise(cooler.setState(False, setpoint))
+                self._device_cache['cooler'] = (False, setpoint)
                 self._state['cooling_enabled'] = False
                 return DLAPICameraResponse(success=True,description="Cooling Disabled.")
             else:
@@ -482,7 +593,8 @@ class DLAPICamera(DCPHardware):
                 use_external_trigger:bool = False, 
                 checksum = False, 
                 debug:bool = False, 
-                wait=True):
+                wait=True, 
+                wait_for_write:bool = True):
         """Exposes the DLAPI Camera.
 
         Args:
@@ -490,11 +602,14 @@ class DLAPICamera(DCPHardware):
             imtype (str, optional): Type of image ("bias", "dark", "flat", or "light"). Defaults to "light"
             filename (str, optional): FITS filename to output. Defaults to None, in which case a standard name is applied
             readout_mode (str, optional): Image readout mode. Defaults to 'Normal'. See get_readout_modes() for the list of available modes.
+            fast (bool, optional): Skip the abort (and 0.5s wait) done before every exposure to clear the sensor. Defaults to False.
             use_preflash (bool, optional): Apply image preflash? Defaults to False.
             use_external_trigger (bool, optional): Use external trigger? Defaults to False.
             checksum (bool, optional): Compute checksum of image data portion and write it to the log. Defaults to False.
             debug (bool, optional): Print addtional information. Defaults to False.
             wait (bool, optional): Block until completed. Defaults to True.
+            wait_for_write (bool, optional): Block until the FITS file is on disk. If False the file is
+                written in the background and expose() returns once the image is downloaded. Defaults to True.
 
         Raises:
             DLAPICameraError: Error raised if exposure cannot be taken.
@@ -505,6 +620,7 @@ class DLAPICamera(DCPHardware):
 
         # Figure out the filename
         self._imtype = imtype
+        self._readout_mode = readout_mode
         if not filename:
             self._automatic_filename = True
             sequence_number = self._latest_image_number + 1
@@ -520,14 +636,15 @@ class DLAPICamera(DCPHardware):
         else:
             open_shutter = True
             
-        # Get the index of the desired readout mode.
+        # Get the index of the desired readout mode. Names are resolved once per session.
         try:
-            readout_mode_index = self._get_readout_modes().index(readout_mode)
+            readout_mode_index = self._readout_mode_index(readout_mode)
         except ValueError:
             return DLAPICameraResponse(success=False,description=f"Error. Readout mode '{readout_mode}' not supported.")
         # If we're not in fast mode, abort any exposure that might be in progress.
         # This shouldn't be necessary bit it seems to have the side-effect of 
-        # clearing the buffer and lowering read noise.
+        # clearing the buffer and lowering read noise, so it is kept by default
+        # (it costs 0.5s per frame). Bursts that do not need it should use fast=True.
         if not fast:
             self.abort_exposure()
         try:
@@ -571,8 +688,12 @@ class DLAPICamera(DCPHardware):
             if debug:
                 print("Saving image.")            
             with self._activity_lock:
-                data = self._get_image_data(checksum=checksum, debug=debug)
-                self._save_data(data, filename=self._next_filename)
+                data = self._get_image_data(checksum=checksum, debug=debug, 
+                                            out=self._next_ring_slot(asynchronous=not wait_for_write))
+            # The file is written outside the activity lock so polling is not held up by the disk.
+            written = self._writer.submit(data, self._header_snapshot(), self._next_filename)
+            if wait_for_write:
+                written.result()
             
             # The file has been saved, so update the stored information.
             self._latest_image = self._next_filename
@@ -582,7 +703,8 @@ class DLAPICamera(DCPHardware):
             self._next_filename = None
             self._is_exposing = False
             self._state['is_exposing'] = False
-            return DLAPICameraResponse(success=True,description=f"Exposure completed. Image saved: {self._latest_image}")
+            saved = "saved" if wait_for_write else "queued for writing"
+            return DLAPICameraResponse(success=True,description=f"Exposure completed. Image {saved}: {self._latest_image}")
         except:
             self._is_exposing = False
             self._state['is_exposing'] = False
@@ -632,8 +754,8 @@ class DLAPICamera(DCPHardware):
         
         # Get the image from the buffer and save it to a file.
         with self._activity_lock:
-            data = self._get_image_data(checksum=checksum, debug=debug)
-            self._save_data(data, filename=self._next_filename)
+            data = self._get_image_data(checksum=checksum, debug=debug, out=self._next_ring_slot())
+        self._writer.submit(data, self._header_snapshot(), self._next_filename).result()
         
         # Update the stored information.
         self._latest_image = self._next_filename
@@ -646,6 +768,192 @@ class DLAPICamera(DCPHardware):
         return DLAPICameraResponse(success=True,description=f"Exposure completed. Image saved: {self._latest_image}")
         
         
+    def expose_sequence(self, n_frames:int, 
+                exptime:float, 
+                imtype:str = "light", 
+                readout_mode:str = 'Low Gain', 
+                fast:bool = False, 
+                use_preflash:bool = False, 
+                use_external_trigger:bool = False, 
+                interval:float = 0, 
+                status_interval:float = 10, 
+                checksum = False, 
+                debug:bool = False):
+        """Takes a burst of exposures with downloads and file writes pipelined.
+        Each frame is handed to the background FITS writer and the next exposure
+        starts straight away, so building headers and writing to disk overlap with
+        integration and readout. Files are named automatically like expose().
+
+        Args:
+            n_frames (int): Number of exposures.
+            exptime (float): Exposure time in seconds.
+            imtype (str, optional): Type of image ("bias", "dark", "flat", or "light"). Defaults to "light".
+            readout_mode (str, optional): Image readout mode. Defaults to 'Low Gain'.
+            fast (bool, optional): Skip the abort done once before the burst. Defaults to False.
+            use_preflash (bool, optional): Apply image preflash? Defaults to False.
+            use_external_trigger (bool, optional): Use external trigger? Defaults to False.
+            interval (float, optional): Minimum seconds between the starts of exposures. Defaults to 0 (as fast as possible).
+            status_interval (float, optional): Seconds between temperature refreshes for the headers. Defaults to 10.
+            checksum (bool, optional): Log the MD5 checksum of every frame. Defaults to False.
+            debug (bool, optional): Print addtional information. Defaults to False.
+
+        Returns:
+            DLAPICameraResponse: payload has the files written, elapsed time and achieved frame rates.
+        """
+        if not self._state['is_connected']:
+            return DLAPICameraResponse(success=False,description="Error. Camera not connected.")
+        try:
+            self._readout_mode_index(readout_mode)
+        except ValueError:
+            return DLAPICameraResponse(success=False,description=f"Error. Readout mode '{readout_mode}' not supported.")
+
+        self._writer.reset_stats()
+        futures = []
+        start = time.perf_counter()
+        frames = self._exposure_frames(n_frames, exptime, imtype, readout_mode, fast=fast, 
+                                    use_preflash=use_preflash, use_external_trigger=use_external_trigger, 
+                                    interval=interval, status_interval=status_interval, 
+                                    checksum=checksum, debug=debug, asynchronous=True)
+        try:
+            for i, (data, header) in enumerate(frames):
+                futures.append(self._writer.submit(data, header, self._next_sequence_filename(imtype)))
+                if debug:
+                    print(f"Frame {i + 1}/{n_frames} queued, {self._writer.stats()['queue_depth']} waiting to be written.")
+        except Exception as e:
+            self.logger.error(f"Sequence stopped after {len(futures)} frames: {str(e)}")
+        finally:
+            frames.close()
+        acquired = time.perf_counter()
+        n_acquired = len(futures)
+        written = []
+        errors = []
+        for future in futures:
+            try:
+                written.append(future.result())
+            except Exception as e:
+                errors.append(f"{str(e)}")
+        elapsed = time.perf_counter() - start
+
+        self._image_stack.extend(written)
+        if written:
+            self._latest_image = written[-1]
+        payload = {'files': written,
+                   'n_frames': n_acquired,
+                   'elapsed_s': elapsed,
+                   'acquisition_rate_hz': n_acquired / (acquired - start) if n_acquired else 0.0,
+                   'frame_rate_hz': len(written) / elapsed if written else 0.0,
+                   'writer': self._writer.stats()}
+        self.logger.info(f"Sequence of {n_acquired} frames in {elapsed:.2f}s ({payload['frame_rate_hz']:.2f} frames/s).")
+        success = n_acquired == n_frames and not errors
+        return DLAPICameraResponse(success=success,payload=payload,
+                                   description=f"Sequence completed. {len(written)} of {n_frames} images saved.",
+                                   warnings=[f"Could not write image: {error}" for error in errors] or None)
+
+
+    def stream(self, n_frames:int, 
+                exptime:float, 
+                imtype:str = "bias", 
+                readout_mode:str = 'Low Gain', 
+                fast:bool = False, 
+                use_preflash:bool = False, 
+                use_external_trigger:bool = False, 
+                interval:float = 0, 
+                save_every:int = None, 
+                status_interval:float = 10, 
+                checksum = False, 
+                debug:bool = False):
+        """Takes a burst of exposures and yields the frames in memory instead of
+        writing them to disk, so they can go straight into streaming statistics
+        (for example stackStats.pixelStats) without the write then reload round trip.
+        
+        Each frame is only guaranteed until the next one is requested: with a ring
+        buffer set the slot is reused, so copy any frame that needs to be kept.
+
+        Args:
+            n_frames (int): Number of exposures.
+            exptime (float): Exposure time in seconds.
+            imtype (str, optional): Type of image ("bias", "dark", "flat", or "light"). Defaults to "bias".
+            readout_mode (str, optional): Image readout mode. Defaults to 'Low Gain'.
+            fast (bool, optional): Skip the abort done once before the burst. Defaults to False.
+            use_preflash (bool, optional): Apply image preflash? Defaults to False.
+            use_external_trigger (bool, optional): Use external trigger? Defaults to False.
+            interval (float, optional): Minimum seconds between the starts of exposures. Defaults to 0 (as fast as possible).
+            save_every (int, optional): Also write every save_every'th frame to disk (in the background). Defaults to None (nothing is saved).
+            status_interval (float, optional): Seconds between temperature refreshes for the headers. Defaults to 10.
+            checksum (bool, optional): Log the MD5 checksum of every frame. Defaults to False.
+            debug (bool, optional): Print addtional information. Defaults to False.
+
+        Yields:
+            (np.ndarray, dict): Frame and its FITS header values.
+
+        Raises:
+            DLAPICameraError: Camera not connected or readout mode not supported.
+        """
+        if not self._state['is_connected']:
+            raise DLAPICameraError("Error. Camera not connected.")
+        try:
+            self._readout_mode_index(readout_mode)
+        except ValueError:
+            raise DLAPICameraError(f"Error. Readout mode '{readout_mode}' not supported.")
+
+        frames = self._exposure_frames(n_frames, exptime, imtype, readout_mode, fast=fast, 
+                                    use_preflash=use_preflash, use_external_trigger=use_external_trigger, 
+                                    interval=interval, status_interval=status_interval, 
+                                    checksum=checksum, debug=debug, asynchronous=bool(save_every))
+        for i, (data, header) in enumerate(frames):
+            if save_every and i % save_every == 0:
+                future = self._writer.submit(data, header, self._next_sequence_filename(imtype))
+                future.add_done_callback(self._record_saved_image)
+            yield data, header
+
+
+    def acquire(self, n_frames:int, 
+                exptime:float, 
+                consumers:list, 
+                imtype:str = "bias", 
+                readout_mode:str = 'Low Gain', 
+                **kwargs):
+        """Takes a burst of exposures and hands every frame to each consumer without
+        writing it to disk (see stream()).
+
+        Args:
+            n_frames (int): Number of exposures.
+            exptime (float): Exposure time in seconds.
+            consumers (list): Callables called as consumer(data, header) for every frame.
+            imtype (str, optional): Type of image ("bias", "dark", "flat", or "light"). Defaults to "bias".
+            readout_mode (str, optional): Image readout mode. Defaults to 'Low Gain'.
+            **kwargs: Passed on to stream() (fast, interval, save_every...).
+
+        Returns:
+            DLAPICameraResponse: payload has the number of frames, elapsed time and frame rate.
+        """
+        n_saved = len(self._image_stack)
+        n_acquired = 0
+        start = time.perf_counter()
+        frames = self.stream(n_frames, exptime, imtype=imtype, readout_mode=readout_mode, **kwargs)
+        try:
+            for data, header in frames:
+                for consumer in consumers:
+                    consumer(data, header)
+                n_acquired += 1
+        except DLAPICameraError as e:
+            return DLAPICameraResponse(success=False,description=e.message)
+        except Exception as e:
+            self.logger.error(f"Acquisition stopped after {n_acquired} frames: {str(e)}")
+        finally:
+            frames.close()
+        elapsed = time.perf_counter() - start
+        if kwargs.get('save_every'):
+            self._writer.flush()
+        payload = {'n_frames': n_acquired,
+                   'elapsed_s': elapsed,
+                   'frame_rate_hz': n_acquired / elapsed if n_acquired else 0.0,
+                   'files': self._image_stack[n_saved:]}
+        self.logger.info(f"Acquired {n_acquired} frames in memory in {elapsed:.2f}s ({payload['frame_rate_hz']:.2f} frames/s).")
+        return DLAPICameraResponse(success=n_acquired == n_frames,payload=payload,
+                                   description=f"Acquisition completed. {n_acquired} of {n_frames} frames acquired.")
+
+
     def get_status(self):
         """Get general status of the camera.
 
@@ -663,6 +971,11 @@ class DLAPICamera(DCPHardware):
             self._state['heatsink_temperature_c'] = round(cooler.getHeatSinkThermopileTemperature(), 3)
             self._state['sensor_temperature_c'] = round(cooler.getSensorThermopileTemperature(), 3)
             self._state['power_draw_percent'] = round(cooler.getCoolerPower(), 3)
+            # Something else changed the cooler, so the cached setting can no longer be trusted
+            cached = self._device_cache['cooler']
+            if cached is not None and (bool(cached[0]) != bool(self._state['cooling_enabled']) 
+                                       or abs(cached[1] - self._state['setpoint_temperature_c']) > 1e-3):
+                self._device_cache['cooler'] = None
         else:
             self._state['cooling_enabled'] = False
             self._state['setpoint_temperature_c'] = None
@@ -769,11 +1082,11 @@ class DLAPICamera(DCPHardware):
             self._exposure_duration = duration
             start = datetime.now()
             self._exposure_start_datetime = start
-            self._exposure_start_time = start.isoformat('T','seconds')
+            self._exposure_start_time = start.isoformat('T','milliseconds')
             mid = start + timedelta(seconds=exptime/2.0)
-            self._exposure_mid_time = mid.isoformat('T','seconds')
+            self._exposure_mid_time = mid.isoformat('T','milliseconds')
             end = start + timedelta(seconds=exptime)
-            self._exposure_end_time = end.isoformat('T','seconds')
+            self._exposure_end_time = end.isoformat('T','milliseconds')
             handlePromise(self.sensor.startExposure(options))
         except:
             return DLAPICameraResponse(success=False,description="Error. Could not start exposure.")
@@ -816,7 +1129,7 @@ class DLAPICamera(DCPHardware):
             raise RuntimeError("Error. Could not start download.")    
 
 
-    def _get_image_data(self, checksum = False, debug = False):
+    def _get_image_data(self, checksum = False, debug = False, out = None):
         if not self._state['is_connected']:
             return DLAPICameraResponse(success=False,description="Error. Camera not connected.")
         if debug:
@@ -838,7 +1151,9 @@ class DLAPICamera(DCPHardware):
                     self.logger.error("Giving up after {} attempts to download buffer.".format(n_max_download_attempts))
                     raise DLAPICameraError("Error. Could not start download.")
         
-        # Turn the buffer into a 1D array of unsigned shorts
+        # Wrap the SDK buffer without copying it element by element. The view
+        # is only valid until the next download, so it is copied exactly once,
+        # either into out (for example a ring buffer slot) or into a new array.
         if debug:
             print("Getting image data.")
         pImg = self.sensor.getImage()
@@ -846,45 +1161,125 @@ class DLAPICamera(DCPHardware):
         n_data = pImg.getBufferLength()
         if debug:
             print(f"Buffer length: {n_data}")
-        d = cppyy.ll.cast['ushort*'](rawdata)
-        d.reshape((n_data,))
-
-        # Turn the 1D list into a 2D numpy array.
-        data = np.reshape(np.array(d), (self._height, self._width))
+        view = buffer_as_array(rawdata, n_data).reshape((self._height, self._width))
+        if out is None:
+            data = view.copy()
+        else:
+            np.copyto(out, view)
+            data = out
         if checksum:
             self._checksum = hashlib.md5(data).hexdigest()
             self.logger.info(f"Image bytes checksum: {self._checksum}")
         return data     
 
 
-    def _save_data(self, data, filename='/tmp/tmp.fits'):
+    def _exposure_frames(self, n_frames, exptime, imtype, readout_mode, fast=False, use_preflash=False, 
+                        use_external_trigger=False, interval=0, status_interval=10, checksum=False, 
+                        debug=False, asynchronous=False):
+        """Exposure loop shared by expose_sequence(), stream() and acquire().
+        Yields (data, header) for every frame as soon as it is downloaded.
+        asynchronous says whether frames may still be in use (queued for writing)
+        after the next one is downloaded.
+        """
+        readout_mode_index = self._readout_mode_index(readout_mode)
+        open_shutter = not (("dark" in imtype.lower()) or ("bias" in imtype.lower()))
+        self._imtype = imtype
+        self._readout_mode = readout_mode
+        if not fast:
+            self.abort_exposure()
+        self._is_exposing = True
+        self._state['is_exposing'] = True
+        last_start = None
+        last_status = None
+        try:
+            for i in range(n_frames):
+                if interval and last_start is not None:
+                    time.sleep(max(0, interval - (time.perf_counter() - last_start)))
+                last_start = time.perf_counter()
+                with self._activity_lock:
+                    self._start_exposure(exptime, open_shutter=open_shutter, readout_mode=readout_mode_index, 
+                                        use_preflash=use_preflash, use_external_trigger=use_external_trigger)
+                time.sleep(exptime)
+                try:
+                    with self._activity_lock:
+                        self._wait_for_exposure_to_complete(debug=debug)
+                except DLAPICameraError:
+                    self.logger.error("Attempting to get image data anyway.")
+                if last_status is None or time.perf_counter() - last_status > status_interval:
+                    self.get_status()
+                    last_status = time.perf_counter()
+                with self._activity_lock:
+                    data = self._get_image_data(checksum=checksum, debug=debug, 
+                                                out=self._next_ring_slot(asynchronous=asynchronous))
+                yield data, self._header_snapshot()
+        finally:
+            self._is_exposing = False
+            self._state['is_exposing'] = False
+
+
+    def _next_sequence_filename(self, imtype):
+        """Claims the next automatic file name."""
+        self._latest_image_number += 1
+        return os.path.join(self.dirname, f"{self.serial_number}_{self._latest_image_number}_{imtype}.fits")
+
+
+    def _record_saved_image(self, future):
+        """Done callback for frames saved in the background by stream()."""
+        if future.exception() is None:
+            self._image_stack.append(future.result())
+            self._latest_image = future.result()
+
+
+    def _next_ring_slot(self, asynchronous=False):
+        """Next ring buffer slot to download into, None if there is no ring buffer.
+        For asynchronous writes the slot must not come round again while it is still
+        queued or being written, so None is returned unless the ring is bigger than
+        everything the writer can hold.
+        """
+        if self._ring_buffer is None:
+            return None
+        if asynchronous and self._ring_buffer.n_frames <= self._writer.capacity:
+            return None
+        return self._ring_buffer.next_slot()
+
+
+    def _header_snapshot(self):
+        """Header values of the exposure that was just downloaded. Taken before the
+        next exposure starts, so the file can be written later (on another thread)
+        without reading camera attributes that have since changed.
+
+        Returns:
+            header (dict): FITS keyword -> value.
+        """
         # TODO: Keywords we still need to add:
         # TARGET, EGAIN, FOCUS, FILTER, TILT, RA, DEC, EQUINOX
-        hdul = fits.HDUList()
-        hdul.append(fits.PrimaryHDU())
-        hdul[0].data = data
-        hdul[0].header['BITPIX'] = 16
-        hdul[0].header['NAXIS'] = 2
-        hdul[0].header['NAXIS1'] = self._height
-        hdul[0].header['NAXIS2'] = self._width
-        hdul[0].header['EXPTIME'] = self._exposure_duration
-        hdul[0].header['IMAGETYP'] = self._imtype
-        hdul[0].header['XBINNING'] = self._bin_x
-        hdul[0].header['YBINNING'] = self._bin_y
-        hdul[0].header['DATE'] = self._exposure_start_time
-        hdul[0].header['DATE-OBS'] = self._exposure_start_time
-        hdul[0].header['DATE-MID'] = self._exposure_mid_time
-        hdul[0].header['DATE-END'] = self._exposure_end_time
-        hdul[0].header['CCD-TEMP'] = self._state['sensor_temperature_c']
-        hdul[0].header['HSINKT'] = self._state['heatsink_temperature_c']
-        hdul[0].header['SERIALNO'] = self.serial_number
-        hdul.writeto(filename, overwrite=True)
+        header = {}
+        header['EXPTIME'] = self._exposure_duration
+        header['IMAGETYP'] = self._imtype
+        header['READOUTM'] = self._readout_mode
+        header['XBINNING'] = self._bin_x
+        header['YBINNING'] = self._bin_y
+        header['DATE'] = self._exposure_start_time
+        header['DATE-OBS'] = self._exposure_start_time
+        header['DATE-MID'] = self._exposure_mid_time
+        header['DATE-END'] = self._exposure_end_time
+        header['CCD-TEMP'] = self._state['sensor_temperature_c']
+        header['HSINKT'] = self._state['heatsink_temperature_c']
+        header['SERIALNO'] = self.serial_number
+        return header
+
+
+    def _save_data(self, data, filename='/tmp/tmp.fits', header=None):
+        if header is None:
+            header = self._header_snapshot()
+        write_fits(data, header, filename)
         self.logger.info(f"Saved: {filename}")
         
 
     def _signal_handler(self, sig, frame):
         """Signal handler for SIGINT signal."""
         self.stop_polling()  # This also shuts down the polling thread.
+        self._writer.close()  # Don't lose frames that are still queued.
         sys.exit(0)
 
 
@@ -910,6 +1305,21 @@ def handlePromise(pPromise):
     pPromise.release()
     
     
+def buffer_as_array(pointer, n_pixels:int) -> np.ndarray:
+    """Wraps an SDK image buffer as a 1D uint16 array without copying it.
+
+    Args:
+        pointer: Buffer pointer returned by getBufferData().
+        n_pixels (int): Number of pixels in the buffer.
+
+    Returns:
+        np.ndarray: uint16 view of the buffer. Only valid until the SDK reuses the buffer.
+    """
+    address = buffer_address(pointer)
+    buffer = (ctypes.c_uint16 * n_pixels).from_address(address)
+    return np.frombuffer(buffer, dtype=np.uint16, count=n_pixels)
+    
+    
 def highest_fits_sequence_number(serno:str, directory:str) -> str:
     fileno_max = None
     for filename in os.listdir(directory):
@@ -1,13 +1,7 @@
-import cppyy
-import cppyy.ll
 import ctypes
 
 from log import DFLog
-
-cppyy.include('/usr/local/include/dlapi.h')
-cppyy.load_library('/usr/local/lib/libdlapi')
-
-dl = cppyy.gbl.dl
+from backend import dl
 
 class DLAPIGatewayError(Exception):
     """Exception raised when an SBIG Gateway error occurs."
@@ -0,0 +1,67 @@
+import threading
+import numpy as np
+
+
+class FrameRingBuffer(object):
+    """A preallocated ring of image frames.
+
+    Downloads are copied straight into the next slot, so taking a long burst
+    (for example 300 biases) never allocates a new array per frame. Once the
+    ring is full the oldest frame is overwritten.
+    """
+
+    def __init__(self, n_frames:int, shape:tuple, dtype=np.uint16):
+        """Initializes the ring buffer.
+
+        Args:
+            n_frames (int): Number of frames held before the oldest is overwritten.
+            shape (tuple): Shape of a frame (ny, nx).
+            dtype (optional): Pixel type. Defaults to np.uint16.
+        """
+        if n_frames < 1:
+            raise ValueError("Error. A ring buffer needs at least one frame.")
+        self.n_frames = n_frames
+        self.shape = tuple(shape)
+        self.buffer = np.empty((n_frames,) + self.shape, dtype=dtype)
+        self._n_written = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Number of frames currently held."""
+        return min(self._n_written, self.n_frames)
+
+    @property
+    def n_written(self):
+        """Total number of frames written since the buffer was created or reset."""
+        return self._n_written
+
+    def next_slot(self):
+        """Claims the next slot in the ring.
+
+        Returns:
+            np.ndarray: A view of the slot, to be filled in place.
+        """
+        with self._lock:
+            slot = self.buffer[self._n_written % self.n_frames]
+            self._n_written += 1
+        return slot
+
+    def latest(self):
+        """The most recently claimed frame, or None if the buffer is empty."""
+        if self._n_written == 0:
+            return None
+        return self.buffer[(self._n_written - 1) % self.n_frames]
+
+    def frames(self):
+        """Frames currently held, oldest first.
+
+        Returns:
+            np.ndarray: Copy of the frames with shape (len(self), ny, nx).
+        """
+        start = self._n_written - len(self)
+        return self.buffer[[i % self.n_frames for i in range(start, self._n_written)]]
+
+    def reset(self):
+        """Forgets every frame without freeing the memory."""
+        with self._lock:
+            self._n_written = 0
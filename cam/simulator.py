@@ -0,0 +1,369 @@
+import time
+import threading
+import numpy as np
+from types import SimpleNamespace
+
+
+# Physical model of the simulated sensor. Change with configure() before the
+# gateway is created. Sizes default to the full STC-428 (IMX428) frame, use a
+# smaller frame for quick benchmarks.
+BOLTZMANN_EV = 8.617333262e-5
+
+SENSOR_CONFIG = {
+    'serial_number': 'STC428M-SIM0001',
+    'width': 3208,
+    'height': 2200,
+    'pixel_size': 4.5,
+    'readout_modes': ['High Gain', 'Low Gain'],
+    'gain': {'High Gain': 1.2, 'Low Gain': 2.3},             # e-/ADU
+    'read_noise': {'High Gain': 1.6, 'Low Gain': 3.2},       # e- rms, median pixel
+    'read_noise_spread': 0.25,                               # lognormal sigma of the read noise map
+    'bias': 1000.0,                                          # ADU
+    'bias_column_noise': 2.0,                                # ADU rms column to column offsets
+    'full_well': 51000.0,                                    # e-
+    'dark_current': 0.5,                                     # e-/s/pixel median at dark_reference_temp
+    'dark_reference_temp': 20.0,                             # C
+    'activation_energy': 0.63,                               # eV
+    'dark_spread': 0.3,                                      # lognormal sigma of the dark current map
+    'hot_pixel_fraction': 1e-4,
+    'hot_pixel_factor': 50.0,
+    'flux': 2000.0,                                          # e-/s/pixel for light frames
+    'prnu': 0.01,                                            # photo response non uniformity
+    'rtn_fraction': 1e-3,
+    'rtn_amplitude': 8.0,                                    # e-, mean step of an RTN pixel
+    'rtn_switch_probability': 0.3,                           # chance an RTN pixel changes state between frames
+    'persistence_fraction': 0.002,                           # fraction of a light frame's charge trapped
+    'persistence_taus': (8.0, 60.0),                         # s
+    'persistence_weights': (0.6, 0.4),
+    'ambient_temp': 20.0,                                    # C
+    'max_cooling': 40.0,                                     # C below ambient at 100% power
+    'cooling_time_constant': 60.0,                           # s
+    'readout_time': 0.0,                                     # s between the end of an exposure and ReadyToDownload
+    'download_time': 0.0,                                    # s taken by startDownload (USB transfer)
+    'seed': None,
+}
+
+
+def configure(**kwargs):
+    """Changes the simulated sensor. Only affects gateways created afterwards.
+
+    Args:
+        **kwargs: Any key of SENSOR_CONFIG, for example configure(width=512, height=512, readout_time=0.05).
+    """
+    for key in kwargs:
+        if key not in SENSOR_CONFIG:
+            raise KeyError(f"Error. Unknown simulator setting '{key}'.")
+    SENSOR_CONFIG.update(kwargs)
+
+
+class SimulatedPromise(object):
+    """Stands in for dl::IPromise. Simulated calls finish immediately."""
+
+    def __init__(self, error:str = None):
+        self._error = error
+
+    def wait(self):
+        return dl.IPromise.Complete if self._error is None else dl.IPromise.Error
+
+    def getLastError(self, buffer, length):
+        buffer.value = self._error.encode()[:len(buffer) - 1]
+
+    def release(self):
+        pass
+
+
+class SimulatedImage(object):
+    """Stands in for dl::IImage, the downloaded buffer of uint16 pixels."""
+
+    def __init__(self):
+        self.data = np.zeros(0, dtype=np.uint16)
+
+    def getBufferData(self):
+        return self.data.ctypes.data
+
+    def getBufferLength(self):
+        return self.data.size
+
+
+class SimulatedTEC(object):
+    """Stands in for dl::ITEC. The sensor relaxes exponentially towards the setpoint
+    (or the ambient temperature when cooling is off)."""
+
+    def __init__(self, config:dict):
+        self.config = config
+        self._enabled = False
+        self._setpoint = config['ambient_temp']
+        self._temperature = config['ambient_temp']
+        self._time = time.monotonic()
+
+    def _update(self):
+        now = time.monotonic()
+        target = self._target()
+        tau = self.config['cooling_time_constant']
+        if tau > 0:
+            self._temperature = target + (self._temperature - target) * np.exp(-(now - self._time) / tau)
+        else:
+            self._temperature = target
+        self._time = now
+
+    def _target(self):
+        if not self._enabled:
+            return self.config['ambient_temp']
+        return max(self._setpoint, self.config['ambient_temp'] - self.config['max_cooling'])
+
+    def setState(self, enabled, setpoint):
+        self._update()
+        self._enabled = bool(enabled)
+        self._setpoint = float(setpoint)
+        return SimulatedPromise()
+
+    def getEnabled(self):
+        return self._enabled
+
+    def getSetpoint(self):
+        return self._setpoint
+
+    def getSensorThermopileTemperature(self):
+        self._update()
+        return self._temperature
+
+    def getHeatSinkThermopileTemperature(self):
+        return self.config['ambient_temp'] + 5 * self.getCoolerPower() / 100
+
+    def getCoolerPower(self):
+        if not self._enabled:
+            return 0.0
+        self._update()
+        power = 100 * (self.config['ambient_temp'] - self._temperature) / self.config['max_cooling']
+        return float(np.clip(power, 0, 100))
+
+
+class SimulatedSensor(object):
+    """Stands in for dl::ISensor. Every pixel has its own bias, read noise, dark
+    current, response and (for a few) random telegraph noise, fixed when the sensor
+    is made. Frames are made at download time from the exposure options:
+    Poisson shot noise on the light, dark and persistence charge, gaussian read
+    noise, conversion to ADU with the gain of the readout mode, then clipping.
+
+    Persistence charge is trapped by every light frame and released with the
+    persistence_taus time constants. The charge released since the previous
+    readout is added to each frame, so biases taken after a flat decay like
+    they do on the real sensor.
+
+    Binning is not simulated, frames always have the subframe's size.
+    """
+
+    def __init__(self, config:dict, tec:SimulatedTEC):
+        self.config = config
+        self.tec = tec
+        self._rng = np.random.default_rng(config['seed'])
+        shape = (config['height'], config['width'])
+        rng = self._rng
+
+        self.bias_map = (config['bias'] + rng.normal(0, config['bias_column_noise'], config['width'])[None, :]
+                        + np.zeros(shape)).astype(np.float32)
+        self.read_noise_map = rng.lognormal(0, config['read_noise_spread'], shape).astype(np.float32)
+        self.dark_map = rng.lognormal(0, config['dark_spread'], shape).astype(np.float32)
+        hot = rng.random(shape) < config['hot_pixel_fraction']
+        self.dark_map[hot] *= config['hot_pixel_factor']
+        self.response_map = (1 + rng.normal(0, config['prnu'], shape)).astype(np.float32)
+        self.rtn_rows, self.rtn_cols = np.nonzero(rng.random(shape) < config['rtn_fraction'])
+        self.rtn_amplitude = rng.exponential(config['rtn_amplitude'], self.rtn_rows.size).astype(np.float32)
+        self.rtn_state = rng.random(self.rtn_rows.size) < 0.5
+
+        self._subframe = (0, 0, config['width'], config['height'], 1, 1)
+        self._options = None
+        self._exposure_start = None
+        self._state = dl.ISensor.Idle
+        self._image = SimulatedImage()
+        self._trapped = None
+        self._trapped_time = None
+        self._last_readout = None
+        self._downloaded = threading.Condition()
+
+    def getInfo(self):
+        config = self.config
+        return SimpleNamespace(pixelsX=config['width'], pixelsY=config['height'],
+                            minCoolerSetpoint=config['ambient_temp'] - config['max_cooling'],
+                            maxCoolerSetpoint=config['ambient_temp'], minExposureDuration=0.0,
+                            pixelSizeX=config['pixel_size'], pixelSizeY=config['pixel_size'],
+                            exposurePrecision=1e-6, filterType=0, flag=0, frameType=0,
+                            hasRBIPreflash=False, id=0, maxBinX=4, maxBinY=4, model='STC-428M (simulated)',
+                            numberOfChannelsAvailable=1)
+
+    def queryInfo(self):
+        return SimulatedPromise()
+
+    def queryCalibration(self):
+        return SimulatedPromise()
+
+    def getCalibration(self):
+        return SimpleNamespace(adcGains=[1.0], adcOffsets=[0], channelsInUse=1,
+                            eGain=self.config['gain'][self.config['readout_modes'][0]], substrateVoltage=0.0)
+
+    def getReadoutModes(self, buffer, length):
+        buffer.value = '\n'.join(self.config['readout_modes']).encode()
+
+    def setSubframe(self, subframe):
+        self._subframe = (subframe.top, subframe.left, subframe.width, subframe.height, subframe.binX, subframe.binY)
+        return SimulatedPromise()
+
+    def abortExposure(self):
+        self._state = dl.ISensor.Idle
+        return SimulatedPromise()
+
+    def startExposure(self, options):
+        if options.readoutMode >= len(self.config['readout_modes']):
+            return SimulatedPromise(f"Readout mode {options.readoutMode} does not exist.")
+        self._options = options
+        self._exposure_start = time.monotonic()
+        self._state = dl.ISensor.Exposing
+        return SimulatedPromise()
+
+    def _update_state(self):
+        if self._state == dl.ISensor.Exposing:
+            elapsed = time.monotonic() - self._exposure_start
+            if elapsed >= self._options.duration + self.config['readout_time']:
+                self._state = dl.ISensor.ReadyToDownload
+
+    def startDownload(self):
+        self._update_state()
+        if self._state != dl.ISensor.ReadyToDownload:
+            return SimulatedPromise("No image ready to download.")
+        start = time.monotonic()
+        data = self._make_frame().ravel()
+        remaining = self.config['download_time'] - (time.monotonic() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+        with self._downloaded:
+            self._image.data = data
+            self._state = dl.ISensor.Idle
+            self._downloaded.notify_all()
+        return SimulatedPromise()
+
+    def getImage(self, timeout=10):
+        # The camera starts the download on another thread, so wait for it to finish
+        with self._downloaded:
+            self._downloaded.wait_for(lambda: self._state != dl.ISensor.ReadyToDownload, timeout)
+        return self._image
+
+    def _dark_rate(self):
+        """Median dark current in e-/s at the current sensor temperature (Arrhenius law)."""
+        config = self.config
+        temperature = self.tec.getSensorThermopileTemperature() + 273.15
+        reference = config['dark_reference_temp'] + 273.15
+        return config['dark_current'] * np.exp(-config['activation_energy'] / BOLTZMANN_EV * (1 / temperature - 1 / reference))
+
+    def _released_fraction(self, start, end):
+        """Fraction of the trapped charge released between two times after trapping."""
+        total = 0.0
+        for tau, weight in zip(self.config['persistence_taus'], self.config['persistence_weights']):
+            total += weight * (np.exp(-start / tau) - np.exp(-end / tau))
+        return total
+
+    def _make_frame(self):
+        config = self.config
+        options = self._options
+        mode = config['readout_modes'][options.readoutMode]
+        gain = config['gain'][mode]
+        top, left, nx, ny = self._subframe[:4]
+        window = (slice(top, top + ny), slice(left, left + nx))
+        now = time.monotonic()
+        rng = self._rng
+
+        # Expected electrons per pixel
+        electrons = self.dark_map[window] * np.float32(self._dark_rate() * options.duration)
+        if options.isLightFrame:
+            electrons += self.response_map[window] * np.float32(config['flux'] * options.duration)
+        if self._trapped is not None:
+            since = (self._last_readout if self._last_readout is not None else now) - self._trapped_time
+            electrons += self._trapped[window] * np.float32(self._released_fraction(max(since, 0), now - self._trapped_time))
+        # Biases with nothing to release skip the (slow) Poisson draw
+        if electrons.any():
+            electrons = rng.poisson(electrons).astype(np.float32)
+        np.minimum(electrons, config['full_well'], out=electrons)
+
+        if options.isLightFrame and config['persistence_fraction'] > 0:
+            full = np.zeros((config['height'], config['width']), dtype=np.float32)
+            full[window] = electrons * config['persistence_fraction']
+            self._trapped = full
+            self._trapped_time = now
+        self._last_readout = now
+
+        # Random telegraph pixels flip state between frames
+        self.rtn_state ^= rng.random(self.rtn_state.size) < config['rtn_switch_probability']
+        inside = ((self.rtn_rows >= top) & (self.rtn_rows < top + ny) 
+                  & (self.rtn_cols >= left) & (self.rtn_cols < left + nx) & self.rtn_state)
+        electrons[self.rtn_rows[inside] - top, self.rtn_cols[inside] - left] += self.rtn_amplitude[inside]
+
+        noise = rng.standard_normal((ny, nx), dtype=np.float32)
+        noise *= self.read_noise_map[window]
+        noise *= config['read_noise'][mode]
+        electrons += noise
+        adu = electrons / gain + self.bias_map[window]
+        return np.clip(np.rint(adu), 0, 65535).astype(np.uint16)
+
+
+class SimulatedCamera(object):
+    """Stands in for dl::ICamera."""
+
+    def __init__(self, config:dict):
+        self.config = config
+        self._tec = SimulatedTEC(config)
+        self._sensor = SimulatedSensor(config, self._tec)
+
+    def initialize(self):
+        pass
+
+    def getSerial(self, buffer, length):
+        buffer.value = self.config['serial_number'].encode()
+
+    def getSensor(self, index):
+        return self._sensor
+
+    def getTEC(self):
+        return self._tec
+
+    def queryStatus(self):
+        self._sensor._update_state()
+        return SimulatedPromise()
+
+    def getStatus(self):
+        return SimpleNamespace(mainSensorState=self._sensor._state)
+
+
+class SimulatedGateway(object):
+    """Stands in for dl::IGateway, with one simulated camera attached."""
+
+    def __init__(self):
+        self._cameras = []
+
+    def queryUSBCameras(self):
+        if not self._cameras:
+            self._cameras = [SimulatedCamera(dict(SENSOR_CONFIG))]
+
+    def getUSBCameraCount(self):
+        return len(self._cameras)
+
+    def getUSBCamera(self, index):
+        return self._cameras[index]
+
+
+def _subframe(top, left, width, height, binX, binY):
+    return SimpleNamespace(top=top, left=left, width=width, height=height, binX=binX, binY=binY)
+
+
+def _exposure_options(duration, binX, binY, readoutMode, isLightFrame, useRBIPreflash, useExtTrigger):
+    return SimpleNamespace(duration=duration, binX=binX, binY=binY, readoutMode=readoutMode,
+                        isLightFrame=isLightFrame, useRBIPreflash=useRBIPreflash, useExtTrigger=useExtTrigger)
+
+
+# The parts of the dl namespace the camera code uses
+dl = SimpleNamespace(
+    getGateway=SimulatedGateway,
+    deleteGateway=lambda gateway: None,
+    TSubframe=_subframe,
+    TExposureOptions=_exposure_options,
+    ISensor=SimpleNamespace(Idle=0, Exposing=1, ReadyToDownload=2),
+    IPromise=SimpleNamespace(Complete=0, Error=1),
+)
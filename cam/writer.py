@@ -0,0 +1,208 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from astropy.io import fits
+
+from log import DFLog
+
+
+class FITSWriter(object):
+    """Writes FITS files on background threads.
+
+    Frames are put on a bounded queue and written by one or more worker
+    threads, so a slow disk (for example an SD card on the Pi) does not stall
+    acquisition until the queue is full. When it is full submit() blocks,
+    which is the backpressure that stops frames piling up in memory. Queue
+    depth, write latency and time spent blocked are logged periodically.
+    """
+
+    def __init__(self, n_workers:int = 1, queue_size:int = 8, fsync:bool = False, fsync_batch:int = 1,
+                stats_interval:float = 30, logger = None):
+        """Initializes the writer and starts its worker threads.
+
+        Args:
+            n_workers (int, optional): Number of writer threads. Defaults to 1.
+            queue_size (int, optional): Frames waiting to be written before submit() blocks. Defaults to 8.
+            fsync (bool, optional): Make sure files are on disk, not just in the page cache. Defaults to False.
+            fsync_batch (int, optional): Files each worker writes between fsyncs. Defaults to 1.
+            stats_interval (float, optional): Seconds between statistics log messages. Defaults to 30.
+            logger (logging.Logger, optional): Logger to use. Defaults to a new DFLog logger.
+        """
+        self.n_workers = n_workers
+        self.queue_size = queue_size
+        self.fsync = fsync
+        self.fsync_batch = max(1, fsync_batch)
+        self.stats_interval = stats_interval
+        self.logger = logger if logger is not None else DFLog('FITSWriter').logger
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stats_lock = threading.Lock()
+        self._last_stats_time = time.perf_counter()
+        self.reset_stats()
+
+        self._workers = []
+        for i in range(n_workers):
+            worker = threading.Thread(target=self._work, name=f'FITSWriter-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def capacity(self):
+        """Most frames that can be queued or being written at once."""
+        return self.queue_size + self.n_workers
+
+    @property
+    def is_running(self):
+        return any(worker.is_alive() for worker in self._workers)
+
+    def submit(self, data, header:dict, filename:str) -> Future:
+        """Queues a frame to be written. Blocks while the queue is full.
+
+        Args:
+            data (np.ndarray): Image data. Must not be modified until the write has finished.
+            header (dict): FITS keyword -> value.
+            filename (str): Path of the file to write.
+
+        Returns:
+            Future: Resolves to the filename once it is written, or raises the write error.
+        """
+        if not self.is_running:
+            raise RuntimeError("Error. FITS writer has been closed.")
+        future = Future()
+        start = time.perf_counter()
+        self._queue.put((data, header, filename, future, start))
+        blocked = time.perf_counter() - start
+        with self._stats_lock:
+            self._stats['n_submitted'] += 1
+            self._stats['blocked_s'] += blocked
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], self._queue.qsize())
+        return future
+
+    def flush(self, timeout:float = None) -> bool:
+        """Waits until every queued frame has been written.
+
+        Args:
+            timeout (float, optional): Seconds to wait. Defaults to None (wait forever).
+
+        Returns:
+            bool: True if the queue was emptied.
+        """
+        if timeout is None:
+            self._queue.join()
+        else:
+            end = time.perf_counter() + timeout
+            while self._queue.unfinished_tasks and time.perf_counter() < end:
+                time.sleep(0.01)
+        self.log_stats()
+        return self._queue.unfinished_tasks == 0
+
+    def close(self, timeout:float = None):
+        """Writes everything still queued and stops the workers."""
+        if not self.is_running:
+            return
+        self.flush(timeout)
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def stats(self) -> dict:
+        """Backpressure statistics since the last reset.
+
+        Returns:
+            stats (dict): queue depth, files written, write latency and time submit() spent blocked.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        n_written = stats['n_written']
+        stats['mean_write_s'] = stats['write_s'] / n_written if n_written else 0.0
+        stats['mean_latency_s'] = stats['latency_s'] / n_written if n_written else 0.0
+        return stats
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = {'n_submitted': 0, 'n_written': 0, 'n_failed': 0, 'max_queue_depth': 0,
+                           'blocked_s': 0.0, 'write_s': 0.0, 'max_write_s': 0.0, 'latency_s': 0.0}
+
+    def log_stats(self):
+        stats = self.stats()
+        self.logger.info(f"FITS writer: {stats['n_written']} written, {stats['n_failed']} failed, "
+                         f"queue depth {stats['queue_depth']} (max {stats['max_queue_depth']}/{self.queue_size}), "
+                         f"write {stats['mean_write_s']*1000:.1f}ms mean {stats['max_write_s']*1000:.1f}ms max, "
+                         f"queue to disk {stats['mean_latency_s']*1000:.1f}ms mean, blocked {stats['blocked_s']:.2f}s")
+        self._last_stats_time = time.perf_counter()
+
+    def _work(self):
+        unsynced = []
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._sync(unsynced)
+                self._queue.task_done()
+                break
+            data, header, filename, future, submitted = item
+            try:
+                start = time.perf_counter()
+                write_fits(data, header, filename)
+                if self.fsync:
+                    unsynced.append(filename)
+                    if len(unsynced) >= self.fsync_batch or self._queue.empty():
+                        self._sync(unsynced)
+                end = time.perf_counter()
+                with self._stats_lock:
+                    self._stats['n_written'] += 1
+                    self._stats['write_s'] += end - start
+                    self._stats['max_write_s'] = max(self._stats['max_write_s'], end - start)
+                    self._stats['latency_s'] += end - submitted
+                self.logger.info(f"Saved: {filename}")
+                future.set_result(filename)
+            except Exception as e:
+                with self._stats_lock:
+                    self._stats['n_failed'] += 1
+                self.logger.error(f"Could not write {filename}: {str(e)}")
+                future.set_exception(e)
+            finally:
+                self._queue.task_done()
+            if time.perf_counter() - self._last_stats_time > self.stats_interval:
+                self.log_stats()
+
+    def _sync(self, filenames:list):
+        """fsyncs written files (and their directories) then empties the list."""
+        directories = set()
+        for filename in filenames:
+            fsync_path(filename)
+            directories.add(os.path.dirname(os.path.abspath(filename)))
+        for directory in directories:
+            fsync_path(directory)
+        filenames.clear()
+
+
+def write_fits(data, header:dict, filename:str):
+    """Writes an image and its header values to a FITS file.
+
+    Args:
+        data (np.ndarray): Image data.
+        header (dict): FITS keyword -> value.
+        filename (str): Path of the file, overwritten if it exists.
+    """
+    hdul = fits.HDUList()
+    hdul.append(fits.PrimaryHDU())
+    hdul[0].data = data
+    hdul[0].header['BITPIX'] = 16
+    hdul[0].header['NAXIS'] = 2
+    hdul[0].header['NAXIS1'] = data.shape[0]
+    hdul[0].header['NAXIS2'] = data.shape[1]
+    for key, value in header.items():
+        hdul[0].header[key] = value
+    hdul.writeto(filename, overwrite=True)
+
+
+def fsync_path(path:str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
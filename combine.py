@@ -0,0 +1,191 @@
+import os
+import numpy as np
+from astropy.io import fits
+
+import loadImage
+import calibCache
+
+
+# Scale factor from the median absolute deviation to the standard deviation of a gaussian
+MAD_TO_STD = 1.482602218505602
+
+
+def sigmaClipCombine(frames, sigma=3, maxiters=None, bandBytes=64 * 1024**2):
+    """
+    Sigma clipped median combine of a stack of frames. Pixels are clipped
+    along the stack axis about their median using the MAD standard deviation,
+    repeating until nothing else is clipped (or maxiters is reached), and the
+    median of the values inside the final bounds is returned. This gives the same result as
+
+        clipped = sigma_clip(stack, sigma=sigma, maxiters=maxiters, axis=0, stdfunc='mad_std')
+        np.ma.median(clipped, axis=0)
+
+    (astropy's C implementation, worked in float64 like astropy does) but the
+    stack is processed in bands of rows so only bandBytes of it are in memory
+    at once, and lazy frames only have those rows read from disk.
+
+    Args:
+        frames (sequence): 2D frames to combine. Can be lazy memory mapped frames.
+        sigma (float, optional): Clipping threshold in standard deviations. Defaults to 3.
+        maxiters (int, optional): Maximum clipping iterations, None to clip until converged. Defaults to None.
+        bandBytes (int, optional): Approximate memory used per band of rows. Defaults to 64MB.
+
+    Returns:
+        np.ndarray: combined frame.
+    """
+    if len(frames) == 0:
+        raise ValueError("No frames to combine")
+    height, width = np.shape(frames[0])
+    nFrames = len(frames)
+    frameType = np.asarray(frames[0][:1]).dtype
+    dtype = frameType if frameType.kind == 'f' else np.dtype(np.float64)
+    # The band and a couple of working copies are in memory together
+    bandRows = max(1, int(bandBytes // (3 * frameType.itemsize * nFrames * width)))
+
+    combined = np.empty((height, width), dtype=dtype)
+    for start in range(0, height, bandRows):
+        stop = min(start + bandRows, height)
+        # (pixels, frames) so every pixel's values are contiguous for sorting
+        band = np.empty(((stop - start) * width, nFrames), dtype=frameType)
+        for i, frame in enumerate(frames):
+            band[:, i] = np.asarray(frame[start:stop]).ravel()
+        combined[start:stop] = clipBand(band, sigma, maxiters).reshape(stop - start, width)
+    return combined
+
+
+def clipBand(band, sigma, maxiters):
+    """
+    Sigma clipped median along axis 1 of a (pixels, frames) block.
+
+    Clipping always removes values from the ends of a pixel's distribution,
+    so after sorting once the unclipped values of every pixel are the range
+    sorted[low:high]. Medians are read straight from that range and the MAD
+    is found with a binary search of the sorted values, so nothing is sorted
+    or partitioned again. The block is sorted in its own dtype (integer
+    frames sort much faster than floats) and values are read as float64.
+    Only pixels that had something clipped last iteration are looked at again.
+    Like astropy the iteration only finds the bounds, the values kept are
+    everything inside the last bounds, which can bring back values clipped
+    in an earlier iteration.
+    """
+    data = np.sort(band, axis=1)
+    nPixels, nFrames = data.shape
+    low = np.zeros(nPixels, dtype=np.intp)
+    high = np.full(nPixels, nFrames, dtype=np.intp)
+    median = rangeMedian(data, low, high)
+    lowerBounds = np.empty(nPixels)
+    upperBounds = np.empty(nPixels)
+
+    active = np.arange(nPixels)
+    iteration = 0
+    while active.size and (maxiters is None or iteration < max(maxiters, 1)):
+        values = data[active] if active.size < nPixels else data
+        activeLow = low[active]
+        activeHigh = high[active]
+        activeMedian = median[active]
+        std = rangeMAD(data, active, activeLow, activeHigh, activeMedian) * MAD_TO_STD
+
+        # Move the ends of each pixel's range inwards past clipped values
+        lowerBound = activeMedian - std * sigma
+        upperBound = activeMedian + std * sigma
+        lowerBounds[active] = lowerBound
+        upperBounds[active] = upperBound
+        newLow = np.maximum((values < lowerBound[:, None]).sum(axis=1), activeLow)
+        newHigh = np.minimum(nFrames - (values > upperBound[:, None]).sum(axis=1), activeHigh)
+        changed = (newLow != activeLow) | (newHigh != activeHigh)
+
+        active = active[changed]
+        low[active] = newLow[changed]
+        high[active] = newHigh[changed]
+        median[active] = rangeMedian(data, low[active], high[active], active)
+        iteration += 1
+
+    if iteration == 0:
+        return median
+    # Keep everything inside the last bounds of each pixel
+    low = (data < lowerBounds[:, None]).sum(axis=1)
+    high = nFrames - (data > upperBounds[:, None]).sum(axis=1)
+    return rangeMedian(data, low, high)
+
+
+def rangeMedian(data, low, high, rows=None):
+    """
+    Median of sorted[low:high] along axis 1 for every pixel (or only rows).
+    """
+    if rows is None:
+        rows = np.arange(data.shape[0])
+    count = high - low
+    lower = data[rows, low + (count - 1) // 2].astype(np.float64)
+    return (lower + data[rows, low + count // 2]) / 2
+
+
+def rangeMAD(data, rows, low, high, median):
+    """
+    Median absolute deviation of sorted[low:high] about median for the given rows.
+
+    Split at the median the absolute deviations are two sorted runs, the
+    values below the median read backwards and the values above it read
+    forwards. The middle of the deviations is found by a binary search for
+    how many of them come from the run below, like the k-th smallest of two
+    sorted arrays, so only a handful of values per pixel are read.
+    """
+    flat = data.ravel()
+    count = high - low
+    # Flat index of the first value of each run, the below run counts down from it
+    belowStart = rows * data.shape[1] + low + count // 2 - 1
+    aboveStart = belowStart + 1
+    below = count // 2
+    above = count - below
+
+    # Smallest i so that the k+1 smallest deviations are i from below and k+1-i
+    # from above. Every index read inside the search is within its run.
+    k = (count - 1) // 2
+    lo = np.maximum(0, k + 1 - above)
+    hi = np.minimum(k + 1, below)
+    search = np.nonzero(lo < hi)[0]
+    while search.size:
+        mid = (lo[search] + hi[search]) // 2
+        belowDev = median[search] - flat[belowStart[search] - mid]
+        aboveDev = flat[aboveStart[search] + k[search] - mid] - median[search]
+        atLeast = belowDev >= aboveDev
+        hi[search[atLeast]] = mid[atLeast]
+        lo[search[~atLeast]] = mid[~atLeast] + 1
+        search = search[lo[search] < hi[search]]
+
+    def runDev(start, n, size, sign):
+        # n-th deviation of a run, -inf before it starts and inf past its end
+        deviation = sign * (flat[start + sign * np.clip(n, 0, np.maximum(size - 1, 0))] - median)
+        deviation[n < 0] = -np.inf
+        deviation[n >= size] = np.inf
+        return deviation
+
+    taken = k + 1 - lo
+    kth = np.maximum(runDev(belowStart, lo - 1, below, -1), runDev(aboveStart, taken - 1, above, 1))
+    # Even counts average the k-th and next smallest deviation
+    following = np.minimum(runDev(belowStart, lo, below, -1), runDev(aboveStart, taken, above, 1))
+    return np.where(count % 2 == 1, kth, (kth + following) / 2)
+
+
+def createMasterBias(biasDir, savePath, sigma=3, maxiters=None):
+    """
+    Sigma clipped median master bias of every fits image in a directory. The
+    master comes from the calibration cache when the biases have not changed.
+    Used by both RON and DC.
+
+    Args:
+        biasDir (str): Directory of bias frames.
+        savePath (str): Where to write the master bias fits file.
+        sigma (float, optional): Clipping threshold. Defaults to 3.
+        maxiters (int, optional): Maximum clipping iterations. Defaults to None (until converged).
+
+    Returns:
+        np.ndarray: master bias (float32).
+    """
+    bias = loadImage.fitsLoader(biasDir, lazy=True).loadImages()
+    master = calibCache.getCache().master(
+        bias.filePaths, 'bias',
+        lambda: sigmaClipCombine(bias, sigma=sigma, maxiters=maxiters).astype(np.float32),
+        sigma=sigma, maxiters=maxiters, method='median', stdfunc='mad_std', axis='stack')
+    os.makedirs(os.path.dirname(savePath), exist_ok=True)
+    fits.writeto(savePath, master, overwrite=True)
+    return master
@@ -0,0 +1,150 @@
+import os
+import json
+from astropy.io import fits
+from collections import OrderedDict
+
+
+# Header values stored in the index for every fits file
+INDEX_KEYS = ['EXPTIME', 'IMAGETYP', 'CCD-TEMP', 'READOUTM', 'NAXIS', 'NAXIS1', 'NAXIS2', 'DATE-OBS']
+
+
+class headerIndex:
+    """
+    Sidecar index of the fits headers in a directory. The index is stored as
+    a small JSON table next to the images and holds the filename, size, mtime
+    and a few header values of every file. Only files that were added or
+    changed since the last refresh have their headers read again, so grouping
+    and filtering frames never touches pixel data.
+    """
+
+    filename = '.headerIndex.json'
+
+    def __init__(self, folderPath, keys=INDEX_KEYS):
+        """
+        Args:
+            folderPath (str): Directory holding the fits images.
+            keys (list, optional): Header values to index. Defaults to INDEX_KEYS.
+        """
+        self.folderPath = folderPath
+        self.keys = list(keys)
+        self.indexPath = os.path.join(folderPath, self.filename)
+        self.entries = OrderedDict()
+        self.load()
+        self.refresh()
+
+
+    def load(self):
+        """
+        Load the stored index if there is one. An index built with different
+        keys is thrown away and rebuilt.
+        """
+        try:
+            with open(self.indexPath) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        if stored.get('keys') == self.keys:
+            self.entries = OrderedDict((entry['filename'], entry) for entry in stored['files'])
+
+
+    def save(self):
+        """
+        Write the index next to the images. A read only (or full) data directory
+        just keeps the index in memory, a lookup never fails because of the sidecar.
+        """
+        stored = {'keys': self.keys, 'files': list(self.entries.values())}
+        tmpPath = self.indexPath + '.tmp'
+        try:
+            with open(tmpPath, 'w') as f:
+                # Header values json can not store (like an undefined card) are kept as text
+                json.dump(stored, f, indent=1, default=str)
+            os.replace(tmpPath, self.indexPath)
+        except OSError:
+            try:
+                os.remove(tmpPath)
+            except OSError:
+                pass
+
+
+    def refresh(self):
+        """
+        Bring the index up to date with the directory. Headers are only read for
+        files that are new or whose size/mtime changed, removed files are dropped.
+
+        Returns:
+            bool: True if anything changed.
+        """
+        changed = False
+        current = OrderedDict()
+        for filename in sorted(os.listdir(self.folderPath)):
+            if not filename.endswith('.fits'):
+                continue
+            filePath = os.path.join(self.folderPath, filename)
+            stat = os.stat(filePath)
+            entry = self.entries.get(filename)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+                try:
+                    header = fits.getheader(filePath)
+                except Exception as e:
+                    print(f"Error reading {filePath}: {str(e)}")
+                    continue
+                entry = {'filename': filename, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+                for key in self.keys:
+                    entry[key] = header.get(key)
+                changed = True
+            current[filename] = entry
+
+        if changed or list(current) != list(self.entries):
+            self.entries = current
+            self.save()
+            return True
+        return False
+
+
+    def files(self):
+        """
+        Sorted list of the indexed fits files.
+        """
+        return list(self.entries)
+
+
+    def get(self, filename, key):
+        """
+        Header value of a single file.
+
+        Args:
+            filename (str): Name of the fits file (not the full path).
+            key (str): Indexed header key.
+        """
+        return self.entries[filename].get(key)
+
+
+    def select(self, criteria):
+        """
+        Filenames whose header values match every criteria.
+        Example: select({'IMAGETYP': 'dark', 'EXPTIME': 10.0})
+
+        Args:
+            criteria (dict): Header key -> wanted value.
+
+        Returns:
+            list: Matching filenames.
+        """
+        return [filename for filename, entry in self.entries.items()
+                if all(entry.get(key) == value for key, value in criteria.items())]
+
+
+    def groupBy(self, key):
+        """
+        Group filenames by a header value, sorted by that value.
+
+        Args:
+            key (str): Indexed header key. For example 'EXPTIME'.
+
+        Returns:
+            OrderedDict: Header value -> list of filenames.
+        """
+        groups = {}
+        for filename, entry in self.entries.items():
+            groups.setdefault(entry.get(key), []).append(filename)
+        return OrderedDict(sorted(groups.items(), key=lambda item: (item[0] is None, item[0])))
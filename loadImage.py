@@ -2,33 +2,255 @@ import os
 import numpy as np 
 from astropy.io import fits
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
 import re
 
+from headerIndex import headerIndex
+
+
+# Numpy dtypes of the raw (big endian) data unit for each FITS BITPIX value
+BITPIX_DTYPES = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+
+class lazyFrame:
+    """
+    A single FITS frame whose pixels stay on disk until they are sliced.
+    The data unit of the primary HDU is memory mapped directly from its
+    offset in the file and BZERO/BSCALE are applied to the slice only,
+    so frames written by the camera (uint16 stored with BZERO=32768) can
+    be mapped without astropy copying the whole image.
+    """
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        with fits.open(filePath, memmap=True) as hdul:
+            self.header = hdul[0].header.copy()
+            offset = hdul.fileinfo(0)['datLoc']
+        bitpix = self.header['BITPIX']
+        naxis = self.header['NAXIS']
+        # FITS axes are stored fastest varying first, numpy wants the reverse
+        shape = tuple(self.header[f'NAXIS{n}'] for n in range(naxis, 0, -1))
+        self.bzero = self.header.get('BZERO', 0)
+        self.bscale = self.header.get('BSCALE', 1)
+        self._raw = np.memmap(filePath, dtype=BITPIX_DTYPES[bitpix], mode='r', offset=offset, shape=shape)
+        self.dtype = scaledDtype(self.header)
+
+    @property
+    def shape(self):
+        return self._raw.shape
+
+    @property
+    def ndim(self):
+        return self._raw.ndim
+
+    def __len__(self):
+        return self._raw.shape[0]
+
+    def __getitem__(self, key):
+        """
+        Read only the requested pixels from disk and scale them the same 
+        way astropy would.
+        """
+        raw = np.asarray(self._raw[key])
+        native = raw.astype(raw.dtype.newbyteorder('='))
+        if self.dtype.kind == 'u' and raw.dtype.kind == 'i':
+            # Unsigned data stored as signed integers with a BZERO offset
+            return native.view(self.dtype) ^ self.dtype.type(self.bzero)
+        if self.bscale != 1 or self.bzero != 0:
+            return (native * self.bscale + self.bzero).astype(self.dtype)
+        return native
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+
+class frameSequence:
+    """
+    Sequence-like view of the frames in a list of FITS files. Indexing 
+    returns a lazyFrame (or a list of them for slices) so nothing is read
+    until an analysis slices the pixels.
+    """
+
+    def __init__(self, filePaths):
+        self.filePaths = list(filePaths)
+        self._frames = {}
+
+    def __len__(self):
+        return len(self.filePaths)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index not in self._frames:
+            self._frames[index] = lazyFrame(self.filePaths[index])
+        return self._frames[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def scaledDtype(header):
+    """
+    Works out the numpy dtype astropy gives the data of a FITS header 
+    once BZERO/BSCALE have been applied.
+
+    Args:
+        header (fits.Header): Header of the HDU.
+
+    Returns:
+        np.dtype: dtype of the scaled data.
+    """
+    bitpix = header['BITPIX']
+    bzero = header.get('BZERO', 0)
+    bscale = header.get('BSCALE', 1)
+    raw = np.dtype(BITPIX_DTYPES[bitpix]).newbyteorder('=')
+    if bitpix > 8 and bscale == 1 and bzero == 2**(bitpix - 1):
+        return np.dtype(f'u{raw.itemsize}')
+    if bscale != 1 or bzero != 0:
+        return np.dtype(np.float32) if bitpix in (8, 16) else np.dtype(np.float64)
+    return raw
+
+
+def decodeToShared(filePath, head=None):
+    """
+    Worker for parallel loading. Decodes a fits image (byte swapping and 
+    scaling happen here) and copies it into a new shared memory block so 
+    the pixels do not have to be pickled back to the main process.
+
+    Args:
+        filePath (str): Path to the fits file.
+        head (str, optional): Header value to return along with the image.
+
+    Returns:
+        tuple: shared memory name, shape, dtype string and header value.
+    """
+    with fits.open(filePath) as hdul:
+        data = hdul[0].data
+        key = hdul[0].header.get(head) if head else None
+        data = data.astype(data.dtype.newbyteorder('='), copy=False)
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[...] = data
+    shm.close()
+    return shm.name, data.shape, data.dtype.str, key
+
+
+def collectShared(name, shape, dtype):
+    """
+    Copy a frame out of the shared memory block made by decodeToShared
+    and free the block.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return data
+
 
 class fitsLoader:
 
-    def __init__(self, folderPath):
+    def __init__(self, folderPath, lazy=False, workers=None):
+        """
+        Args:
+            folderPath (str): Directory holding the fits images.
+            lazy (bool, optional): Return memory mapped frames that are only read
+            from disk when sliced instead of loading every image into RAM. Defaults to False.
+            workers (int, optional): Number of processes used to decode fits files
+            in parallel. Ignored in lazy mode. Defaults to None (serial loading).
+        """
         self.folderPath = folderPath
+        self.lazy = lazy
+        self.workers = workers
         self.images = []
         self.keyImages = {}
+        self._index = None
 
 
-    def loadImages(self):
+    @property
+    def index(self):
         """
-        Takes fits images from a folder whos path is specified in
-        the constructor and adds the image data (primary header)
-        to a list called "images"
+        Header index of the folder. Built (or refreshed) the first time it is 
+        used and kept for the lifetime of the loader.
+        """
+        if self._index is None:
+            self._index = headerIndex(self.folderPath)
+        return self._index
+
+
+    def fitsFiles(self):
+        """
+        Sorted list of the fits files in the folder so images always load in 
+        the same order.
         """
-        for filename in os.listdir(self.folderPath):
-            # incase there is a non-fit file in the folder
-            if filename.endswith(".fits"):
-                filePath = os.path.join(self.folderPath, filename)
+        return sorted(file for file in os.listdir(self.folderPath) if file.endswith(".fits"))
+
+
+    def readFrames(self, filePaths, head=None):
+        """
+        Read the primary image (and optionally a header value) of each file.
+        Uses a process pool when the loader was made with workers > 1, results
+        always come back in the same order as filePaths. Files that cannot be
+        read are reported and skipped.
+
+        Args:
+            filePaths (list): Paths of the fits files.
+            head (str, optional): Header value to read with each image.
+
+        Returns:
+            list: (filePath, data, header value) for every file read.
+        """
+        frames = []
+        if self.lazy or not self.workers or self.workers < 2:
+            for filePath in filePaths:
+                try:
+                    if self.lazy:
+                        data = lazyFrame(filePath)
+                        key = data.header.get(head) if head else None
+                    else:
+                        with fits.open(filePath) as hdul:
+                            data = hdul[0].data
+                            key = hdul[0].header.get(head) if head else None
+                    frames.append((filePath, data, key))
+                except Exception as e:
+                    print(f"Error reading {filePath}: {str(e)}")
+            return frames
+
+        # Start the resource tracker here so the workers share it and blocks
+        # created in a worker but unlinked here are not reported as leaked
+        resource_tracker.ensure_running()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(decodeToShared, filePath, head) for filePath in filePaths]
+            for filePath, future in zip(filePaths, futures):
                 try:
-                    with fits.open(filePath) as hdul:
-                        data = hdul[0].data
-                        self.images.append(data)
+                    name, shape, dtype, key = future.result()
+                    frames.append((filePath, collectShared(name, shape, dtype), key))
                 except Exception as e:
                     print(f"Error reading {filePath}: {str(e)}")
+        return frames
+
+
+    def loadImages(self):
+        """
+        Takes fits images from a folder whos path is specified in
+        the constructor and adds the image data (primary header)
+        to a list called "images". In lazy mode "images" is a frameSequence
+        of memory mapped frames instead.
+        """
+        filePaths = [os.path.join(self.folderPath, filename) for filename in self.fitsFiles()]
+        if self.lazy:
+            # Headers are only parsed when a frame is first indexed
+            self.images = frameSequence(filePaths)
+            return self.images
+        for filePath, data, key in self.readFrames(filePaths):
+            self.images.append(data)
         return self.images
     
     def getHeaderInfo(self, str):
@@ -42,15 +264,16 @@ class fitsLoader:
         Returns:
             _type_: data associated with header. 
         """
-        all_files = os.listdir(self.folderPath)
-        fits_files = [file for file in all_files if file.endswith('.fits')]
+        fits_files = self.index.files()
 
         if not fits_files:
             print("No fits files in directory")
         else:
-            fitsFile = fits.open(os.path.join(self.folderPath, fits_files[0]))
-            header = fitsFile[0].header
-            result = header.get(str)
+            # Indexed values never need the file to be opened
+            if str in self.index.keys:
+                result = self.index.get(fits_files[0], str)
+            else:
+                result = fits.getheader(os.path.join(self.folderPath, fits_files[0])).get(str)
             if not result: 
                 print(f"Argument {str} not found in fits header for image: {self.folderPath}\n for image: {fits_files[0]}")
             return result
@@ -65,21 +288,24 @@ class fitsLoader:
         Args:
             head (str): Header value to sort images by.
         """
-        for filename in os.listdir(self.folderPath):
-            if filename.endswith(".fits"):
-                filePath = os.path.join(self.folderPath, filename)
-                try:
-                    with fits.open(filePath) as hdul:
-                        header = hdul[0].header
-                        key = header.get(head)
-                        data = hdul[0].data
+        if head in self.index.keys:
+            # Group with the header index so only pixel data is read below
+            keys = {}
+            for key, filenames in self.index.groupBy(head).items():
+                for filename in filenames:
+                    keys[os.path.join(self.folderPath, filename)] = key
+            for filePath, data, _ in self.readFrames(list(keys)):
+                if keys[filePath] not in self.keyImages:
+                    self.keyImages[keys[filePath]] = []
 
-                        if key not in self.keyImages:
-                            self.keyImages[key] = []
+                self.keyImages[keys[filePath]].append(data)
+        else:
+            filePaths = [os.path.join(self.folderPath, filename) for filename in self.fitsFiles()]
+            for filePath, data, key in self.readFrames(filePaths, head):
+                if key not in self.keyImages:
+                    self.keyImages[key] = []
 
-                        self.keyImages[key].append(data)
-                except Exception as e:
-                    print(f"Error reading {filePath}: {str(e)}")
+                self.keyImages[key].append(data)
 
         self.keyImages = OrderedDict(sorted(self.keyImages.items()))
         return self.keyImages
@@ -98,30 +324,26 @@ class fitsLoader:
             self.keyImages (dict): Sorted dictionary of numpy arrays
             containing pixel information.
         """
-        for filename in os.listdir(self.folderPath):
-            # in case there is a non-fit file in the folder
-            if filename.endswith(".fits"):
-                # Extract information from filename using regular expression
-                if extraction_type == 'wavelength':
-                    pattern = rf'\d+s_{delimiter}(\d+)nm'
-                elif extraction_type == 'exposure_time':
-                    pattern = rf'(\d+)s_{delimiter}\d+nm'
-                elif extraction_type == 'temp':
-                    pattern = rf'(-?\d+)C_{delimiter}'
-
-                match = re.search(pattern, filename)
-                if match:
-                    info = match.group(1)
-                    filePath = os.path.join(self.folderPath, filename)
-                    try:
-                        with fits.open(filePath) as hdul:
-                            data = hdul[0].data
-                            self.images.append(data)
-                            if info not in self.keyImages:
-                                self.keyImages[info] = []
-                            self.keyImages[info].append(data)
-                    except Exception as e:
-                        print(f"Error reading {filePath}: {str(e)}")
+        # Extract information from filename using regular expression
+        if extraction_type == 'wavelength':
+            pattern = rf'\d+s_{delimiter}(\d+)nm'
+        elif extraction_type == 'exposure_time':
+            pattern = rf'(\d+)s_{delimiter}\d+nm'
+        elif extraction_type == 'temp':
+            pattern = rf'(-?\d+)C_{delimiter}'
+
+        matched = {}
+        for filename in self.fitsFiles():
+            match = re.search(pattern, filename)
+            if match:
+                matched[os.path.join(self.folderPath, filename)] = match.group(1)
+
+        for filePath, data, key in self.readFrames(list(matched)):
+            info = matched[filePath]
+            self.images.append(data)
+            if info not in self.keyImages:
+                self.keyImages[info] = []
+            self.keyImages[info].append(data)
 
         # Sort dict by information (either wavelength or exposure time) lowest -> highest
         self.keyImages = {k: v for k, v in sorted(self.keyImages.items())}
@@ -0,0 +1,419 @@
+import numpy as np
+
+
+class pixelStats:
+    """
+    Streaming pixel wise statistics for a stack of frames. Frames are added
+    one at a time and the running count, mean, M2 (Welford), min and max are
+    updated in place, so memory stays at a few frames no matter how many
+    frames are in the stack.
+    """
+
+    def __init__(self, dtype=np.float64):
+        """
+        Args:
+            dtype (np.dtype, optional): Precision of the running totals. Defaults to float64.
+        """
+        self.dtype = dtype
+        self.count = 0
+        self._mean = None
+        self._m2 = None
+        self._min = None
+        self._max = None
+
+
+    def add(self, frame):
+        """
+        Add a single frame to the running statistics.
+
+        Args:
+            frame (array like): 2D frame. Can be a lazy memory mapped frame.
+        """
+        # Always a private copy since it is reused as scratch space below
+        frame = np.array(frame, dtype=self.dtype)
+        if self.count == 0:
+            self._mean = np.zeros(frame.shape, dtype=self.dtype)
+            self._m2 = np.zeros(frame.shape, dtype=self.dtype)
+            self._min = frame.copy()
+            self._max = frame.copy()
+        elif frame.shape != self._mean.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match stack shape {self._mean.shape}")
+        else:
+            np.minimum(self._min, frame, out=self._min)
+            np.maximum(self._max, frame, out=self._max)
+
+        self.count += 1
+        # Welford update done in place to avoid extra full frame temporaries
+        delta = frame - self._mean
+        self._mean += delta / self.count
+        frame -= self._mean
+        delta *= frame
+        self._m2 += delta
+        return self
+
+
+    def addFrames(self, frames):
+        """
+        Add every frame of an iterable (list, frameSequence, generator...).
+        """
+        for frame in frames:
+            self.add(frame)
+        return self
+
+
+    def merge(self, other):
+        """
+        Combine with statistics accumulated separately (Chan et al. parallel
+        algorithm). Used to join partial stacks from different workers.
+
+        Args:
+            other (pixelStats): Statistics for another part of the stack.
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            self._mean = other._mean.copy()
+            self._m2 = other._m2.copy()
+            self._min = other._min.copy()
+            self._max = other._max.copy()
+            return self
+        total = self.count + other.count
+        delta = other._mean - self._mean
+        self._m2 += other._m2 + delta**2 * (self.count * other.count / total)
+        self._mean += delta * (other.count / total)
+        np.minimum(self._min, other._min, out=self._min)
+        np.maximum(self._max, other._max, out=self._max)
+        self.count = total
+        return self
+
+
+    def checkCount(self, needed=1):
+        if self.count < needed:
+            raise ValueError(f"Need at least {needed} frames, only {self.count} added")
+
+
+    @property
+    def mean(self):
+        self.checkCount()
+        return self._mean
+
+    @property
+    def sum(self):
+        self.checkCount()
+        return self._mean * self.count
+
+    @property
+    def min(self):
+        self.checkCount()
+        return self._min
+
+    @property
+    def max(self):
+        self.checkCount()
+        return self._max
+
+    def variance(self, ddof=0):
+        """
+        Pixel wise variance. ddof=0 matches np.var(stack, axis=0).
+        """
+        self.checkCount(ddof + 1)
+        return self._m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        """
+        Pixel wise standard deviation. ddof=0 matches np.std(stack, axis=0).
+        """
+        return np.sqrt(self.variance(ddof))
+
+
+def stackMean(frames, dtype=np.float64):
+    """
+    Pixel wise mean of a stack of frames without holding the stack in memory.
+
+    Args:
+        frames (iterable): Frames to average.
+
+    Returns:
+        np.ndarray: mean frame.
+    """
+    return pixelStats(dtype).addFrames(frames).mean
+
+
+def tileView(frame, tileSize):
+    """
+    View of a frame split into square tiles. Rows/columns that do not fill a
+    whole tile are cropped off the bottom/right edge.
+
+    Args:
+        frame (array like): 2D frame.
+        tileSize (int): Width of a tile in pixels.
+
+    Returns:
+        np.ndarray: (tilesY, tileSize, tilesX, tileSize) view of the frame.
+    """
+    frame = np.asarray(frame)
+    tilesY = frame.shape[0] // tileSize
+    tilesX = frame.shape[1] // tileSize
+    cropped = frame[:tilesY * tileSize, :tilesX * tileSize]
+    return cropped.reshape(tilesY, tileSize, tilesX, tileSize)
+
+
+def tileMeanVar(frame, tileSize):
+    """
+    Mean and variance of every tile of a frame.
+
+    Returns:
+        tuple: (means, variances), both (tilesY, tilesX) arrays.
+    """
+    tiles = tileView(frame, tileSize)
+    return tiles.mean(axis=(1, 3)), tiles.var(axis=(1, 3))
+
+
+def linearFit(x, y):
+    """
+    Least squares straight line through the points along axis 0, solved in
+    closed form for every other index at once. Equivalent to calling
+    np.polyfit(x[:, i], y[:, i], 1) for each i.
+
+    Args:
+        x (np.ndarray): (N, ...) x values. Can also be 1D (N,) and shared by every fit.
+        y (np.ndarray): (N, ...) y values.
+
+    Returns:
+        tuple: (slope, intercept) arrays with the shape of y[0].
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if x.ndim == 1 and y.ndim > 1:
+        x = x.reshape((-1,) + (1,) * (y.ndim - 1))
+    xMean = x.mean(axis=0)
+    yMean = y.mean(axis=0)
+    dx = x - xMean
+    slope = (dx * (y - yMean)).sum(axis=0) / (dx**2).sum(axis=0)
+    intercept = yMean - slope * xMean
+    return slope, intercept
+
+
+class pixelRegression:
+    """
+    Streaming least squares straight line fit for every pixel. Points are
+    added one (x, y) frame pair at a time and only the running weighted sums
+    are kept, so fitting N points per pixel costs O(H*W) memory.
+    Used for per pixel photon transfer curves and dark current ramps.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._sw = None
+        self._sx = None
+        self._sy = None
+        self._sxx = None
+        self._sxy = None
+        self._syy = None
+
+
+    def add(self, x, y, weight=1):
+        """
+        Add one point to every pixel's fit.
+
+        Args:
+            x (array like): x value, a scalar shared by every pixel or a frame.
+            y (array like): y value frame.
+            weight (array like, optional): Weight of the point, scalar or frame. Defaults to 1.
+        """
+        y = np.asarray(y, dtype=np.float64)
+        x = np.broadcast_to(np.asarray(x, dtype=np.float64), y.shape)
+        w = np.broadcast_to(np.asarray(weight, dtype=np.float64), y.shape)
+        if self.count == 0:
+            self._sw, self._sx, self._sy, self._sxx, self._sxy, self._syy = (
+                np.zeros(y.shape) for _ in range(6))
+        elif y.shape != self._sy.shape:
+            raise ValueError(f"Frame shape {y.shape} does not match fit shape {self._sy.shape}")
+        wx = w * x
+        self._sw += w
+        self._sx += wx
+        self._sy += w * y
+        self._sxx += wx * x
+        self._sxy += wx * y
+        self._syy += w * y * y
+        self.count += 1
+        return self
+
+
+    def solve(self):
+        """
+        Solve every pixel's fit at once. Pixels whose x values are all the
+        same have no defined slope and come back as NaN.
+
+        Returns:
+            tuple: (slope, intercept, residual rms) frames.
+        """
+        if self.count < 2:
+            raise ValueError(f"Need at least 2 points, only {self.count} added")
+        with np.errstate(divide='ignore', invalid='ignore'):
+            det = self._sw * self._sxx - self._sx**2
+            slope = (self._sw * self._sxy - self._sx * self._sy) / det
+            intercept = (self._sy - slope * self._sx) / self._sw
+            # Weighted residual sum of squares from the sums, no second pass needed
+            rss = (self._syy - slope * self._sxy - intercept * self._sy)
+            rms = np.sqrt(np.maximum(rss, 0) / self._sw)
+        return slope, intercept, rms
+
+
+def madOutliers(frame, sigma=3):
+    """
+    Pixels more than sigma robust standard deviations from the median of a
+    frame, using the median absolute deviation scaled to a gaussian standard
+    deviation. A single pass so it is cheap enough to run on full frames.
+
+    Args:
+        frame (array like): 2D frame.
+        sigma (float, optional): Threshold in standard deviations. Defaults to 3.
+
+    Returns:
+        np.ndarray: boolean mask, True for outliers.
+    """
+    frame = np.asarray(frame)
+    median = np.median(frame)
+    deviation = np.abs(frame - median)
+    std = np.median(deviation) * 1.482602218505602
+    return deviation > sigma * std
+
+
+class rtnStats:
+    """
+    Streaming random telegraph noise statistics for every pixel of a bias
+    stack. Each frame is compared to the first one and the previous one to
+    accumulate the first four moments, the number of jumps between consecutive
+    frames larger than jumpSigma times the noise of a difference, and a histogram with a
+    few coarse bins. Everything is updated in place so the stack is read once
+    and memory stays at nBins + a handful of frames. The histogram is a
+    (nBins, H*W) uint16 array, about 170MB for a full 3208x2200 frame with
+    the default 12 bins, so use fewer bins or a subframe on small machines.
+    """
+
+    def __init__(self, jumpSigma=5, nBins=12, binSigma=2.5, minNoise=0.5):
+        """
+        Args:
+            jumpSigma (float, optional): Jump threshold in standard deviations of a frame difference. Defaults to 5.
+            nBins (int, optional): Number of histogram bins, each costs 2 bytes per pixel. Defaults to 12.
+            binSigma (float, optional): Histogram bin width in read noise standard deviations. Defaults to 2.5.
+            minNoise (float, optional): Floor on the read noise estimate in ADU. Integer frames with very
+            little noise can have a MAD of exactly 0, which would make every step a jump. Defaults to 0.5.
+        """
+        self.jumpSigma = jumpSigma
+        self.nBins = nBins
+        self.binSigma = binSigma
+        self.minNoise = minNoise
+        self.count = 0
+        self.noise = None
+
+
+    def add(self, frame):
+        """
+        Add the next frame of the stack. Frames must be added in time order.
+        """
+        frame = np.array(frame, dtype=np.float64)
+        if self.count == 0:
+            self._reference = frame
+            self._previous = frame
+            self._sums = [np.zeros(frame.shape) for _ in range(4)]
+            self._jumps = np.zeros(frame.shape, dtype=np.uint16)
+            self._hist = np.zeros((self.nBins, frame.size), dtype=np.uint16)
+            self._pixels = np.arange(frame.size)
+        elif frame.shape != self._reference.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match stack shape {self._reference.shape}")
+
+        step = frame - self._previous
+        if self.count == 1:
+            # Read noise of a single frame from the first difference, robust to the RTN pixels
+            self.noise = np.median(np.abs(step)) * 1.482602218505602 / np.sqrt(2)
+            if self.noise < self.minNoise:
+                # The MAD of integer data is quantized (and can be 0), use the std of
+                # the difference without its largest 1% of steps instead
+                small = np.abs(step) <= np.percentile(np.abs(step), 99)
+                self.noise = max(np.std(step[small]) / np.sqrt(2), self.minNoise)
+            self._binWidth = self.binSigma * self.noise
+            # The first frame's histogram entry could not be binned until the noise was known
+            self._addHistogram(np.zeros_like(self._reference))
+        if self.count >= 1:
+            # A difference of two frames has sqrt(2) times the noise of one
+            self._jumps += np.abs(step) > self.jumpSigma * self.noise * np.sqrt(2)
+
+        deviation = frame - self._reference
+        power = deviation.copy()
+        for total in self._sums:
+            total += power
+            power *= deviation
+        if self.count >= 1:
+            self._addHistogram(deviation)
+
+        self._previous = frame
+        self.count += 1
+        return self
+
+
+    def _addHistogram(self, deviation):
+        # Bins are centred on the first frame, values past the ends go in the end bins
+        bins = np.floor(deviation.ravel() / self._binWidth + 0.5).astype(np.intp) + self.nBins // 2
+        np.clip(bins, 0, self.nBins - 1, out=bins)
+        self._hist.reshape(-1)[bins * self._pixels.size + self._pixels] += 1
+
+
+    def addFrames(self, frames):
+        for frame in frames:
+            self.add(frame)
+        return self
+
+
+    @property
+    def jumps(self):
+        """
+        Number of jumps between consecutive frames for every pixel.
+        """
+        return self._jumps
+
+    @property
+    def histogram(self):
+        """
+        (nBins, H, W) histogram of each pixel's values about its first frame.
+        """
+        return self._hist.reshape((self.nBins,) + self._reference.shape)
+
+    def std(self):
+        n = self.count
+        mean = self._sums[0] / n
+        return np.sqrt(np.maximum(self._sums[1] / n - mean**2, 0))
+
+
+    def bimodality(self):
+        """
+        Sample bimodality coefficient (g^2 + 1) / (k + 3(n-1)^2 / ((n-2)(n-3)))
+        with g the skewness and k the excess kurtosis. Gaussian noise gives 1/3,
+        values above 5/9 point to a bimodal (telegraph) pixel.
+        """
+        n = self.count
+        if n < 4:
+            raise ValueError(f"Need at least 4 frames, only {n} added")
+        s1, s2, s3, s4 = (total / n for total in self._sums)
+        mean = s1
+        m2 = s2 - mean**2
+        m3 = s3 - 3 * mean * s2 + 2 * mean**3
+        m4 = s4 - 4 * mean * s3 + 6 * mean**2 * s2 - 3 * mean**4
+        with np.errstate(divide='ignore', invalid='ignore'):
+            skew = m3 / m2**1.5 * np.sqrt(n * (n - 1)) / (n - 2)
+            kurtosis = ((n + 1) * (m4 / m2**2 - 3) + 6) * (n - 1) / ((n - 2) * (n - 3))
+            coefficient = (skew**2 + 1) / (kurtosis + 3 * (n - 1)**2 / ((n - 2) * (n - 3)))
+        return np.nan_to_num(coefficient, nan=0)
+
+
+    def levels(self, minFraction=0.05):
+        """
+        Number of separate levels each pixel sits at: runs of neighbouring
+        histogram bins that each hold at least minFraction of the frames.
+        """
+        occupied = self.histogram >= max(2, minFraction * self.count)
+        starts = occupied[0].astype(np.uint8)
+        starts += (occupied[1:] & ~occupied[:-1]).sum(axis=0, dtype=np.uint8)
+        return starts
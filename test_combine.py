@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from astropy.stats import sigma_clip
+
+import combine
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.uint16])
+@pytest.mark.parametrize('maxiters', [None, 3, 1])
+def test_sigmaClipCombine_matches_astropy(dtype, maxiters):
+    rng = np.random.default_rng(0)
+    stack = rng.normal(1000, 5, (30, 40, 50))
+    outliers = rng.random(stack.shape) < 0.02
+    stack[outliers] += rng.normal(0, 200, outliers.sum())
+    stack = stack.astype(dtype)
+
+    expected = np.ma.median(sigma_clip(stack, sigma=3, maxiters=maxiters, axis=0, stdfunc='mad_std'), axis=0)
+    # Small bands so several of them are combined
+    combined = combine.sigmaClipCombine(list(stack), sigma=3, maxiters=maxiters, bandBytes=30 * 50 * 8 * 3 * 7)
+    np.testing.assert_allclose(combined, expected.filled(np.nan), rtol=0, atol=1e-4)
+
+
+def test_sigmaClipCombine_even_and_constant_stacks():
+    rng = np.random.default_rng(1)
+    stack = rng.integers(990, 1010, (8, 20, 20)).astype(np.uint16)
+    stack[:, :5] = 1000
+    expected = np.ma.median(sigma_clip(stack, sigma=2, axis=0, stdfunc='mad_std'), axis=0)
+    np.testing.assert_allclose(combine.sigmaClipCombine(list(stack), sigma=2), expected.filled(np.nan), rtol=0, atol=1e-4)